@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 18:05:37 2026
+
+@author: Hayley B. Caldwell
+
+DNap Relationship (Sigma): Streaming Artifact Detection
+
+Covariance-based (Potato) artifact detection as in yasa.art_detect with
+method='covar', but reading the recording in blocks. Only the covariance
+matrix of each window is kept (a few kB per window), so memory does not
+grow with the length of the recording, and windows get a provisional
+z-score as soon as their block has been read. The provisional z-scores
+use the median and MAD of the recent log-distances, so a run of large
+artifacts does not inflate the spread and hide the ones after it. The
+final artifact vector and z-scores are the same as yasa.art_detect
+(mean and SD, as in pyriemann's Potato).
+"""
+
+from collections import deque
+
+import numpy as np
+
+# units used by yasa when it reads a Raw, so the covariances are the same
+uv_units = dict(eeg='uV', emg='uV', eog='uV', ecg='uV')
+
+# yasa needs at least this many windows of a stage to z-score them
+min_windows = 30
+
+# stage code yasa gives to windows where half of the channels are flat
+flat_stage = -111991
+
+# provisional z-scores: median/MAD over the log-distances of the last
+# robust_windows windows of a stage (720 x 5 s = 1 h)
+robust_windows = 720
+
+# MAD to SD of a normal distribution
+mad_scale = 1.4826
+
+
+def _riemann_distance(covs, mean):
+    try:
+        from pyriemann.geometry.distance import distance_riemann
+    except ImportError:
+        from pyriemann.utils.distance import distance_riemann
+    return distance_riemann(covs, mean)
+
+
+def _riemann_geodesic(a, b, alpha):
+    try:
+        from pyriemann.geometry.geodesic import geodesic_riemann
+    except ImportError:
+        from pyriemann.utils.geodesic import geodesic_riemann
+    return geodesic_riemann(a, b, alpha)
+
+
+def raw_blocks(raw, block_sec=600.):
+    """Yield consecutive (channels, times) blocks of a Raw in uV.
+
+    Only one block is read from disk at a time when raw is not preloaded.
+    """
+    n_block = int(block_sec * raw.info['sfreq'])
+    for start in range(0, raw.n_times, n_block):
+        stop = min(start + n_block, raw.n_times)
+        yield raw.get_data(start=start, stop=stop, units=uv_units)
+
+
+class StreamingArtifactDetector:
+    """Potato artifact detection fed with consecutive blocks of samples.
+
+    Call ``update(block)`` with each (channels, times) block in uV; it
+    returns the indices of the windows completed by the block and their
+    provisional z-scores. Per stage, a Potato is fitted once 30 windows have
+    been seen; after that each window is scored against its mean with the
+    median and MAD of the last robust_windows log-distances, which follow
+    slow drifts over the night. Every clean window updates the running
+    Riemannian mean.
+    ``finish()`` refits each stage on all windows and returns the artifact
+    vector and z-scores of yasa.art_detect.
+    """
+
+    def __init__(self, sf, window=5, hypno=None, include=(1, 2, 3, 4),
+                 threshold=3, shrinkage=0.1):
+        if float(window * sf) != int(window * sf):
+            raise ValueError('window * sf must be a whole number of samples')
+        self.window = int(window * sf)
+        self.hypno = None if hypno is None else np.asarray(hypno)
+        self.include = np.atleast_1d(include) if hypno is not None else np.array([-2])
+        self.threshold = threshold
+        self.shrinkage = shrinkage
+        self.n_windows = 0
+        self._rest = None
+        self._covs = []
+        self._flat = []
+        self._ch_min = None
+        self._ch_max = None
+        self._refs = {}
+        self._warmup = {}
+
+    def _potato(self):
+        from pyriemann.artifact_detection import Potato
+        return Potato(metric='riemann', threshold=self.threshold, pos_label=0,
+                      neg_label=1, n_iter_max=10)
+
+    def _stages(self, idx, isflat):
+        """Stage of each window (value of the hypnogram at its first sample)."""
+        if self.hypno is None:
+            stages = np.full(len(idx), -2)
+        else:
+            stages = self.hypno[idx * self.window].copy()
+        stages[isflat.sum(axis=-1) / isflat.shape[-1] >= 0.5] = flat_stage
+        return stages
+
+    def update(self, block):
+        """Add the next block of samples; return (window indices, z-scores).
+
+        Windows of stages not in include, or of a stage with fewer than 30
+        windows so far, get a NaN z-score.
+        """
+        from pyriemann.estimation import Covariances
+
+        block = np.asarray(block, dtype=np.float64)
+        if self._ch_min is None:
+            self._ch_min = np.nanmin(block, axis=-1)
+            self._ch_max = np.nanmax(block, axis=-1)
+        else:
+            self._ch_min = np.fmin(self._ch_min, np.nanmin(block, axis=-1))
+            self._ch_max = np.fmax(self._ch_max, np.nanmax(block, axis=-1))
+        if self._rest is not None:
+            block = np.concatenate([self._rest, block], axis=-1)
+
+        n_chan, n_times = block.shape
+        n_win = n_times // self.window
+        # (windows, channels, samples) view of the complete windows
+        epochs = block[:, :n_win * self.window].reshape(n_chan, n_win, self.window)
+        epochs = epochs.transpose(1, 0, 2)
+        self._rest = block[:, n_win * self.window:].copy()
+
+        idx = np.arange(self.n_windows, self.n_windows + n_win)
+        self.n_windows += n_win
+        if n_win == 0:
+            return idx, np.empty(0)
+        isflat = (epochs == epochs[:, :, 1][..., None]).all(axis=-1)
+        covs = Covariances().fit_transform(epochs)
+        self._covs.append(covs)
+        self._flat.append(isflat)
+        return idx, self._provisional(covs, self._stages(idx, isflat))
+
+    def _provisional(self, covs, stages):
+        from pyriemann.estimation import Shrinkage
+
+        covs = Shrinkage(self.shrinkage).fit_transform(covs)
+        zscores = np.full(len(covs), np.nan)
+        for stage in self.include:
+            sel = np.nonzero(stages == stage)[0]
+            if sel.size == 0:
+                continue
+            if stage not in self._refs:
+                # collect windows until there are enough to fit
+                warmup = self._warmup.setdefault(stage, [])
+                warmup.append(covs[sel])
+                if sum(len(c) for c in warmup) < min_windows:
+                    continue
+                warmup = np.concatenate(self._warmup.pop(stage))
+                potato = self._potato().fit(warmup)
+                clean = potato.transform(warmup) < self.threshold
+                d = np.log(_riemann_distance(warmup, potato.covmean_))
+                self._refs[stage] = {'mean': potato.covmean_, 'n': clean.sum(),
+                                     'dists': deque(d, maxlen=robust_windows)}
+                zscores[sel] = self._robust_z(stage, d[-sel.size:])
+                continue
+            zscores[sel] = [self._score(stage, c) for c in covs[sel]]
+        return zscores
+
+    def _robust_z(self, stage, d):
+        """z-score log-distances with the median/MAD of the stage's recent ones."""
+        dists = np.fromiter(self._refs[stage]['dists'], dtype=np.float64)
+        median = np.median(dists)
+        mad = mad_scale * np.median(np.abs(dists - median))
+        if mad == 0:
+            return np.full(np.shape(d), np.nan)
+        return (d - median) / mad
+
+    def _score(self, stage, cov):
+        """z-score one window and update the running reference if it is clean."""
+        ref = self._refs[stage]
+        d = np.log(_riemann_distance(cov[np.newaxis], ref['mean'])[0])
+        z = self._robust_z(stage, d)
+        # every window enters the median/MAD (they resist the outliers), only
+        # clean windows move the running Riemannian mean
+        ref['dists'].append(d)
+        if z < self.threshold:
+            ref['n'] += 1
+            ref['mean'] = _riemann_geodesic(ref['mean'], cov, 1. / ref['n'])
+        return z
+
+    def finish(self):
+        """Return (artifact per window, z-score per window) as yasa.art_detect."""
+        from pyriemann.estimation import Shrinkage
+
+        if not self._covs:
+            raise ValueError('no complete window was given')
+        covs = np.concatenate(self._covs)
+        isflat = np.concatenate(self._flat)
+        # drop channels that are flat over the whole recording
+        keep = self._ch_max != self._ch_min
+        if not keep.all():
+            print('Flat channel(s) were found and removed in data.')
+            covs = covs[:, keep][:, :, keep]
+            isflat = isflat[:, keep]
+        if keep.sum() < 4:
+            raise ValueError('covariance artifact detection needs at least 4 channels')
+        covs = Shrinkage(self.shrinkage).fit_transform(covs)
+
+        n_windows = len(covs)
+        stages = self._stages(np.arange(n_windows), isflat)
+        epoch_is_art = np.zeros(n_windows, dtype=int)
+        zscores = np.full(n_windows, np.nan)
+        potato = self._potato()
+        for stage in self.include:
+            where_stage = np.nonzero(stages == stage)[0]
+            if where_stage.size < min_windows:
+                continue
+            zscores[where_stage] = potato.fit_transform(covs[where_stage])
+            epoch_is_art[where_stage] = potato.predict(covs[where_stage]).astype(int)
+        epoch_is_art[stages == flat_stage] = 1
+        return epoch_is_art.astype(bool), zscores
+
+
+def stream_art_detect(raw, window=5, hypno=None, include=(1, 2, 3, 4),
+                      threshold=3, block_sec=600., callback=None):
+    """yasa.art_detect(raw, method='covar') reading raw one block at a time.
+
+    callback, if given, is called with (window indices, provisional
+    z-scores) after each block. Returns the artifact vector and z-scores.
+    """
+    detector = StreamingArtifactDetector(raw.info['sfreq'], window, hypno,
+                                         include, threshold)
+    for block in raw_blocks(raw, block_sec):
+        idx, zscores = detector.update(block)
+        if callback is not None:
+            callback(idx, zscores)
+    return detector.finish()
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 23:58:12 2026
+
+@author: Hayley B. Caldwell
+
+DNap Relationship (Sigma): Multichannel SO-Spindle Coupling
+
+yasa.sw_detect(coupling=True) filters the sigma band and runs two
+Hilbert transforms per channel, one channel after the other. Here the
+slow waves of all channels are detected without coupling, and the
+coupling is added afterwards in one batched pass: the sigma band of all
+channels is filtered at once, the slow oscillation phase and the sigma
+amplitude come from one FFT over all channels, and the epochs around
+every negative peak are indexed at once per channel. Filtering and FFTs
+run over n_jobs channels in parallel.
+
+The SigmaPeak, PhaseAtSigmaPeak and ndPAC columns are the ones yasa
+computes with coupling=True (same filters, same FFT length), so the
+result is the same as running yasa on every channel.
+"""
+
+import numpy as np
+
+# yasa coupling defaults: sigma band, +/- time around the negative peak
+# (s) and p threshold of the ndPAC
+freq_sp = (12, 16)
+coupling_time = 1.
+coupling_p = 0.05
+
+
+def analytic_signal(x, n_jobs=1):
+    """scipy.signal.hilbert(x, N=next_fast_len) along the last axis.
+
+    All rows are transformed in one FFT call, n_jobs rows at a time.
+    """
+    from scipy import fft
+
+    n = x.shape[-1]
+    nfast = fft.next_fast_len(n)
+    xf = fft.fft(x, nfast, axis=-1, workers=n_jobs)
+    h = np.zeros(nfast)
+    if nfast % 2 == 0:
+        h[0] = h[nfast // 2] = 1
+        h[1:nfast // 2] = 2
+    else:
+        h[0] = 1
+        h[1:(nfast + 1) // 2] = 2
+    xf *= h
+    return fft.ifft(xf, axis=-1, workers=n_jobs)[..., :n]
+
+
+def norm_direct_pac(pha, amp, p=coupling_p):
+    """ndPAC of each row of (events, times) phase and amplitude epochs.
+
+    Same as yasa (Ozkurt et al. 2012): values that are not significant at
+    p are set to 0.
+    """
+    from scipy.special import erfinv
+
+    n_times = amp.shape[-1]
+    amp = amp - amp.mean(axis=-1, keepdims=True)
+    amp = amp / amp.std(ddof=1, axis=-1, keepdims=True)
+    pac = np.abs(np.einsum('ej,ej->e', amp, np.exp(1j * pha)))
+    if p is None or p == 1.:
+        return pac / n_times
+    s = pac ** 2
+    pac /= n_times
+    pac[s <= 2 * n_times * erfinv(1 - p) ** 2] = 0.
+    return pac
+
+
+def event_coupling(pha, amp, neg_peaks, sf, time=coupling_time, p=coupling_p):
+    """SigmaPeak, PhaseAtSigmaPeak and ndPAC of slow waves of one channel.
+
+    pha and amp are the slow oscillation phase and sigma amplitude of the
+    channel, neg_peaks the sample of each negative peak. Slow waves whose
+    epoch does not fit in the data get NaN.
+    """
+    n_before = n_after = int(sf * time)
+    idx = neg_peaks[:, None] + np.arange(-n_before, n_after + 1)
+    valid = np.flatnonzero((idx[:, 0] >= 0) & (idx[:, -1] < len(pha)))
+    idx = idx[valid]
+    pha_ev, amp_ev = pha[idx], amp[idx]
+
+    sigma_peak = np.full(len(neg_peaks), np.nan)
+    phase = np.full(len(neg_peaks), np.nan)
+    ndpac = np.full(len(neg_peaks), np.nan)
+    idx_max = amp_ev.argmax(axis=1)
+    sigma_peak[valid] = neg_peaks[valid] / sf + (idx_max - n_before) / sf
+    phase[valid] = np.take_along_axis(pha_ev, idx_max[:, None], axis=1)[:, 0]
+    ndpac[valid] = norm_direct_pac(pha_ev, amp_ev, p)
+    return sigma_peak, phase, ndpac
+
+
+def add_coupling(sw, n_jobs=1, freq_sp=freq_sp, time=coupling_time,
+                 p=coupling_p):
+    """yasa SWResults of sw_detect(coupling=False) with the coupling added.
+
+    Returns a new SWResults whose events have the SigmaPeak,
+    PhaseAtSigmaPeak and ndPAC columns for every channel.
+    """
+    import yasa
+    from mne.filter import filter_data
+
+    events = sw.summary().copy()
+    sf = sw._sf
+    chan_idx = np.unique(events['IdxChannel'])
+    # only the channels with slow waves; yasa skips the others
+    data_sp = filter_data(sw._data[chan_idx], sf, freq_sp[0], freq_sp[1],
+                          method='fir', l_trans_bandwidth=1.5,
+                          h_trans_bandwidth=1.5, n_jobs=n_jobs, verbose=False)
+    amp = np.abs(analytic_signal(data_sp, n_jobs))
+    del data_sp
+    pha = np.angle(analytic_signal(sw._data_filt[chan_idx], n_jobs))
+
+    columns = {c: np.full(len(events), np.nan)
+               for c in ('SigmaPeak', 'PhaseAtSigmaPeak', 'ndPAC')}
+    for row, i in enumerate(chan_idx):
+        sel = np.flatnonzero(events['IdxChannel'].to_numpy() == i)
+        neg_peaks = np.rint(events['NegPeak'].to_numpy()[sel] * sf).astype(int)
+        for c, values in zip(columns, event_coupling(pha[row], amp[row],
+                                                     neg_peaks, sf, time, p)):
+            columns[c][sel] = values
+    # same column order as yasa.sw_detect(coupling=True)
+    at = events.columns.get_loc('Frequency') + 1
+    for n, (c, values) in enumerate(columns.items()):
+        events.insert(at + n, c, values)
+    return yasa.SWResults(events=events, data=sw._data, sf=sf,
+                          ch_names=sw._ch_names, hypno=sw._hypno,
+                          data_filt=sw._data_filt)
+
+
+def coupling_topography(events):
+    """Per channel coupling strength over all slow waves.
+
+    Returns a dataframe indexed by channel with the number of slow waves,
+    the circular mean phase at the sigma peak, its vector length and the
+    mean ndPAC.
+    """
+    import pandas as pd
+
+    rows = {}
+    for ch, ev in events.groupby('Channel', sort=False):
+        phase = ev['PhaseAtSigmaPeak'].dropna().to_numpy()
+        vector = np.exp(1j * phase).mean() if len(phase) else np.nan
+        rows[ch] = {'Count': len(ev),
+                    'CircMean': np.angle(vector),
+                    'VectorLength': np.abs(vector),
+                    'ndPAC': ev['ndPAC'].mean()}
+    return pd.DataFrame.from_dict(rows, orient='index')
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 23:41:18 2026
+
+@author: Hayley B. Caldwell
+
+DNap Relationship (Sigma): Event Tables
+
+04 keeps every detected spindle, slow wave and coupled slow wave, not
+only the per-subject medians, so the cohort can be summarised again
+(mean instead of median, another grouping, density per clean minute)
+without running the detections on the naps again.
+
+Each subject's events are one compressed .npz file with one array per
+column; text columns (Channel) are stored as integer codes plus their
+names. Event times are in seconds from the start of the recording. The
+file also holds the artifact-free minutes of each stage, for densities.
+
+    python dnap_events.py D:\\DNap\\EEG\\processed\\events --kind spindles --aggfunc mean
+"""
+
+import os.path as op
+import glob
+
+import numpy as np
+
+# event kinds written by 04, as <subj>_<kind>.npz in the events folder
+event_kinds = ('spindles', 'slow_waves', 'coupling')
+
+# columns that identify an event rather than describe it
+key_columns = ['subj', 'Stage', 'Channel', 'IdxChannel']
+
+
+def events_fname(subj, kind, events_dir='events'):
+    return op.join(events_dir, '%s_%s.npz' % (subj, kind))
+
+
+def clean_minutes(hypno, sf):
+    """{stage: minutes} of a per-sample hypnogram (artifacts marked -1)."""
+    stages, counts = np.unique(np.asarray(hypno), return_counts=True)
+    return {int(s): c / (60. * sf) for s, c in zip(stages, counts) if s >= 0}
+
+
+def save_events(events, fname, subj, minutes):
+    """Write a yasa event summary (one row per event) to a column file."""
+    arrays = {'subj': np.array(subj),
+              'minutes_stage': np.array(sorted(minutes), dtype=np.int64),
+              'minutes': np.array([minutes[s] for s in sorted(minutes)])}
+    for column in events:
+        values = events[column].to_numpy()
+        if values.dtype.kind in 'biuf':
+            arrays['col:' + column] = values
+        else:
+            names, codes = np.unique(values.astype(str), return_inverse=True)
+            arrays['col:' + column] = codes.astype(np.int16)
+            arrays['names:' + column] = names
+    np.savez_compressed(fname, **arrays)
+    return fname
+
+
+def load_events(fname):
+    """(events dataframe, {stage: minutes}) of one event file."""
+    import pandas as pd
+    with np.load(fname, allow_pickle=False) as f:
+        columns = {}
+        for key in f.files:
+            if not key.startswith('col:'):
+                continue
+            column = key[4:]
+            if 'names:' + column in f.files:
+                columns[column] = pd.Categorical.from_codes(
+                    f[key], f['names:' + column])
+            else:
+                columns[column] = f[key]
+        subj = str(f['subj'])
+        minutes = dict(zip(f['minutes_stage'].tolist(), f['minutes'].tolist()))
+    events = pd.DataFrame(columns)
+    events.insert(0, 'subj', subj)
+    return events, minutes
+
+
+def read_events(files):
+    """Events of many subjects in one dataframe, and the minutes table.
+
+    The minutes table has one row per subject and one column per stage.
+    """
+    import pandas as pd
+    frames, minutes = [], {}
+    for fname in files:
+        events, m = load_events(fname)
+        frames.append(events)
+        minutes[events['subj'].iloc[0] if len(events) else
+                op.basename(fname).split('_')[0]] = m
+    events = pd.concat(frames, ignore_index=True)
+    for column in ('subj', 'Channel'):
+        if column in events:
+            events[column] = events[column].astype('category')
+    return events, pd.DataFrame.from_dict(minutes, orient='index').fillna(0.)
+
+
+def feature_columns(events):
+    from dnap_stages import time_columns
+    return [c for c in events.columns
+            if c not in key_columns and c not in time_columns
+            and events[c].dtype.kind in 'biuf']
+
+
+def summarise(events, minutes=None, by=('subj', 'Stage', 'Channel'),
+              aggfunc='median'):
+    """Aggregate the event features per group, with Count and Density.
+
+    Matches yasa's summary(grp_chan=True, grp_stage=True) per subject,
+    including the circular mean of PhaseAtSigmaPeak whatever aggfunc.
+    Density is the count per artifact-free minute of the stage, or of
+    all the stages in the table when not grouping by stage; it needs
+    the minutes table and 'subj' in by.
+    """
+    by = list(by)
+    grouped = events.groupby(by, observed=True, sort=True)
+    aggdict = {c: aggfunc for c in feature_columns(events)}
+    if 'PhaseAtSigmaPeak' in aggdict:
+        from scipy.stats import circmean
+        aggdict['PhaseAtSigmaPeak'] = lambda x: circmean(
+            x, low=-np.pi, high=np.pi, nan_policy='omit')
+    out = grouped.agg(aggdict)
+    out.insert(0, 'Count', grouped.size())
+    if minutes is not None and 'subj' in by:
+        index = out.index.to_frame(index=False)
+        if 'Stage' in by:
+            stage_minutes = minutes.stack()
+            keys = list(zip(index['subj'], index['Stage']))
+            dur = stage_minutes.reindex(keys).to_numpy()
+        else:
+            stages = np.unique(events['Stage'])
+            dur = minutes.reindex(columns=stages).sum(axis=1)
+            dur = dur.reindex(index['subj']).to_numpy()
+        out.insert(1, 'Density', out['Count'].to_numpy() / dur)
+    return out
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('events_dir', help='events folder written by 04')
+    parser.add_argument('--kind', default='spindles', choices=event_kinds)
+    parser.add_argument('--by', nargs='+', default=['subj', 'Stage', 'Channel'],
+                        help='columns to group by')
+    parser.add_argument('--aggfunc', default='median')
+    parser.add_argument('--out', help='csv file (default <kind>_<aggfunc>.csv)')
+    args = parser.parse_args()
+
+    files = sorted(glob.glob(op.join(args.events_dir, '*_%s.npz' % args.kind)))
+    events, minutes = read_events(files)
+    out = summarise(events, minutes, args.by, args.aggfunc).round(3)
+    outfile = args.out or '%s_%s.csv' % (args.kind, args.aggfunc)
+    out.to_csv(outfile)
+    print('%d events of %d subjects summarised to %s'
+          % (len(events), len(files), outfile))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 23:05:31 2026
+
+@author: Hayley B. Caldwell
+
+DNap Relationship (Sigma): Item Epoch Index
+
+event_id_ret and event_id_res in 01 map each word x presentation item
+('edge_1', 'edge_2', ...) to its trigger code. item_lookup turns such a
+map into arrays indexed by trigger code, so the items of a whole event
+array are found with one lookup instead of a loop over the triggers.
+
+01 saves the item-locked epochs of a recording with the item metadata.
+ItemIndex holds their data sorted by phase, presentation and word; a
+query such as all presentation-3 items then selects a run of consecutive
+epochs and returns a view of the data, not a copy.
+"""
+
+import os.path as op
+import re
+
+import numpy as np
+
+# file name ending of the item epochs written by 01
+items_suffix = '_items_epo.fif.gz'
+
+# metadata columns of the item epochs
+item_columns = ['word', 'word_id', 'presentation', 'phase', 'code', 'sample',
+                'onset']
+
+
+def stimulus_code(description):
+    """Trigger code of a BrainVision 'Stimulus/S 10' annotation, else None.
+
+    Use as event_id of mne.events_from_annotations: its default parser
+    only reads the codes while the raw is still a RawBrainVision, and
+    numbers them 1..N once the raw has been saved and read back with
+    boundary annotations.
+    """
+    match = re.match(r'^Stimulus/S\s*(\d+)$', description)
+    return int(match.group(1)) if match else None
+
+
+def split_item(name):
+    """('edge', 1) for 'edge_1'; None for names that are not items."""
+    word, _, presentation = name.rpartition('_')
+    if not word or not presentation.isdigit():
+        return None
+    return word, int(presentation)
+
+
+def item_lookup(event_id):
+    """Words of an event map and trigger code -> word index / presentation.
+
+    Returns (words, word_of_code, presentation_of_code); codes that are
+    not items have word index -1. Words are numbered in the order of
+    their first presentation.
+    """
+    items = []
+    for name, code in event_id.items():
+        item = split_item(name)
+        if item is not None:
+            items.append((code,) + item)
+    first = {}
+    for code, word, presentation in sorted(items):
+        first.setdefault(word, (presentation, code))
+    words = sorted(first, key=first.get)
+    word_ids = {w: n for n, w in enumerate(words)}
+
+    n_codes = max(code for code, _, _ in items) + 1
+    word_of_code = np.full(n_codes, -1)
+    presentation_of_code = np.zeros(n_codes, dtype=int)
+    for code, word, presentation in items:
+        word_of_code[code] = word_ids[word]
+        presentation_of_code[code] = presentation
+    return words, word_of_code, presentation_of_code
+
+
+def item_events(events, event_id, phase, sfreq, first_samp=0):
+    """Item events of an mne events array and their metadata.
+
+    Returns the item events, in the order of events, and a dict of
+    metadata arrays (item_columns) with one value per item event. Codes
+    that are not in event_id (stray or unlisted triggers) are dropped
+    with a warning. Raises ValueError if the codes look renumbered
+    rather than read from the trigger descriptions: they are exactly
+    1..N and some are not in event_id.
+    """
+    words, word_of_code, presentation_of_code = item_lookup(event_id)
+    codes = events[:, 2]
+    present = np.unique(codes)
+    unknown = np.setdiff1d(present, list(event_id.values()))
+    if len(unknown):
+        if (present == np.arange(1, len(present) + 1)).all():
+            raise ValueError('trigger codes are 1..%d, they were renumbered '
+                             'instead of read from the descriptions'
+                             % len(present))
+        print('WARNING: dropping %d events with trigger codes %s that are '
+              'not in the event map' % (np.isin(codes, unknown).sum(),
+                                        ', '.join(map(str, unknown))))
+    word_id = np.full(len(codes), -1)
+    known = (codes >= 0) & (codes < len(word_of_code))
+    word_id[known] = word_of_code[codes[known]]
+    keep = word_id >= 0
+
+    events = events[keep]
+    word_id = word_id[keep]
+    metadata = {'word': np.asarray(words, dtype=object)[word_id],
+                'word_id': word_id,
+                'presentation': presentation_of_code[events[:, 2]],
+                'phase': np.full(len(events), phase, dtype=object),
+                'code': events[:, 2],
+                'sample': events[:, 0],
+                'onset': (events[:, 0] - first_samp) / sfreq}
+    return events, metadata
+
+
+def as_view(data, pos):
+    """data[pos] as a view if pos is evenly spaced, else as a copy."""
+    pos = np.asarray(pos)
+    if len(pos) == 0:
+        return data[:0]
+    if len(pos) == 1:
+        return data[pos[0]:pos[0] + 1]
+    step = pos[1] - pos[0]
+    if step > 0 and (np.diff(pos) == step).all():
+        return data[pos[0]:pos[-1] + 1:step]
+    return data[pos]
+
+
+class ItemIndex:
+    """Item epochs of one recording with vectorized metadata lookups.
+
+    data is (epochs, channels, times) and metadata a dict of arrays with
+    one value per epoch; both are sorted by phase, presentation, word
+    and sample (one copy, unless they are sorted already). select returns
+    the positions of the epochs matching a query and get the matching
+    data, as a view when the epochs are consecutive (e.g. one
+    presentation) or evenly spaced (e.g. one word across complete
+    presentations).
+    """
+
+    def __init__(self, data, metadata, times=None, ch_names=None):
+        metadata = {k: np.asarray(v) for k, v in metadata.items()}
+        order = np.lexsort([metadata[k] for k in
+                            ('sample', 'word_id', 'presentation', 'phase')])
+        if (order != np.arange(len(order))).any():
+            data = data[order]
+            metadata = {k: v[order] for k, v in metadata.items()}
+        self.data = data
+        self.metadata = metadata
+        self.times = times
+        self.ch_names = ch_names
+
+    @classmethod
+    def from_epochs(cls, epochs):
+        data = epochs.get_data(copy=False)
+        metadata = {c: epochs.metadata[c].to_numpy() for c in epochs.metadata}
+        return cls(data, metadata, epochs.times, epochs.ch_names)
+
+    def __len__(self):
+        return len(self.data)
+
+    def select(self, **query):
+        """Positions of the epochs whose metadata match every query value.
+
+        A value may be a scalar or a list of accepted values, e.g.
+        select(presentation=3) or select(word=['edge', 'seat']).
+        """
+        mask = np.ones(len(self), dtype=bool)
+        for column, value in query.items():
+            values = self.metadata[column]
+            if np.ndim(value):
+                mask &= np.isin(values, value)
+            else:
+                mask &= values == value
+        return np.nonzero(mask)[0]
+
+    def get(self, **query):
+        """(data, metadata) of the epochs matching the query."""
+        pos = self.select(**query)
+        return (as_view(self.data, pos),
+                {k: v[pos] for k, v in self.metadata.items()})
+
+
+def read_items(fname):
+    """ItemIndex of an item epochs file saved by 01."""
+    import mne
+    return ItemIndex.from_epochs(mne.read_epochs(fname, preload=True,
+                                                 verbose=False))
+
+
+def read_item_files(files):
+    """{(s_number, condition): ItemIndex} of item epochs files of 01.
+
+    e.g. indexes[('07', 'ret')].get(presentation=3) for all
+    presentation-3 items of participant 07.
+    """
+    indexes = {}
+    for fname in files:
+        s_number, condition = op.basename(fname)[:-len(items_suffix)].split('_', 1)
+        indexes[s_number, condition] = read_items(fname)
+    return indexes
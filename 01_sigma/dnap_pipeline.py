@@ -0,0 +1,542 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 11:02:17 2026
+
+@author: Hayley B. Caldwell
+
+DNap Relationship (Sigma): Pipeline
+
+Wires the stage scripts into one dependency graph:
+
+    raw task EEG  -> preprocessed epochs (01) -> TFA power (03) -> stats (05)
+    raw rest EEG  -> IAF table (02) -----------------^
+    raw nap EEG   -> preprocessed nap (04) -> detections (04)
+
+A node is only re-run when the content of its input files, its parameters
+or the stage script itself changed since the last successful run, so
+changing e.g. a filter setting rebuilds only the artifacts downstream of it.
+Nodes whose inputs are ready run concurrently across cores.
+
+Run from the command line, e.g.
+
+    python dnap_pipeline.py --jobs 4 --param l_freq=0.5
+
+To run a grid of settings at once, see dnap_sweep.py.
+"""
+
+import os
+import os.path as op
+import sys
+import glob
+import json
+import hashlib
+import argparse
+import importlib.util
+import ast
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from dnap_profiling import RunReport
+from dnap_startup import setup_backend
+from dnap_events import event_kinds, events_fname
+
+here = op.dirname(op.abspath(__file__))
+
+stage_scripts = {'preproc': 'dnap_sigma_01_preproc.py',
+                 'iaf': 'dnap_sigma_02_iaf.py',
+                 'tfa': 'dnap_sigma_03_tfa.py',
+                 'sleep': 'dnap_sigma_04_sleep-group.py',
+                 'stats': 'dnap_sigma_05_stats.py'}
+
+
+def load_stage(script):
+    """Import one of the stage scripts by file name.
+
+    The scripts are not valid module names (04 has a hyphen), so they are
+    loaded from their path and registered under a sanitised name.
+    """
+    if here not in sys.path:
+        sys.path.insert(0, here)
+    name = op.splitext(script)[0].replace('-', '_')
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.spec_from_file_location(name, op.join(here, script))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+# function arguments that change how a node runs, not what it computes;
+# they are left out of the node hash
+runtime_kwargs = ('n_jobs',)
+
+# local modules that build and run the graph rather than compute results;
+# editing them does not make the outputs of a stage stale
+driver_modules = ('dnap_pipeline.py', 'dnap_sweep.py')
+
+
+def local_imports(script):
+    """Local modules (dnap_*.py next to the stages) a script imports.
+
+    Follows the imports of those modules too, so the result is every
+    local file whose code a stage can run (except driver_modules). Found
+    by parsing the source, without importing anything.
+    """
+    found, todo = set(), [script]
+    while todo:
+        with open(op.join(here, todo.pop()), 'rb') as fid:
+            tree = ast.parse(fid.read())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.level == 0:
+                names = [node.module]
+            else:
+                continue
+            for name in names:
+                fname = name.split('.')[0] + '.py'
+                if (fname != script and fname not in found
+                        and fname not in driver_modules
+                        and op.isfile(op.join(here, fname))):
+                    found.add(fname)
+                    todo.append(fname)
+    return sorted(found)
+
+
+def run_task(script, func, kwargs, report_file=None):
+    """Call ``func`` of a stage script; used in the worker processes."""
+    # spawned workers do not run main, so pick the plot backend here too
+    setup_backend()
+    if script is None:
+        func = globals()[func]
+    else:
+        func = getattr(load_stage(script), func)
+    if report_file is None:
+        return func(**kwargs)
+    report = RunReport(op.basename(report_file))
+    try:
+        return func(report=report, **kwargs)
+    finally:
+        report.write(report_file)
+
+
+def concat_csv(files, outfile):
+    """Join csv files with identical headers into one file."""
+    with open(outfile, 'w') as out:
+        for n, fname in enumerate(files):
+            with open(fname) as fid:
+                header = fid.readline()
+                if n == 0:
+                    out.write(header)
+                for line in fid:
+                    out.write(line)
+    return outfile
+
+
+def brainvision_files(vhdr):
+    """Return the header, marker and data file of a BrainVision recording."""
+    base = op.splitext(vhdr)[0]
+    return [fname for fname in (vhdr, base + '.vmrk', base + '.eeg')
+            if op.exists(fname)]
+
+
+class Node:
+    """One step of the pipeline: a stage function and its files."""
+
+    def __init__(self, name, script, func, kwargs=None, inputs=(),
+                 outputs=(), deps=(), report_file=None):
+        self.name = name
+        self.script = script
+        self.func = func
+        self.kwargs = kwargs or {}
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.deps = list(deps)
+        self.report_file = report_file
+
+
+class Pipeline:
+    """Dependency graph of nodes with hash-based change detection.
+
+    The hash of each node combines the stage script and the local modules
+    it imports, the function and its parameters (except runtime_kwargs)
+    and the content of its input files. Hashes of the last
+    successful run are kept in ``manifest_file``; file content hashes are
+    cached by size and modification time so large raw files are only read
+    again when they change.
+    """
+
+    def __init__(self, manifest_file):
+        self.manifest_file = manifest_file
+        self.nodes = {}
+        self.imports = {}
+        if op.exists(manifest_file):
+            with open(manifest_file) as fid:
+                self.manifest = json.load(fid)
+        else:
+            self.manifest = {'files': {}, 'nodes': {}}
+
+    def add(self, name, script, func, kwargs=None, inputs=(), outputs=(),
+            deps=(), report_file=None):
+        if name in self.nodes:
+            raise ValueError('node %s was added twice' % name)
+        node = Node(name, script, func, kwargs, inputs, outputs, deps,
+                    report_file)
+        self.nodes[name] = node
+        return node
+
+    def file_hash(self, fname):
+        stat = os.stat(fname)
+        cached = self.manifest['files'].get(op.abspath(fname))
+        if cached is not None and cached[:2] == [stat.st_size, stat.st_mtime]:
+            return cached[2]
+        sha = hashlib.sha1()
+        with open(fname, 'rb') as fid:
+            for chunk in iter(lambda: fid.read(2 ** 20), b''):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+        self.manifest['files'][op.abspath(fname)] = [stat.st_size,
+                                                     stat.st_mtime, digest]
+        return digest
+
+    def code_hash(self, script):
+        """Hashes of a stage script and of the local modules it imports."""
+        if script not in self.imports:
+            self.imports[script] = local_imports(script)
+        return {fname: self.file_hash(op.join(here, fname))
+                for fname in [script] + self.imports[script]}
+
+    def node_hash(self, node):
+        script = None
+        if node.script is not None:
+            script = self.code_hash(node.script)
+        state = {'script': script,
+                 'func': node.func,
+                 'kwargs': {k: v for k, v in node.kwargs.items()
+                            if k not in runtime_kwargs},
+                 'inputs': sorted((op.abspath(i), self.file_hash(i))
+                                  for i in node.inputs)}
+        blob = json.dumps(state, sort_keys=True, default=str)
+        return hashlib.sha1(blob.encode()).hexdigest()
+
+    def is_fresh(self, node, key):
+        return (self.manifest['nodes'].get(node.name) == key and
+                all(op.exists(o) for o in node.outputs))
+
+    def save_manifest(self):
+        tmp = self.manifest_file + '.tmp'
+        with open(tmp, 'w') as fid:
+            json.dump(self.manifest, fid, indent=1)
+        os.replace(tmp, self.manifest_file)
+
+    def check(self):
+        """Raise if a node depends on a missing node or on itself."""
+        for node in self.nodes.values():
+            for d in node.deps:
+                if d not in self.nodes:
+                    raise ValueError('%s depends on unknown node %s'
+                                     % (node.name, d))
+        visiting, visited = set(), set()
+
+        def visit(name):
+            if name in visited:
+                return
+            if name in visiting:
+                raise ValueError('dependency cycle through %s' % name)
+            visiting.add(name)
+            for d in self.nodes[name].deps:
+                visit(d)
+            visiting.discard(name)
+            visited.add(name)
+
+        for name in self.nodes:
+            visit(name)
+
+    def run(self, n_jobs=1, force=False, dry_run=False):
+        """Run all stale nodes, in dependency order.
+
+        Returns a dict mapping node name to 'skipped', 'done', 'failed' or
+        'blocked' (an upstream node failed).
+        """
+        self.check()
+        status = {}
+        pending = dict(self.nodes)
+        running = {}
+        executor = ProcessPoolExecutor(n_jobs) if n_jobs > 1 and not dry_run else None
+        try:
+            while pending or running:
+                for name, node in list(pending.items()):
+                    dep_status = [status.get(d) for d in node.deps]
+                    if any(s is None for s in dep_status):
+                        continue
+                    del pending[name]
+                    if any(s in ('failed', 'blocked') for s in dep_status):
+                        status[name] = 'blocked'
+                        print('blocked ' + name)
+                        continue
+                    if dry_run and any(s == 'done' for s in dep_status):
+                        # inputs would change, so this node would rebuild too
+                        status[name] = 'done'
+                        print('would run ' + name)
+                        continue
+                    key = self.node_hash(node)
+                    if not force and self.is_fresh(node, key):
+                        status[name] = 'skipped'
+                        continue
+                    if dry_run:
+                        status[name] = 'done'
+                        print('would run ' + name)
+                        continue
+                    print('running ' + name)
+                    args = (node.script, node.func, node.kwargs, node.report_file)
+                    if executor is None:
+                        self._finish(name, key, status, _Result(run_task, args))
+                    else:
+                        running[executor.submit(run_task, *args)] = (name, key)
+                if not running:
+                    continue
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name, key = running.pop(future)
+                    self._finish(name, key, status, future)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+            self.save_manifest()
+        return status
+
+    def _finish(self, name, key, status, future):
+        try:
+            future.result()
+        except Exception as err:
+            status[name] = 'failed'
+            # forget the old hash so the node is retried on the next run
+            self.manifest['nodes'].pop(name, None)
+            print('failed %s: %r' % (name, err))
+            return
+        status[name] = 'done'
+        self.manifest['nodes'][name] = key
+        print('finished ' + name)
+
+
+class _Result:
+    """Run a function now and expose it like a finished future."""
+
+    def __init__(self, func, args):
+        self.error = None
+        try:
+            self.value = func(*args)
+        except Exception as err:
+            self.error = err
+
+    def result(self):
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+def build_pipeline(params=None, manifest_file=None, n_jobs=1):
+    """Build the graph of all stages from the files on disk.
+
+    ``params`` overrides stage settings: l_freq, h_freq, sfreq and duration
+    for the task pre-processing, iaf_fmin and iaf_fmax for the IAF,
+    estimator for the TFA, nap_l_freq, nap_h_freq for the nap
+    pre-processing, precision ('double' or 'single') for the TFA and
+    the nap analyses and n_permutations for the group statistics.
+    ``n_jobs`` is passed to the steps that run in parallel themselves
+    (the IAF spectra).
+    """
+    params = params or {}
+    preproc = load_stage(stage_scripts['preproc'])
+    iaf = load_stage(stage_scripts['iaf'])
+    tfa = load_stage(stage_scripts['tfa'])
+    sleep = load_stage(stage_scripts['sleep'])
+    stats = load_stage(stage_scripts['stats'])
+
+    eeg_dir = preproc.data_dir
+    processed_dir = op.join(eeg_dir, 'sigma', 'processed')
+    report_dir = op.join(eeg_dir, 'sigma', 'reports')
+    power_dir = op.join(processed_dir, 'power')
+    nap_dir = sleep.processed_dir
+    if manifest_file is None:
+        manifest_file = op.join(eeg_dir, 'sigma', 'pipeline_manifest.json')
+    pipe = Pipeline(manifest_file)
+
+    # raw task EEG -> preprocessed epochs
+    epoch_nodes = {}
+    for f in sorted(glob.glob(op.join(eeg_dir, preproc.raw_pattern))):
+        s_number, condition = preproc.parse_fname(f)
+        inputs = brainvision_files(f)
+        paste = preproc.files_to_paste.get(op.basename(f))
+        if paste is not None:
+            inputs += brainvision_files(op.join(eeg_dir, paste))
+        epo = preproc.processed_fname(f, processed_dir)
+        outputs = [epo]
+        if preproc.save_item_epochs:
+            outputs.append(preproc.items_fname(f, processed_dir))
+        name = 'preproc:%s_%s' % (s_number, condition)
+        pipe.add(name, stage_scripts['preproc'], 'preprocess_file',
+                 dict(f=f, out_dir=processed_dir,
+                      l_freq=params.get('l_freq', preproc.l_freq),
+                      h_freq=params.get('h_freq', preproc.h_freq),
+                      sfreq=params.get('sfreq', preproc.resample_sfreq),
+                      duration=params.get('duration', preproc.epoch_duration)),
+                 inputs=inputs, outputs=outputs,
+                 report_file=op.join(report_dir, name.replace(':', '_')))
+        epoch_nodes[epo] = name
+
+    # raw resting EEG -> IAF table
+    iaf_files = sorted(glob.glob(op.join(eeg_dir, iaf.iaf_pattern)))
+    iaf_table = op.join(processed_dir, 'iaf_long.txt')
+    pipe.add('iaf', stage_scripts['iaf'], 'compute_iaf',
+             dict(iaf_files=iaf_files, outfile=iaf_table,
+                  fmin=params.get('iaf_fmin', iaf.iaf_fmin),
+                  fmax=params.get('iaf_fmax', iaf.iaf_fmax), n_jobs=n_jobs),
+             inputs=[i for f in iaf_files for i in brainvision_files(f)],
+             outputs=[iaf_table],
+             report_file=op.join(report_dir, 'iaf'))
+
+    # preprocessed epochs + IAF -> TFA power
+    power_files = []
+    for epo, dep in sorted(epoch_nodes.items()):
+        s_no, a = op.basename(epo).split('_')[:2]
+        outputs = [tfa.power_fname(s_no, a, b, power_dir) for b in tfa.bands]
+        name = 'tfa:%s_%s' % (s_no, a)
+        pipe.add(name, stage_scripts['tfa'], 'tfa_file',
+                 dict(e=epo, iaf_info_means=iaf_table, bands=tfa.bands,
+                      windows=tfa.windows, power_dir=power_dir,
+                      estimator=params.get('estimator', tfa.estimator),
+                      precision=params.get('precision', tfa.precision)),
+                 inputs=[epo, iaf_table], outputs=outputs, deps=[dep, 'iaf'],
+                 report_file=op.join(report_dir, name.replace(':', '_')))
+        power_files += outputs
+    sigma_power = op.join(processed_dir, 'sigma_power.csv')
+    pipe.add('tfa:gather', None, 'concat_csv',
+             dict(files=power_files, outfile=sigma_power),
+             inputs=power_files, outputs=[sigma_power],
+             deps=[n for n in pipe.nodes if n.startswith('tfa:')])
+
+    # TFA power -> group cluster statistics
+    stats_dir = op.join(processed_dir, stats.stats_dir)
+    name = op.join(stats_dir, '%s_vs_%s' % stats.conditions)
+    pipe.add('stats', stage_scripts['stats'], 'group_stats',
+             dict(power_file=sigma_power, out_dir=stats_dir,
+                  n_perm=int(params.get('n_permutations', stats.n_permutations))),
+             inputs=[sigma_power],
+             outputs=[name + '_channels.csv', name + '_clusters.csv'],
+             deps=['tfa:gather'], report_file=op.join(report_dir, 'stats'))
+
+    # raw nap EEG -> preprocessed nap -> detections
+    results = {'spindles': [], 'slow_waves': [], 'power': [], 'coupling': [],
+               'coupling_chan': []}
+    for s in sorted(glob.glob(op.join(sleep.raw_dir, sleep.sleep_pattern))):
+        subj = op.split(s)[1][0:2]
+        nap = sleep.nap_fname(subj, nap_dir)
+        pipe.add('nap:' + subj, stage_scripts['sleep'], 'preprocess_nap',
+                 dict(s=s, outfile=nap,
+                      l_freq=params.get('nap_l_freq', sleep.l_freq),
+                      h_freq=params.get('nap_h_freq', sleep.h_freq)),
+                 inputs=brainvision_files(s), outputs=[nap],
+                 report_file=op.join(report_dir, 'nap_' + subj))
+
+        hypno_file = op.join(nap_dir, subj + '_hyp.csv')
+        if not op.exists(hypno_file):
+            print('no hypnogram for participant ' + subj + ', skipping detection')
+            continue
+        outputs = {'spindles': op.join(nap_dir, 'spindle', subj + '_spindle.csv'),
+                   'slow_waves': op.join(nap_dir, 'so', subj + '_so.csv'),
+                   'power': op.join(nap_dir, 'power', subj + '_power.csv'),
+                   'coupling': op.join(nap_dir, 'coupling', subj + '_coupling.csv'),
+                   'coupling_chan': op.join(nap_dir, 'coupling',
+                                            subj + '_coupling_chan.csv')}
+        events = [events_fname(subj, kind, op.join(nap_dir, 'events'))
+                  for kind in event_kinds]
+        pipe.add('detect:' + subj, stage_scripts['sleep'], 'analyse_nap',
+                 dict(a=nap, hypno_file=hypno_file, out_dir=nap_dir,
+                      precision=params.get('precision', sleep.precision)),
+                 inputs=[nap, hypno_file],
+                 outputs=list(outputs.values()) + events,
+                 deps=['nap:' + subj],
+                 report_file=op.join(report_dir, 'detect_' + subj))
+        for key in results:
+            results[key].append(outputs[key])
+
+    detect_nodes = [n for n in pipe.nodes if n.startswith('detect:')]
+    for key, files in results.items():
+        outfile = op.join(nap_dir, key + '.csv')
+        pipe.add('detect:gather_' + key, None, 'concat_csv',
+                 dict(files=files, outfile=outfile),
+                 inputs=files, outputs=[outfile], deps=detect_nodes)
+
+    return pipe
+
+
+def make_folders():
+    """Create the output folders the stages write to."""
+    preproc = load_stage(stage_scripts['preproc'])
+    sleep = load_stage(stage_scripts['sleep'])
+    folders = [op.join(preproc.data_dir, l) for l in preproc.folder_list]
+    folders += [op.join(preproc.data_dir, 'sigma', 'processed', 'power')]
+    folders += [op.join(sleep.processed_dir, l) for l in sleep.folder_list]
+    for l in folders:
+        if not os.path.exists(l):
+            os.makedirs(l)
+
+
+def parse_value(value):
+    """None, int, float or str of a command line value.
+
+    Integers stay int so that e.g. 30 gets the same node hash as the
+    default setting 30 and shares its outputs.
+    """
+    if value.lower() == 'none':
+        return None
+    for parse in (int, float):
+        try:
+            return parse(value)
+        except ValueError:
+            pass
+    return value
+
+
+def parse_params(items):
+    params = {}
+    for item in items:
+        key, value = item.split('=', 1)
+        params[key] = parse_value(value)
+    return params
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1,
+                        help='number of nodes to run at the same time')
+    parser.add_argument('--force', action='store_true',
+                        help='re-run every node regardless of hashes')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only list the nodes that would run')
+    parser.add_argument('--param', action='append', default=[],
+                        help='override a stage setting, e.g. l_freq=0.5 '
+                             'or estimator=welch')
+    args = parser.parse_args()
+
+    # plots go to a window in IPython and straight to file in batch runs
+    setup_backend()
+
+    make_folders()
+    pipe = build_pipeline(parse_params(args.param), n_jobs=args.jobs)
+    # the stage functions write their plots relative to the EEG folder
+    os.chdir(load_stage(stage_scripts['preproc']).data_dir)
+    status = pipe.run(n_jobs=args.jobs, force=args.force, dry_run=args.dry_run)
+
+    counts = {}
+    for s in status.values():
+        counts[s] = counts.get(s, 0) + 1
+    print(', '.join('%d %s' % (n, s) for s, n in sorted(counts.items())))
+    if 'failed' in counts:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 17:02:11 2026
+
+@author: Hayley B. Caldwell
+
+DNap Relationship (Sigma): Compute Precision
+
+The epochs and naps are saved in single precision already, so the analyses
+can also run on float32 arrays. This is not end-to-end: pre-processing
+(01) stays in float64. In 03 the epochs are read straight into a float32
+array (half the input memory) and the wavelet and spectral steps compute
+in float32. In 04 the nap is read straight into float32 as well, but
+yasa and tensorpac upcast to float64 for the band power, detections and
+PAC, so there the mode saves memory, not time. 'double' is the reference
+path and stays the default.
+
+Accuracy of the single precision path, as the largest absolute difference
+to the double path divided by the largest absolute double value. Each
+entry is checked against the double path when validating (03 --validate,
+validate_precision in 04):
+
+    data       1e-6   epochs/nap cast to float32 (03, 04)
+    window     1e-4   window means of Morlet/Welch/multitaper power (03)
+    bandpower  1e-4   yasa band power per sleep stage (04)
+    detection  1e-4   spindle and slow wave medians per stage/channel (04)
+
+The detections run on the float32-rounded nap, so an event right at a
+threshold can be found in one mode only; the detection check then fails
+on the counts. Check a recording before switching a study over.
+"""
+
+import numpy as np
+
+# 'double' (float64, reference) or 'single' (float32)
+precision = 'double'
+
+dtypes = {'double': np.float64, 'single': np.float32}
+complex_dtypes = {'double': np.complex128, 'single': np.complex64}
+
+# largest error allowed relative to the double precision result
+tolerances = {'data': 1e-6,
+              'window': 1e-4,
+              'bandpower': 1e-4,
+              'detection': 1e-4}
+
+
+def compute_dtype(precision=precision):
+    if precision not in dtypes:
+        raise ValueError("precision must be 'double' or 'single', got %r"
+                         % (precision,))
+    return dtypes[precision]
+
+
+def as_compute(x, precision=precision):
+    """Return x as an array of the compute dtype, without copying if it is."""
+    return np.asarray(x, dtype=compute_dtype(precision))
+
+
+def precision_of(x):
+    """'single' for float32/complex64 arrays, else 'double'."""
+    if np.asarray(x).dtype in (np.float32, np.complex64):
+        return 'single'
+    return 'double'
+
+
+def relative_error(ref, test):
+    """Largest absolute difference relative to the largest reference value."""
+    ref = np.asarray(ref, dtype=np.float64)
+    test = np.asarray(test, dtype=np.float64)
+    scale = np.max(np.abs(ref))
+    if scale == 0:
+        return float(np.max(np.abs(test)))
+    return float(np.max(np.abs(test - ref)) / scale)
+
+
+def check_tolerance(name, ref, test):
+    """Compare a single precision result with the double one.
+
+    Prints the relative error and returns True if it is within
+    tolerances[name].
+    """
+    err = relative_error(ref, test)
+    ok = err <= tolerances[name]
+    print('%-10s single vs double: relative error %.2e (tolerance %.0e) %s'
+          % (name, err, tolerances[name], 'ok' if ok else 'EXCEEDED'))
+    return ok
+
+
+def check_table(name, ref, test):
+    """check_tolerance on the numeric columns of two summary dataframes.
+
+    The tables must have the same rows (e.g. stage and channel groups);
+    otherwise the check fails without comparing values.
+    """
+    if not ref.index.equals(test.index):
+        print('%-10s single vs double: different rows EXCEEDED' % name)
+        return False
+    columns = ref.select_dtypes('number').columns
+    return check_tolerance(name, ref[columns], test[columns])
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 09:12:40 2026
+
+@author: Hayley B. Caldwell
+
+DNap Relationship (Sigma): Run Profiling
+
+Records wall time, CPU time, peak memory and disk traffic for each named
+processing step, per subject, and writes them out as a run report.
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+from contextlib import contextmanager
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def peak_rss():
+    """Return the peak resident set size of this process in bytes.
+
+    This is a high-water mark for the whole process, so the value recorded
+    at the end of a step is the peak reached at any point up to then.
+    """
+    if psutil is not None:
+        mem = psutil.Process().memory_info()
+        # peak_wset is only reported on Windows
+        if hasattr(mem, 'peak_wset'):
+            return int(mem.peak_wset)
+    if resource is not None:
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+        if sys.platform == 'darwin':
+            return int(maxrss)
+        return int(maxrss) * 1024
+    if psutil is not None:
+        return int(psutil.Process().memory_info().rss)
+    return None
+
+
+def io_counters():
+    """Return (bytes_read, bytes_written) for this process, or (None, None)."""
+    if psutil is not None:
+        try:
+            io = psutil.Process().io_counters()
+            return int(io.read_bytes), int(io.write_bytes)
+        except (AttributeError, psutil.Error):
+            pass
+    try:
+        with open('/proc/self/io') as fid:
+            counters = dict(line.split(': ') for line in fid.read().splitlines())
+        return int(counters['read_bytes']), int(counters['write_bytes'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+class RunReport:
+    """Collect per-subject, per-step resource usage for one script run.
+
+    Use ``report.subject(...)`` to set who is being processed and wrap each
+    step in ``with report.stage('name'):``. Call ``report.write(...)`` at the
+    end of the run to save the JSON and CSV report.
+    """
+
+    fields = ['script', 'subj', 'stage', 'wall_s', 'cpu_s', 'peak_rss_mb',
+              'rss_growth_mb', 'read_mb', 'written_mb', 'status']
+
+    def __init__(self, script):
+        self.script = script
+        self.subj = None
+        self.records = []
+        self.started = time.time()
+
+    def subject(self, subj):
+        """Attribute all following steps to this subject."""
+        self.subj = subj
+
+    @contextmanager
+    def stage(self, name):
+        """Time a named step and record its resource usage."""
+        rss_before = peak_rss()
+        read_before, written_before = io_counters()
+        wall_before = time.perf_counter()
+        cpu_before = time.process_time()
+        status = 'ok'
+        try:
+            yield
+        except BaseException:
+            status = 'error'
+            raise
+        finally:
+            wall = time.perf_counter() - wall_before
+            cpu = time.process_time() - cpu_before
+            rss_after = peak_rss()
+            read_after, written_after = io_counters()
+            self.records.append({
+                'script': self.script,
+                'subj': self.subj,
+                'stage': name,
+                'wall_s': round(wall, 4),
+                'cpu_s': round(cpu, 4),
+                'peak_rss_mb': _mb(rss_after),
+                'rss_growth_mb': _mb(_diff(rss_after, rss_before)),
+                'read_mb': _mb(_diff(read_after, read_before)),
+                'written_mb': _mb(_diff(written_after, written_before)),
+                'status': status})
+
+    def summary(self):
+        """Return total wall/CPU time per step, slowest first."""
+        totals = {}
+        for r in self.records:
+            t = totals.setdefault(r['stage'], {'stage': r['stage'], 'n': 0,
+                                               'wall_s': 0., 'cpu_s': 0.})
+            t['n'] += 1
+            t['wall_s'] += r['wall_s']
+            t['cpu_s'] += r['cpu_s']
+        return sorted(totals.values(), key=lambda t: t['wall_s'], reverse=True)
+
+    def write(self, basename):
+        """Write the report to ``basename.json`` and ``basename.csv``."""
+        folder = os.path.dirname(basename)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+
+        with open(basename + '.json', 'w') as fid:
+            json.dump({'script': self.script,
+                       'started': time.strftime('%Y-%m-%d %H:%M:%S',
+                                                time.localtime(self.started)),
+                       'total_wall_s': round(time.time() - self.started, 4),
+                       'summary': self.summary(),
+                       'records': self.records}, fid, indent=2)
+
+        with open(basename + '.csv', 'w', newline='') as fid:
+            writer = csv.DictWriter(fid, fieldnames=self.fields)
+            writer.writeheader()
+            writer.writerows(self.records)
+
+        print('run report written to ' + basename + '.json/.csv')
+        for t in self.summary():
+            print('  %-14s %8.1f s wall %8.1f s cpu (%d runs)'
+                  % (t['stage'], t['wall_s'], t['cpu_s'], t['n']))
+
+
+def _diff(after, before):
+    if after is None or before is None:
+        return None
+    return after - before
+
+
+def _mb(n_bytes):
+    if n_bytes is None:
+        return None
+    return round(n_bytes / 1024. ** 2, 3)
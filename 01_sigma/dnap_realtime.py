@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 19:10:52 2026
+
+@author: Hayley B. Caldwell
+
+DNap Relationship (Sigma): Real-Time Sigma / Slow Oscillation Tracker
+
+Online counterpart of the spindle and slow wave detection in 04 for
+closed-loop cueing during the nap. EEG arrives in blocks from a source;
+every block updates causal sigma and slow oscillation filters and emits
+timestamped events:
+
+    spindle_start  sigma RMS and relative sigma power above threshold
+                   for at least sp_duration[0] seconds
+    spindle_end    end of that spindle, with its duration
+    so_trough      negative slow oscillation peak below -so_amp_neg uV,
+                   with the predicted time of the following up-state
+
+A source is any object with ``sfreq``, ``ch_names`` and a ``blocks()``
+generator of (first sample, block in uV (channels, times), arrival time
+from time.perf_counter). FileReplaySource replays a pre-processed nap for
+testing; an amplifier stream only needs to provide the same interface.
+
+    python dnap_realtime.py 30_nap_raw.fif.gz --chans Cz --speed 1
+"""
+
+import time
+
+import numpy as np
+
+# same frequency bands and thresholds as the offline detection (yasa)
+freq_sp = (12, 15)
+freq_broad = (1, 30)
+freq_so = (0.3, 1.5)
+sp_rms_win = 0.3          # s, moving RMS of the sigma signal
+sp_rel_win = 2.           # s, window of the relative sigma power
+sp_thresh_rms = 1.5       # SD above the running mean RMS
+sp_thresh_rel = 0.2       # sigma / broadband power
+sp_duration = (0.5, 2.)   # s
+so_amp_neg = 40.          # uV
+so_freq = 0.8             # Hz, to predict the up-state after a trough
+
+# seconds of data used to settle the filters and the RMS baseline
+# before any event is emitted
+warmup_sec = 30.
+# time constant of the running RMS baseline
+baseline_sec = 60.
+# processing time allowed per block, in seconds
+block_budget = 0.02
+
+
+class FileReplaySource:
+    """Replay a recording block by block, optionally at acquisition speed.
+
+    speed=1 delivers blocks in real time, speed=2 twice as fast and speed=0
+    as fast as they can be processed.
+    """
+
+    def __init__(self, fname, chans=None, block_sec=0.1, speed=1.):
+        import mne
+        self.raw = mne.io.read_raw_fif(fname, preload=False, verbose=False)
+        if chans is not None:
+            self.raw.pick(chans)
+        self.sfreq = self.raw.info['sfreq']
+        self.ch_names = self.raw.ch_names
+        self.block = max(1, int(round(block_sec * self.sfreq)))
+        self.speed = speed
+
+    def blocks(self):
+        started = time.perf_counter()
+        for start in range(0, self.raw.n_times, self.block):
+            stop = min(start + self.block, self.raw.n_times)
+            data = self.raw.get_data(start=start, stop=stop, units='uV')
+            if self.speed:
+                # wait until the last sample of the block would have been recorded
+                due = started + stop / self.sfreq / self.speed
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            yield start, data, time.perf_counter()
+
+
+class SleepTracker:
+    """Causal sigma power, spindle and slow oscillation tracking.
+
+    Feed consecutive blocks to ``process``; filter states and detector
+    states carry over between blocks, so the result does not depend on
+    the block size. ``sigma_rms`` and ``so_phase`` hold the latest
+    estimates per channel.
+    """
+
+    def __init__(self, sfreq, ch_names):
+        from scipy.signal import butter
+
+        self.sfreq = sfreq
+        self.ch_names = list(ch_names)
+        n_chan = len(self.ch_names)
+        self.sos = {'sigma': butter(4, freq_sp, 'bandpass', fs=sfreq, output='sos'),
+                    'broad': butter(4, freq_broad, 'bandpass', fs=sfreq, output='sos'),
+                    'so': butter(1, freq_so, 'bandpass', fs=sfreq, output='sos')}
+        # filter states, shape (sections, channels, 2)
+        self.zi = {k: np.zeros((len(sos), n_chan, 2)) for k, sos in self.sos.items()}
+        # moving averages as FIR filters with carried-over state
+        self.n_rms = int(sp_rms_win * sfreq)
+        self.n_rel = int(sp_rel_win * sfreq)
+        self.ma_zi = {'rms': np.zeros((n_chan, self.n_rms - 1)),
+                      'sigma': np.zeros((n_chan, self.n_rel - 1)),
+                      'broad': np.zeros((n_chan, self.n_rel - 1))}
+        self.n_samples = 0
+        self.warmup = int(warmup_sec * sfreq)
+        self.alpha = 1. / (baseline_sec * sfreq)
+        self.rms_mean = np.zeros(n_chan)
+        self.rms_var = np.zeros(n_chan)
+        self.sigma_rms = np.zeros(n_chan)
+        self.so_phase = np.zeros(n_chan)
+        self._sp_onset = [None] * n_chan
+        self._sp_emitted = [False] * n_chan
+        self._so_last = np.zeros(n_chan)
+        self._so_min = [None] * n_chan
+        self._so_armed = [False] * n_chan
+
+    def _filter(self, key, x):
+        from scipy.signal import sosfilt
+        y, self.zi[key] = sosfilt(self.sos[key], x, axis=-1, zi=self.zi[key])
+        return y
+
+    def _moving_average(self, key, x, n):
+        from scipy.signal import lfilter
+        y, self.ma_zi[key] = lfilter(np.ones(n) / n, 1., x, axis=-1, zi=self.ma_zi[key])
+        return y
+
+    def process(self, start, block):
+        """Update the estimates with one block; return the new events.
+
+        start is the index of the first sample of the block. Event times
+        are in seconds from the start of the recording; 'sample' is the
+        sample at which the event could be decided.
+        """
+        block = np.atleast_2d(np.asarray(block, dtype=np.float64))
+        sigma = self._filter('sigma', block)
+        broad = self._filter('broad', block)
+        so = self._filter('so', block)
+        rms = np.sqrt(self._moving_average('rms', sigma ** 2, self.n_rms))
+        rel = (self._moving_average('sigma', sigma ** 2, self.n_rel)
+               / np.maximum(self._moving_average('broad', broad ** 2, self.n_rel), 1e-12))
+
+        events = []
+        for ch in range(block.shape[0]):
+            events += self._spindles(ch, start, rms[ch], rel[ch])
+            events += self._slow_oscillations(ch, start, so[ch])
+        self.sigma_rms = rms[:, -1]
+        # phase of a narrow-band oscillation x = A cos(phi) from x and dx/dt
+        omega = 2 * np.pi * so_freq
+        slope = (so[:, -1] - (so[:, -2] if so.shape[1] > 1 else self._so_last)) * self.sfreq
+        self.so_phase = np.arctan2(-slope / omega, so[:, -1])
+        self._so_last = so[:, -1]
+        self.n_samples = start + block.shape[1]
+        return sorted(events, key=lambda e: e['sample'])
+
+    def _spindles(self, ch, start, rms, rel):
+        events = []
+        for i in range(len(rms)):
+            sample = start + i
+            # running baseline of the sigma RMS (exponential moving average)
+            delta = rms[i] - self.rms_mean[ch]
+            self.rms_mean[ch] += self.alpha * delta
+            self.rms_var[ch] = (1 - self.alpha) * (self.rms_var[ch] + self.alpha * delta ** 2)
+            if sample < self.warmup:
+                continue
+            thresh = self.rms_mean[ch] + sp_thresh_rms * np.sqrt(self.rms_var[ch])
+            above = rms[i] > thresh and rel[i] > sp_thresh_rel
+            onset = self._sp_onset[ch]
+            if above and onset is None:
+                self._sp_onset[ch] = sample
+            elif above:
+                if not self._sp_emitted[ch] and (sample - onset) / self.sfreq >= sp_duration[0]:
+                    self._sp_emitted[ch] = True
+                    events.append(self._event('spindle_start', ch, onset, sample,
+                                              rms=rms[i]))
+            elif onset is not None:
+                duration = (sample - onset) / self.sfreq
+                if self._sp_emitted[ch]:
+                    events.append(self._event('spindle_end', ch, onset, sample,
+                                              duration=duration,
+                                              valid=duration <= sp_duration[1]))
+                self._sp_onset[ch] = None
+                self._sp_emitted[ch] = False
+        return events
+
+    def _slow_oscillations(self, ch, start, so):
+        events = []
+        prev = self._so_last[ch]
+        for i in range(len(so)):
+            sample = start + i
+            x = so[i]
+            if x > 0:
+                # one trough per negative half-wave
+                self._so_armed[ch] = True
+            elif self._so_armed[ch] and sample >= self.warmup and x < -so_amp_neg:
+                if x <= prev:
+                    self._so_min[ch] = (sample, x)
+                elif self._so_min[ch] is not None:
+                    # the signal turned back up: the trough is behind us
+                    t_sample, t_amp = self._so_min[ch]
+                    events.append(self._event(
+                        'so_trough', ch, t_sample, sample, amplitude=t_amp,
+                        upstate=t_sample / self.sfreq + 0.5 / so_freq))
+                    self._so_min[ch] = None
+                    self._so_armed[ch] = False
+            prev = x
+        return events
+
+    def _event(self, name, ch, onset, sample, **info):
+        event = {'event': name, 'channel': self.ch_names[ch],
+                 'time': onset / self.sfreq, 'sample': sample}
+        event.update(info)
+        return event
+
+
+def run_tracker(source, on_event=None, budget=block_budget):
+    """Track a source until it ends; return the events and latency stats.
+
+    Each event gets 'latency': seconds from the arrival of the sample that
+    decided it to its emission, i.e. the delay of a cue triggered by it.
+    on_event is called with each event as soon as it is emitted.
+    """
+    tracker = SleepTracker(source.sfreq, source.ch_names)
+    events, block_times = [], []
+    for start, block, arrived in source.blocks():
+        new = tracker.process(start, block)
+        done = time.perf_counter()
+        block_times.append(done - arrived)
+        last = start + block.shape[-1] - 1
+        for e in new:
+            # samples earlier in the block were recorded before it arrived
+            e['latency'] = done - arrived + (last - e['sample']) / source.sfreq
+            if on_event is not None:
+                on_event(e)
+        events += new
+    return events, latency_summary(block_times, events, budget)
+
+
+def latency_summary(block_times, events, budget=block_budget):
+    block_times = np.asarray(block_times)
+    event_lat = np.asarray([e['latency'] for e in events])
+    summary = {'n_blocks': len(block_times),
+               'block_median_s': float(np.median(block_times)),
+               'block_p95_s': float(np.percentile(block_times, 95)),
+               'block_max_s': float(block_times.max()),
+               'blocks_over_budget': int((block_times > budget).sum()),
+               'n_events': len(events)}
+    if len(event_lat):
+        summary.update({'event_median_s': float(np.median(event_lat)),
+                        'event_p95_s': float(np.percentile(event_lat, 95)),
+                        'event_max_s': float(event_lat.max())})
+    return summary
+
+
+def main():
+    import argparse
+    import pandas as pd
+
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('fname', help='pre-processed nap (fif) to replay')
+    parser.add_argument('--chans', nargs='+', default=['Cz'])
+    parser.add_argument('--block', type=float, default=0.1,
+                        help='block length in seconds')
+    parser.add_argument('--speed', type=float, default=1.,
+                        help='replay speed, 0 for as fast as possible')
+    parser.add_argument('--out', default='realtime_events.csv')
+    args = parser.parse_args()
+
+    source = FileReplaySource(args.fname, args.chans, args.block, args.speed)
+
+    def show(e):
+        print('%8.2f s  %-13s %-4s latency %5.1f ms'
+              % (e['time'], e['event'], e['channel'], 1000 * e['latency']))
+
+    events, summary = run_tracker(source, on_event=show)
+    pd.DataFrame(events).to_csv(args.out, index=False)
+    print('events written to ' + args.out)
+    for key, value in summary.items():
+        print('  %-20s %s' % (key, value))
+
+
+if __name__ == '__main__':
+    main()
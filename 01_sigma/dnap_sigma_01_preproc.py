@@ -5,46 +5,47 @@ Created on Tue May 16 12:10:24 2023
 @author: Hayley B. Caldwell 
 
 DNap Relationship (Sigma) 01: Pre-Processing 
+
+Each step is an importable function so the pipeline orchestrator
+(dnap_pipeline.py) can run single files; running this script processes
+all files in data_dir as before.
 """
 
 
-import mne
 import os
 import os.path as op
+import sys
 import glob
-import seaborn as sns
-import csv
-from philistine.mne import abs_threshold, retrieve
-from autoreject import AutoReject, get_rejection_threshold
-from mne.preprocessing import ICA
-from mne.preprocessing import create_eog_epochs
-import matplotlib.pyplot as plt
-
-# plots created will appear in a different window - dont worry, it runs
-%matplotlib qt
-
-# set working directory to where the function is located 
-os.chdir('E:\\DNap\\Scripts')
-from utils import compute_ica_correction
-
-# set working directory to where the raw EEG files are located 
-os.chdir('E:\\DNap\\EEG')
-
-sns.set(style='white', font_scale=1.2)
+from dnap_profiling import RunReport
+from dnap_startup import setup_backend
+from dnap_items import item_events, items_suffix, stimulus_code
 
 ##############################################################################
 #                           Setup the basics                                 #
 ##############################################################################
 
-# construct a montage to assign to the data
-montage = mne.channels.make_standard_montage('standard_1020')
+# where the raw EEG files and the ICA function (utils.py) are located
+data_dir = 'E:\\DNap\\EEG'
+scripts_dir = 'E:\\DNap\\Scripts'
+
+# montage to assign to the data
+montage_name = 'standard_1020'
 
-raw_files = glob.glob("*dnap_int_re*.vhdr")
+raw_pattern = "*dnap_int_re*.vhdr"
 
 # toggle this to true if you want to overwrite already processed files
 # toggle this to false if you want to skip already processed files
 compute_from_scratch = False
 
+# channel types for the BrainVision recordings
+eog_chans = ['E1', 'E2']
+misc_chans = ['EMG1', 'EMG2', 'EMG3', 'ECG']
+
+# resampling rate, filter band and epoch length
+resample_sfreq = 100
+l_freq, h_freq = 1, 40.
+epoch_duration = 30
+
 # rejection thresholds for ICA and artifact rejection
 reject_ica = dict(eeg=150e-6)
 reject = dict(eeg=150e-6, eog=250e-6)
@@ -179,230 +180,113 @@ windows = {"Prestim": (-200, -0.5),
            "Event": (0, 4000)
            }
 
-# Make sure that the needed folders exists. Create if not.
+# item event map of each phase (the condition ends in ret or res)
+event_ids = {'ret': event_id_ret, 'res': event_id_res}
+
+# also save item-locked epochs (tmin to tmax around each word trigger)
+# with their word, presentation and phase as metadata (see dnap_items)
+save_item_epochs = True
+
+
+# Fix files
+# pasting files together in cases of a crash
+files_to_paste = {
+    '07_dnap_int_ret.vhdr': 'files_to_paste\\07_dnap_int_ret2.vhdr',
+    '14_dnap_int_res.vhdr': 'files_to_paste\\14_dnap_int_res2.vhdr',
+    '16_dnap_int_ret.vhdr': 'files_to_paste\\16_dnap_int2_ret.vhdr',
+    '19_dnap_int_res.vhdr': 'files_to_paste\\19_dnap_int_res2.vhdr',
+    '25_dnap_int_ret.vhdr': 'files_to_paste\\25_dnap_int_ret2.vhdr'}
+
+# set some cases manually if they were concatenated prior as time info is incorrect
+# (tmin, tmax) in seconds for each of the six rounds
+manual_sections = {
+    '07_dnap_int_ret.vhdr': [(106, 593), (1348, 1813), (2374, 2809),
+                             (3564, 3991), (4776, 5184), (5944, 6348)],
+    '14_dnap_int_res.vhdr': [(37, 262), (1263, 1486), (2462, 2678),
+                             (3286, 3507), (4495, 4715), (5698, 5916)],
+    '16_dnap_int_ret.vhdr': [(61, 529), (651, 1105), (1854, 2307),
+                             (3053, 3509), (4318, 4754), (5440, 5904)],
+    '19_dnap_int_res.vhdr': [(59, 286), (995, 1214), (2214, 2438),
+                             (3408, 3628), (4546, 4767), (5823, 6041)],
+    '25_dnap_int_ret.vhdr': [(35, 493), (1113, 1512), (1952, 2338),
+                             (3162, 3552), (4448, 4832), (5559, 5959)]}
+
+# start and stop triggers of the six rounds (r1-start ... r6-stop)
+round_triggers = [(230, 231), (232, 233), (234, 235),
+                  (236, 237), (238, 239), (240, 241)]
 
 folder_list = ['sigma\\butterfly_plots', 'sigma\\topoplots', 'sigma\\psd_plots', 'sigma\\erp_plots',
                'sigma\\processed', 'sigma\\ica']
 
-for l in folder_list:
-    if not os.path.exists(l):
-        os.makedirs(l)
-
-# loop through the list of raw files for preprocessing
-for f in raw_files:
 
-    # extract participant number and condition
-    s_number = '_'.join(f.split('_')[:1])
-    condition = '_'.join(f.split('_')[3:])
+def parse_fname(f):
+    """Extract participant number and condition from a raw file name."""
+    s_number = '_'.join(op.basename(f).split('_')[:1])
+    condition = '_'.join(op.basename(f).split('_')[3:])
     condition = '_'.join(condition.split('.')[:1])
-    s_no_cond = s_number+condition
-
-    # ---------------------------------------------------------------------------
-    # Basic Pre-Processing and ICA Correction
-    # ---------------------------------------------------------------------------
-
-    print('processing participant: ' + s_number + ". condition:" + condition)
-
-    if op.exists('sigma\\processed\\' + s_number + "_" + condition + '_epo.fif.gz'):
-        if not(compute_from_scratch):
-            print('skipping participant' + s_number + ': file already exists')
-            continue
-
-    raw = mne.io.read_raw_brainvision(f, preload=True, eog=['E1', 'E2'],
-                                      misc=['EMG1', 'EMG2', 'EMG3', 'ECG'])
-
-    # Fix files
-    # pasting files together in cases of a crash
-
-    if f == '07_dnap_int_ret.vhdr':
-        raw1 = mne.io.read_raw_brainvision('07_dnap_int_ret.vhdr', preload=True, eog=['E1', 'E2'],
-                                           misc=['EMG1', 'EMG2', 'EMG3', 'ECG'])
-        raw2 = mne.io.read_raw_brainvision('files_to_paste\\07_dnap_int_ret2.vhdr', preload=True, eog=['E1', 'E2'],
-                                           misc=['EMG1', 'EMG2', 'EMG3', 'ECG'])
-        raws = [raw1, raw2]
-        raw = mne.io.concatenate_raws(raws, preload=True)
-    elif f == '14_dnap_int_res.vhdr':
-        raw1 = mne.io.read_raw_brainvision('14_dnap_int_res.vhdr', preload=True, eog=['E1', 'E2'],
-                                           misc=['EMG1', 'EMG2', 'EMG3', 'ECG'])
-        raw2 = mne.io.read_raw_brainvision('files_to_paste\\14_dnap_int_res2.vhdr', preload=True, eog=['E1', 'E2'],
-                                           misc=['EMG1', 'EMG2', 'EMG3', 'ECG'])
-        raws = [raw1, raw2]
-        raw = mne.io.concatenate_raws(raws, preload=True)
-    elif f == '16_dnap_int_ret.vhdr':
-        raw1 = mne.io.read_raw_brainvision('16_dnap_int_ret.vhdr', preload=True, eog=['E1', 'E2'],
-                                           misc=['EMG1', 'EMG2', 'EMG3', 'ECG'])
-        raw2 = mne.io.read_raw_brainvision('files_to_paste\\16_dnap_int2_ret.vhdr', preload=True, eog=['E1', 'E2'],
-                                           misc=['EMG1', 'EMG2', 'EMG3', 'ECG'])
-        raws = [raw1, raw2]
-        raw = mne.io.concatenate_raws(raws, preload=True)
-    elif f == '19_dnap_int_res.vhdr':
-        raw1 = mne.io.read_raw_brainvision('19_dnap_int_res.vhdr', preload=True, eog=['E1', 'E2'],
-                                           misc=['EMG1', 'EMG2', 'EMG3', 'ECG'])
-        raw2 = mne.io.read_raw_brainvision('files_to_paste\\19_dnap_int_res2.vhdr', preload=True, eog=['E1', 'E2'],
-                                           misc=['EMG1', 'EMG2', 'EMG3', 'ECG'])
-        raws = [raw1, raw2]
-        raw = mne.io.concatenate_raws(raws, preload=True)
-    elif f == '25_dnap_int_ret.vhdr':
-        raw1 = mne.io.read_raw_brainvision('25_dnap_int_ret.vhdr', preload=True, eog=['E1', 'E2'],
-                                           misc=['EMG1', 'EMG2', 'EMG3', 'ECG'])
-        raw2 = mne.io.read_raw_brainvision('files_to_paste\\25_dnap_int_ret2.vhdr', preload=True, eog=['E1', 'E2'],
-                                           misc=['EMG1', 'EMG2', 'EMG3', 'ECG'])
-        raws = [raw1, raw2]
-        raw = mne.io.concatenate_raws(raws, preload=True)
-    else:
-        pass
+    return s_number, condition
 
-    # segment the continuous EEG around events
-    events = mne.events_from_annotations(raw)
 
-    # crop out breaks between restudy and retrieval rounds
-    events_array = events[0]
+def processed_fname(f, out_dir='sigma\\processed'):
+    s_number, condition = parse_fname(f)
+    return op.join(out_dir, s_number + "_" + condition + '_epo.fif.gz')
 
+
+def read_raw(f):
+    """Read a raw BrainVision file, pasting crashed recordings together."""
+    import mne
+    raw = mne.io.read_raw_brainvision(f, preload=True, eog=eog_chans,
+                                      misc=misc_chans)
+    paste = files_to_paste.get(op.basename(f))
+    if paste is not None:
+        raw2 = mne.io.read_raw_brainvision(op.join(op.dirname(f), paste), preload=True,
+                                           eog=eog_chans, misc=misc_chans)
+        raw = mne.io.concatenate_raws([raw, raw2], preload=True)
+    return raw
+
+
+def find_sections(raw, f):
+    """Return (tmin, tmax) in seconds of the six restudy/retrieval rounds."""
+    import mne
+    if op.basename(f) in manual_sections:
+        return manual_sections[op.basename(f)]
+
+    # segment the continuous EEG around events
+    events_array = mne.events_from_annotations(raw)[0]
     sf = raw.info['sfreq']
-    
-    # set some cases manually if they were concatenated prior as time info is incorrect
-    if f == '07_dnap_int_ret.vhdr':
-        tmin1 = 106
-        tmax1 = 593
-        tmin2 = 1348
-        tmax2 = 1813
-        tmin3 = 2374
-        tmax3 = 2809
-        tmin4 = 3564
-        tmax4 = 3991
-        tmin5 = 4776
-        tmax5 = 5184
-        tmin6 = 5944
-        tmax6 = 6348
-    elif f == '14_dnap_int_res.vhdr':
-        tmin1 = 37
-        tmax1 = 262
-        tmin2 = 1263
-        tmax2 = 1486
-        tmin3 = 2462
-        tmax3 = 2678
-        tmin4 = 3286
-        tmax4 = 3507
-        tmin5 = 4495
-        tmax5 = 4715
-        tmin6 = 5698
-        tmax6 = 5916
-    elif f == '16_dnap_int_ret.vhdr':
-        tmin1 = 61
-        tmax1 = 529
-        tmin2 = 651
-        tmax2 = 1105
-        tmin3 = 1854
-        tmax3 = 2307
-        tmin4 = 3053
-        tmax4 = 3509
-        tmin5 = 4318
-        tmax5 = 4754
-        tmin6 = 5440
-        tmax6 = 5904
-    elif f == '19_dnap_int_res.vhdr':
-        tmin1 = 59
-        tmax1 = 286
-        tmin2 = 995
-        tmax2 = 1214
-        tmin3 = 2214
-        tmax3 = 2438
-        tmin4 = 3408
-        tmax4 = 3628
-        tmin5 = 4546
-        tmax5 = 4767
-        tmin6 = 5823
-        tmax6 = 6041
-    elif f == '25_dnap_int_ret.vhdr':
-        tmin1 = 35
-        tmax1 = 493
-        tmin2 = 1113
-        tmax2 = 1512
-        tmin3 = 1952
-        tmax3 = 2338
-        tmin4 = 3162
-        tmax4 = 3552
-        tmin5 = 4448
-        tmax5 = 4832
-        tmin6 = 5559
-        tmax6 = 5959
-    else:
+
+    # crop out breaks between restudy and retrieval rounds
+    sections = []
+    for n, (start, stop) in enumerate(round_triggers):
+        tmin_n = tmax_n = None
         for trigger in range(0, len(events_array)):
             trig_all = events_array[trigger, 2]
-            if trig_all == 230:
-                tmin1_time = events_array[trigger, 0]/sf
-                tmin1 = tmin1_time - 0.01
-                print("tmin1 =", tmin1)
-            elif trig_all == 231:
-                tmax1_time = events_array[trigger, 0]/sf
-                tmax1 = tmax1_time + 0.01
-                print("tmax1 =", tmax1)
-            elif trig_all == 232:
-                tmin2_time = events_array[trigger, 0]/sf
-                tmin2 = tmin2_time - 0.01
-                print("tmin2 =", tmin2)
-            elif trig_all == 233:
-                tmax2_time = events_array[trigger, 0]/sf
-                tmax2 = tmax2_time + 0.01
-                print("tmax2 =", tmax2)
-            elif trig_all == 234:
-                tmin3_time = events_array[trigger, 0]/sf
-                tmin3 = tmin3_time - 0.01
-                print("tmin3 =", tmin3)
-            elif trig_all == 235:
-                tmax3_time = events_array[trigger, 0]/sf
-                tmax3 = tmax3_time + 0.01
-                print("tmax3 =", tmax3)
-            elif trig_all == 236:
-                tmin4_time = events_array[trigger, 0]/sf
-                tmin4 = tmin4_time - 0.01
-                print("tmin4 =", tmin4)
-            elif trig_all == 237:
-                tmax4_time = events_array[trigger, 0]/sf
-                tmax4 = tmax4_time + 0.01
-                print("tmax4 =", tmax4)
-            elif trig_all == 238:
-                tmin5_time = events_array[trigger, 0]/sf
-                tmin5 = tmin5_time - 0.01
-                print("tmin5 =", tmin5)
-            elif trig_all == 239:
-                tmax5_time = events_array[trigger, 0]/sf
-                tmax5 = tmax5_time + 0.01
-                print("tmax5 =", tmax5)
-            elif trig_all == 240:
-                tmin6_time = events_array[trigger, 0]/sf
-                tmin6 = tmin6_time - 0.01
-                print("tmin6 =", tmin6)
-            elif trig_all == 241:
-                tmax6_time = events_array[trigger, 0]/sf
-                tmax6 = tmax6_time + 0.01
-                print("tmax6 =", tmax6)
-    raw2 = raw.copy()
-    section1 = raw2.crop(tmin=tmin1, tmax=tmax1,
-                         include_tmax=True, verbose=None)
-    raw2 = raw.copy()
-    section2 = raw2.crop(tmin=tmin2, tmax=tmax2,
-                         include_tmax=True, verbose=None)
-    raw2 = raw.copy()
-    section3 = raw2.crop(tmin=tmin3, tmax=tmax3,
-                         include_tmax=True, verbose=None)
-    raw2 = raw.copy()
-    section4 = raw2.crop(tmin=tmin4, tmax=tmax4,
-                         include_tmax=True, verbose=None)
-    raw2 = raw.copy()
-    section5 = raw2.crop(tmin=tmin5, tmax=tmax5,
-                         include_tmax=True, verbose=None)
-    raw2 = raw.copy()
-    section6 = raw2.crop(tmin=tmin6, tmax=tmax6,
-                         include_tmax=True, verbose=None)
-
-    raws = [section1, section2, section3, section4, section5, section6]
-
-    raw = mne.concatenate_raws(
+            if trig_all == start:
+                tmin_n = events_array[trigger, 0]/sf - 0.01
+                print("tmin%d =" % (n + 1), tmin_n)
+            elif trig_all == stop:
+                tmax_n = events_array[trigger, 0]/sf + 0.01
+                print("tmax%d =" % (n + 1), tmax_n)
+        sections.append((tmin_n, tmax_n))
+    return sections
+
+
+def segment_raw(raw, f):
+    """Crop the six rounds out of the recording and join them."""
+    import mne
+    raws = [raw.copy().crop(tmin=tmin_n, tmax=tmax_n, include_tmax=True,
+                            verbose=None)
+            for tmin_n, tmax_n in find_sections(raw, f)]
+
+    return mne.concatenate_raws(
         raws, preload=None, events_list=None, on_mismatch='raise', verbose=None)
 
-    # downsample to 250 Hz
-    raw = raw.resample(100)
+
+def resample_raw(raw, sfreq=resample_sfreq):
+    """Downsample, re-reference to the mastoids and set the montage."""
+    import mne
+    # downsample to 100 Hz
+    raw = raw.resample(sfreq)
 
     # re-reference to the mean of the left and right mastoids
     raw.set_eeg_reference(ref_channels=['M1', 'M2'])
@@ -411,30 +295,234 @@ for f in raw_files:
     raw.drop_channels(['M1', 'M2', 'EMG1', 'EMG2', 'EMG3', 'ECG'])
 
     # set montage to add information about electrode positions
-    raw.set_montage(montage)
+    # construct a montage to assign to the data
+    raw.set_montage(mne.channels.make_standard_montage(montage_name))
+    return raw
 
-    # apply ICA-based EOG correction
 
+def filter_raw(raw, l_freq=l_freq, h_freq=h_freq):
     # filter the data
-    raw.filter(1, 40., l_trans_bandwidth='auto', h_trans_bandwidth='auto',
+    raw.filter(l_freq, h_freq, l_trans_bandwidth='auto', h_trans_bandwidth='auto',
                filter_length='auto', method='fir', fir_window='hamming', phase='zero', n_jobs=2)
+    return raw
+
+
+def plot_raw_psd(raw, f, plot_dir='sigma\\psd_plots'):
+    import seaborn as sns
+    import matplotlib.pyplot as plt
+    sns.set(style='white', font_scale=1.2)
 
     # Create initial PSD plot
-    psd_plot_name = 'sigma\\psd_plots\\' + s_number + \
-        "_" + condition + '_psd_raw' + '.png'
+    s_number, condition = parse_fname(f)
+    psd_plot_name = op.join(plot_dir, s_number + "_" + condition + '_psd_raw' + '.png')
     fig = raw.plot_psd(fmin=0, fmax=30)
     fig.savefig(psd_plot_name)
     plt.close(fig='all')
 
+
+def ica_correct(raw, f):
     # apply ICA function from utils.py script
-    raw = compute_ica_correction(raw, f)
+    if scripts_dir not in sys.path:
+        sys.path.append(scripts_dir)
+    from utils import compute_ica_correction
+    return compute_ica_correction(raw, f)
+
+
+def make_epochs(raw, duration=epoch_duration, reject=None, flat=None):
+    """Fixed-length epochs, dropping those beyond the reject/flat thresholds."""
+    import mne
+    epochs = mne.make_fixed_length_epochs(raw, duration=duration, preload=True)
+    if reject is not None or flat is not None:
+        epochs.drop_bad(reject=reject, flat=flat)
+    return epochs
+
+
+def items_fname(f, out_dir='sigma\\processed'):
+    s_number, condition = parse_fname(f)
+    return op.join(out_dir, s_number + "_" + condition + items_suffix)
+
+
+def make_item_epochs(raw, f, tmin=tmin, tmax=tmax, reject=None, flat=None):
+    """Epochs around every item trigger, with the item metadata."""
+    import mne
+    import pandas as pd
+    phase = parse_fname(f)[1].split('_')[-1]
+    events = mne.events_from_annotations(raw, event_id=stimulus_code)[0]
+    events, metadata = item_events(events, event_ids[phase], phase,
+                                   raw.info['sfreq'], raw.first_samp)
+    return mne.Epochs(raw, events, tmin=tmin, tmax=tmax, baseline=None,
+                      metadata=pd.DataFrame(metadata), reject=reject,
+                      flat=flat, preload=True)
+
+
+def item_epochs_file(raw, f, out_dir, reject=None, flat=None):
+    """Cut the item epochs of f from the cleaned raw and save them."""
+    fname = items_fname(f, out_dir)
+    item_epochs = make_item_epochs(raw, f, reject=reject, flat=flat)
+    item_epochs.save(fname, fmt='single', overwrite=True)
+    return fname
+
+
+def read_checkpoint(fname):
+    import mne
+    return mne.io.read_raw_fif(fname, preload=True)
+
+
+def save_checkpoint(raw, fname):
+    # double precision so resuming gives the same result as a single run
+    raw.save(fname, fmt='double', overwrite=True)
+    return fname
+
+
+# The steps of preprocess_file, each reading and saving a checkpoint, so a
+# parameter sweep (dnap_sweep.py) can resume from the last shared step.
+
+def segment_file(f, outfile, report=None):
+    """Read a raw file, keep the six rounds and save the segmented raw."""
+    if report is None:
+        report = RunReport('01_preproc')
+    s_number, condition = parse_fname(f)
+    report.subject(s_number + "_" + condition)
+    with report.stage('read'):
+        raw = read_raw(f)
+    with report.stage('segment'):
+        raw = segment_raw(raw, f)
+    with report.stage('save'):
+        return save_checkpoint(raw, outfile)
+
+
+def filter_file(raw_file, outfile, l_freq=l_freq, h_freq=h_freq,
+                sfreq=resample_sfreq, report=None):
+    """Resample, re-reference and filter a segmented raw checkpoint."""
+    if report is None:
+        report = RunReport('01_preproc')
+    with report.stage('read'):
+        raw = read_checkpoint(raw_file)
+    with report.stage('resample'):
+        raw = resample_raw(raw, sfreq)
+    with report.stage('filter'):
+        raw = filter_raw(raw, l_freq, h_freq)
+    with report.stage('save'):
+        return save_checkpoint(raw, outfile)
+
+
+def ica_file(raw_file, f, outfile, report=None):
+    """ICA-correct a filtered raw checkpoint of raw file f."""
+    if report is None:
+        report = RunReport('01_preproc')
+    with report.stage('read'):
+        raw = read_checkpoint(raw_file)
+    with report.stage('ICA'):
+        raw = ica_correct(raw, f)
+    with report.stage('save'):
+        return save_checkpoint(raw, outfile)
+
+
+def epoch_file(raw_file, f, out_dir, duration=epoch_duration, reject=None,
+               flat=None, items=save_item_epochs, report=None):
+    """Epoch an ICA-corrected raw checkpoint and save the epochs of f."""
+    if report is None:
+        report = RunReport('01_preproc')
+    with report.stage('read'):
+        raw = read_checkpoint(raw_file)
+    with report.stage('epoch'):
+        epochs = make_epochs(raw, duration, reject, flat)
+    with report.stage('save'):
+        processed_file = processed_fname(f, out_dir)
+        epochs.save(processed_file, fmt='single', overwrite=True)
+    # after the epochs are saved, so a failure here does not lose them
+    if items:
+        with report.stage('items'):
+            item_epochs_file(raw, f, out_dir, reject, flat)
+    return processed_file
+
+
+def preprocess_file(f, out_dir='sigma\\processed', l_freq=l_freq, h_freq=h_freq,
+                    sfreq=resample_sfreq, duration=epoch_duration, reject=None,
+                    flat=None, items=save_item_epochs, report=None):
+    """Run the full pre-processing of one raw file and save the epochs.
+
+    reject and flat (e.g. the module settings of the same name) drop
+    epochs by peak-to-peak amplitude; by default all epochs are kept.
+    With items=True the item-locked epochs are cut from the same cleaned
+    recording and saved to items_fname. Returns the name of the saved
+    epochs file.
+    """
+    if report is None:
+        report = RunReport('01_preproc')
+    s_number, condition = parse_fname(f)
+    report.subject(s_number + "_" + condition)
+
+    with report.stage('read'):
+        raw = read_raw(f)
+
+    with report.stage('segment'):
+        raw = segment_raw(raw, f)
+
+    with report.stage('resample'):
+        raw = resample_raw(raw, sfreq)
+
+    # apply ICA-based EOG correction
+
+    with report.stage('filter'):
+        raw = filter_raw(raw, l_freq, h_freq)
+
+    plot_raw_psd(raw, f, op.join(op.dirname(out_dir), 'psd_plots'))
+
+    with report.stage('ICA'):
+        raw = ica_correct(raw, f)
+
+    with report.stage('epoch'):
+        epochs = make_epochs(raw, duration, reject, flat)
+
+    with report.stage('save'):
+        # save preprocessed data
+        processed_file = processed_fname(f, out_dir)
+        epochs.save(processed_file, fmt='single', overwrite=True)
+
+    # item epochs after the epochs are saved, so a failure here does not
+    # lose them
+    if items:
+        with report.stage('items'):
+            item_epochs_file(raw, f, out_dir, reject, flat)
+    return processed_file
+
+
+def main():
+    # plots go to a window in IPython and straight to file in batch runs
+    setup_backend()
+
+    # set working directory to where the raw EEG files are located 
+    os.chdir(data_dir)
+
+    # Make sure that the needed folders exists. Create if not.
+    for l in folder_list:
+        if not os.path.exists(l):
+            os.makedirs(l)
+
+    # record time and memory used by each processing step
+    report = RunReport('01_preproc')
+
+    # loop through the list of raw files for preprocessing
+    for f in glob.glob(raw_pattern):
+        s_number, condition = parse_fname(f)
+
+        # ---------------------------------------------------------------------------
+        # Basic Pre-Processing and ICA Correction
+        # ---------------------------------------------------------------------------
+
+        print('processing participant: ' + s_number + ". condition:" + condition)
+
+        if op.exists(processed_fname(f)):
+            if not(compute_from_scratch):
+                print('skipping participant' + s_number + ': file already exists')
+                continue
+
+        preprocess_file(f, report=report)
 
-    picks = mne.pick_types(raw.info, eeg=True, eog=False,
-                           stim=False, misc=False)
+    # save the run report to spot slow steps and outlier participants
+    report.write('sigma\\reports\\01_preproc_report')
 
-    epochs = mne.make_fixed_length_epochs(raw, duration=30,preload=True)
 
-    # save preprocessed data
-    processed_file = 'sigma\\processed\\' + \
-        s_number + "_" + condition + '_epo.fif.gz'
-    epochs.save(processed_file, fmt='single', overwrite=True)
+if __name__ == '__main__':
+    main()
@@ -7,15 +7,16 @@ Created on Tue May 16 11:50:28 2023
 DNap Relationship (Sigma) 02: IAF 
 """
 
-import mne
 import os
 import os.path as op
 import glob
-from philistine.mne import savgol_iaf
+from dnap_profiling import RunReport
+from dnap_startup import setup_backend
 
-# set working directory to where the raw EEG files are located 
-os.chdir('E:\\DNap\\EEG') 
-iaf_files = glob.glob('*_rs1_*.vhdr') 
+# where the raw EEG files are located 
+data_dir = 'E:\\DNap\\EEG'
+iaf_pattern = '*_rs1_*.vhdr'
+iaf_outfile = 'sigma\\processed\\iaf_long.txt'
 
 #Electrodes to consider for IAF calculation
 # = P1, Pz, P2, PO3, POz, PO4, O2, Oz, O2
@@ -23,6 +24,13 @@ electrodes = ['P3','P4','O1','O2','P7','P8','Pz']
 #picks = [46,47,48,55,56,57,61,62,63]
 #Frequency bands to adjust
 bands = ["alpha","l_alpha","u_alpha","theta", "sigma","beta","alphabeta"]
+#Alpha search range passed to savgol_iaf
+iaf_fmin, iaf_fmax = 7, 13
+#Welch resolution and range, smoothing and 1/f check (savgol_iaf defaults)
+psd_resolution = 0.25
+psd_fmin, psd_fmax = 1., 30.
+savgol_window, savgol_polyorder = 11, 5
+pink_max_r2 = 0.9
 
 def get_freq_band_limits(band, paf):
     """Adjust frequency bands using IAF.
@@ -59,23 +67,29 @@ def get_freq_band_limits(band, paf):
     
     return lower, upper
 
-outfile = open('sigma\\processed\\iaf_long.txt','w')
-header = "subj"+"\t"+"cond"+"\t"+"measure"+"\t"+"value"+"\n"
-outfile.write(header)
-
-for i in iaf_files:
-    print("processing file "+i)
-    subj = '_'.join(i.split('_')[:1])
-    cond = '_'.join(i.split('_')[3:])
+def parse_fname(i):
+    subj = '_'.join(op.basename(i).split('_')[:1])
+    cond = '_'.join(op.basename(i).split('_')[3:])
     cond = '_'.join(cond.split('.')[:1])
-    
-    raw = mne.io.read_raw_brainvision(i, preload=True)
-    
+    return subj, cond
+
+def crop_limits(subj, cond):
+    """Return (tmin, tmax) to crop a resting file to, or None."""
     if subj == "21" and cond == "ret":
-        raw.crop(tmin=0, tmax=120,
+        return (0, 120)
+    return None
+
+def read_picks(i):
+    """Read only the IAF electrodes of one resting file."""
+    import mne
+
+    raw = mne.io.read_raw_brainvision(i, preload=False)
+    raw.pick(electrodes)
+    
+    limits = crop_limits(*parse_fname(i))
+    if limits is not None:
+        raw.crop(tmin=limits[0], tmax=limits[1],
                              include_tmax=True, verbose=None)
-    else: 
-        pass
 
     #Standardise electrode names and select picks for IAF calculation
     #ch_names = dict()
@@ -83,16 +97,89 @@ for i in iaf_files:
      #   ch_names[raw.ch_names[i]] = standardize_ch_name(c)
     #raw.rename_channels(ch_names)
 
-    picks = list()
-    for e in electrodes:
-        index = raw.ch_names.index(e)
-        picks.append(index)
+    return raw.load_data()
+
+def psd_cache_name(i, cache_dir):
+    """Cache file for the spectra of one file and the current settings."""
+    import hashlib
+
+    stat = os.stat(i)
+    key = repr((op.abspath(i), stat.st_size, stat.st_mtime, electrodes,
+                crop_limits(*parse_fname(i)), psd_resolution, psd_fmin, psd_fmax))
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return op.join(cache_dir, op.splitext(op.basename(i))[0] + '_' + digest + '_psd.npz')
 
-    #Get IAF
-    paf, cog, ablimits = savgol_iaf(raw, picks=picks, fmin=7, fmax=13)
+def welch_psd(i, cache_dir=None):
+    """Welch PSD of the IAF electrodes of one resting file.
+
+    Uses the same settings as savgol_iaf. Spectra are cached in cache_dir,
+    so changing the alpha range or smoothing does not recompute them.
+    Returns psd (n_electrodes, n_freqs) and freqs.
+    """
+    import numpy as np
+
+    if cache_dir is not None:
+        cache_file = psd_cache_name(i, cache_dir)
+        if op.exists(cache_file):
+            cached = np.load(cache_file)
+            return cached['psd'], cached['freqs']
+
+    print("processing file "+i)
+    raw = read_picks(i)
+    n_fft = int(raw.info['sfreq'] / psd_resolution)
+    spectrum = raw.compute_psd(method="welch", n_fft=n_fft,
+                               fmin=psd_fmin, fmax=psd_fmax)
+    psd, freqs = spectrum.get_data(), spectrum.freqs
+
+    if cache_dir is not None:
+        if not op.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+        np.savez(cache_file, psd=psd, freqs=freqs)
+    return psd, freqs
+
+def savgol_iaf_batch(psds, freqs, fmin=iaf_fmin, fmax=iaf_fmax,
+                     window_length=savgol_window, polyorder=savgol_polyorder,
+                     pink_max_r2=pink_max_r2):
+    """Estimate PAF and CoG for a batch of channel-averaged spectra.
+
+    Follows savgol_iaf from philistine with a fixed alpha band, but works
+    on precomputed spectra of shape (n_files, n_freqs) in one vectorised
+    pass. Returns arrays of PAF and CoG with NaN where savgol_iaf would
+    return None.
+    """
+    import numpy as np
+    from scipy.signal import savgol_filter
 
-    outfile.write(subj+"\t"+cond+"\t"+"paf\t"+str(paf)+"\n")
-    outfile.write(subj+"\t"+cond+"\t"+"cog\t"+str(cog)+"\n")
+    psds = np.atleast_2d(psds)
+    psd_smooth = savgol_filter(psds, window_length=window_length,
+                               polyorder=polyorder, axis=-1)
+    alpha_band = np.logical_and(freqs >= fmin, freqs <= fmax)
+
+    #Correlation with the 1/f fit of the log-log spectrum
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x = np.log(freqs) - np.log(freqs).mean()
+        y = np.log(psd_smooth)
+        y = y - y.mean(axis=-1, keepdims=True)
+        r = (y @ x) / np.sqrt((y ** 2).sum(axis=-1) * (x ** 2).sum())
+    pink = r ** 2 > pink_max_r2
+
+    band = psd_smooth[:, alpha_band]
+    band_freqs = freqs[alpha_band]
+    paf = band_freqs[np.argmax(band, axis=-1)]
+
+    #Centre of gravity of the smoothed alpha peak
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cog_idx = (band * np.arange(band.shape[-1])).sum(axis=-1) / band.sum(axis=-1)
+    valid = np.isfinite(cog_idx) & ~pink
+    cog = np.full(len(psds), np.nan)
+    cog[valid] = band_freqs[np.round(cog_idx[valid]).astype(int)]
+
+    paf = np.where(valid, paf, np.nan)
+    return paf, cog
+
+def iaf_rows(subj, cond, paf, cog):
+    """Return the (subj, cond, measure, value) rows of one file."""
+    rows = [(subj, cond, "paf", paf), (subj, cond, "cog", cog)]
 
     #Calculate adjusted frequency band limits
     for b in bands:
@@ -103,7 +190,79 @@ for i in iaf_files:
         except (TypeError):
             lower,upper = get_freq_band_limits(b,10)
             
-        outfile.write(subj+"\t"+cond+"\t"+band_lower+"\t"+str(lower)+"\n")
-        outfile.write(subj+"\t"+cond+"\t"+band_upper+"\t"+str(upper)+"\n")
+        rows.append((subj, cond, band_lower, lower))
+        rows.append((subj, cond, band_upper, upper))
+    return rows
+
+def compute_iaf(iaf_files, outfile=iaf_outfile, fmin=iaf_fmin, fmax=iaf_fmax,
+                window_length=savgol_window, polyorder=savgol_polyorder,
+                n_jobs=1, report=None):
+    """Estimate IAF for all resting files and write the long-format table.
+
+    Spectra are computed in parallel over files (and cached next to the
+    output table); the IAF estimates are then done in one batch. Returns
+    the table as a DataFrame with string keys and float values (NaN where
+    no IAF could be found, written as an empty field so any csv reader
+    gets a float column).
+    """
+    import numpy as np
+    import pandas as pd
+    from concurrent.futures import ProcessPoolExecutor
+
+    if report is None:
+        report = RunReport('02_iaf')
+    cache_dir = op.join(op.dirname(outfile), 'psd_cache')
+    iaf_files = list(iaf_files)
+
+    with report.stage('welch'):
+        if n_jobs > 1 and len(iaf_files) > 1:
+            with ProcessPoolExecutor(n_jobs) as ex:
+                spectra = list(ex.map(welch_psd, iaf_files, [cache_dir] * len(iaf_files)))
+        else:
+            spectra = [welch_psd(i, cache_dir) for i in iaf_files]
+
+    #Files sharing a frequency grid are estimated together
+    paf = np.full(len(iaf_files), np.nan)
+    cog = np.full(len(iaf_files), np.nan)
+    groups = {}
+    for n, (psd, freqs) in enumerate(spectra):
+        groups.setdefault(freqs.tobytes(), []).append(n)
+    with report.stage('savgol_iaf'):
+        for idx in groups.values():
+            freqs = spectra[idx[0]][1]
+            psds = np.array([spectra[n][0].mean(axis=0) for n in idx])
+            paf[idx], cog[idx] = savgol_iaf_batch(psds, freqs, fmin, fmax,
+                                                  window_length, polyorder)
+
+    rows = []
+    for n, i in enumerate(iaf_files):
+        subj, cond = parse_fname(i)
+        paf_n = None if np.isnan(paf[n]) else float(paf[n])
+        cog_n = None if np.isnan(cog[n]) else float(cog[n])
+        rows += iaf_rows(subj, cond, paf_n, cog_n)
+
+    iaf_table = pd.DataFrame(rows, columns=['subj', 'cond', 'measure', 'value'])
+    iaf_table = iaf_table.astype({'subj': str, 'cond': str, 'measure': str,
+                                  'value': np.float64})
+    with report.stage('write'):
+        iaf_table.to_csv(outfile, sep='\t', index=False)
+    return iaf_table
+
+def main():
+    # keep any plots off screen in batch runs
+    setup_backend()
+
+    # set working directory to where the raw EEG files are located 
+    os.chdir(data_dir) 
+    iaf_files = glob.glob(iaf_pattern) 
+
+    # record time and memory used by each processing step
+    report = RunReport('02_iaf')
+
+    compute_iaf(iaf_files, n_jobs=os.cpu_count() or 1, report=report)
+
+    # save the run report to spot slow steps and outlier participants
+    report.write('sigma\\reports\\02_iaf_report')
 
-outfile.close()
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -7,17 +7,14 @@ Created on Tue May 16 12:26:25 2023
 DNap Relationship (Sigma) 03: Time-Frequency Analysis  
 """
 
-import sys
-import mne
-import numpy as np
 import os.path as op
 import glob
-import pandas as pd
-import csv
 import os
-from path import Path
 
-from mne.time_frequency import tfr_morlet
+from dnap_profiling import RunReport
+from dnap_startup import setup_backend
+from dnap_windows import prefix_sums, window_means, window_samples
+from dnap_precision import check_tolerance, compute_dtype, precision_of
 
 def get_channel_name(epochs,ch_number):
     ch_name = epochs.ch_names[ch_number]
@@ -28,6 +25,9 @@ def drop_position(event_id):
     return new_id
 
 def compute_power(tf_all,epochs,freqs,ncycles,s_no,c_no):
+    import numpy as np
+    import pandas as pd
+    from mne.time_frequency import tfr_morlet
     tf = tfr_morlet(epochs[c_no], freqs=freqs,n_cycles=ncycles, return_itc=False, average=False)
     av = tf.data
     arr = np.column_stack(list(map(np.ravel, np.meshgrid(*map(np.arange, av.shape), indexing="ij"))) + [av.ravel()])
@@ -62,22 +62,16 @@ def add_windows(tf,epoch_tmin,epoch_tmax,windows,sfreq):
     tf_wins = tf.loc[mask_drop,]
     return tf_wins
 
-# set working directory to where the pre-processed EEG files are 
-os.chdir('E:\\DNap\\EEG\\sigma\\processed')
+# where the pre-processed EEG files are 
+processed_dir = 'E:\\DNap\\EEG\\sigma\\processed'
 
 #participants to exclude
 exclude = []
 
-#get lists of processed input files
-epoch_files = glob.glob('*_epo.fif.gz') 
-epoch_files_copy = glob.glob('*_epo.fif - Copy.gz')
-
 #toggle this to true if you want to overwrite already processed files
 #toggle this to false if you want to skip already processed files
 compute_from_scratch = False 
 
-tf_list = []
-
 #Define frequency bands and windows of interest
 bands = ["theta", "sigma"]
 # matching the window to the 30 second window 
@@ -85,67 +79,317 @@ windows = {"Prestim":(-200,-0.5),
         "Event":(0, 30000)
         }
 
-#Read in IAF data for individual frequency definition
-iaf_info = pd.read_table('iaf_long.txt',dtype = {'subj':str, 'measure':str, 'value':np.float64}, na_values = 'None')
-#Calculate mean across pre- and post-exp sessions
-iaf_info_means = iaf_info.groupby(['subj','cond','measure'],as_index=False).agg('mean')
-
-# extract theta and sigma power per epoch, per participant
-for e in epoch_files:
-    s_no = e.split('_')[0]
-    a = e.split('_')[1]
-    if e not in exclude:
-        print("processing subject no." + s_no + ". Condition:" + a)
-        
-        if op.exists('power\\' + s_no + "_" + a + '_sigma_sigma.csv'):
-            if not(compute_from_scratch):
-                print('skipping participant' + s_no + "-condition: " + a +': file already processed')
-                continue  
-        
+#Band power estimator: 'morlet' (time-resolved wavelets, averaged over the
+#windows) or 'welch'/'multitaper' (spectrum of each window, scaled to the
+#Morlet power; the estimator is saved with the power). Welch is about 2x
+#faster than morlet, multitaper about 2x slower
+estimator = 'morlet'
+#Welch segment length in seconds (sets the frequency resolution)
+welch_seg = 4.
+#Minimum correlation with the morlet path when validating an estimator
+validate_r = 0.9
+#Compute precision: 'double' or 'single' (float32, half the memory; see
+#dnap_precision for the tolerances against double)
+precision = 'double'
+
+def read_iaf_means(iaf_file='iaf_long.txt'):
+    """Read in IAF data for individual frequency definition."""
+    import numpy as np
+    import pandas as pd
+    iaf_info = pd.read_table(iaf_file,dtype = {'subj':str, 'measure':str, 'value':np.float64}, na_values = 'None')
+    #Calculate mean across pre- and post-exp sessions
+    return iaf_info.groupby(['subj','cond','measure'],as_index=False).agg('mean')
+
+def power_fname(s_no, a, b, power_dir='power'):
+    return op.join(power_dir, s_no+'_'+a+'_'+b+'_sigma.csv')
+
+def band_limits(iaf_info_means, s_no, a, b):
+    """Define frequency band limits based on IAF."""
+    band_lower = b + "_" + "lower"      
+    band_upper = b + "_" + "upper" 
+    sel = (iaf_info_means['subj'] == s_no) & (iaf_info_means['cond'] == a)
+    lower = float(iaf_info_means.value[sel & (iaf_info_means['measure'] == band_lower)].iloc[0])
+    upper = float(iaf_info_means.value[sel & (iaf_info_means['measure'] == band_upper)].iloc[0])
+    return lower, upper
+
+def morlet_window_power(data, sfreq, epoch_tmin, windows, lower, upper):
+    """Morlet power averaged over the band and over each window.
+
+    Returns the window names and an array (epochs, channels, windows).
+    """
+    import numpy as np
+    from mne.time_frequency import tfr_array_morlet
+
+    freqs = np.linspace(lower,upper,5)
+    ncycles = freqs/4
+    if precision_of(data) == 'single':
+        tf = morlet_power_single(data, sfreq, freqs, ncycles)
+    else:
+        tf = tfr_array_morlet(data, sfreq=sfreq, freqs=freqs,n_cycles=ncycles, output='power')
+    # average over frequencies, then window means from prefix sums over time
+    csum = prefix_sums(tf.mean(axis=2))
+    return window_means(csum, windows, epoch_tmin, sfreq)
+
+def morlet_power_single(data, sfreq, freqs, ncycles):
+    """Morlet power (epochs, channels, freqs, times) computed in float32.
+
+    Same wavelets and 'same'-mode convolution as tfr_array_morlet, which
+    only works in double precision. The signal FFT is taken once and
+    reused for every wavelet.
+    """
+    import numpy as np
+    from scipy import fft
+    from mne.time_frequency import morlet
+
+    data = np.asarray(data, dtype=np.float32)
+    n_times = data.shape[-1]
+    wavelets = morlet(sfreq, freqs, n_cycles=ncycles, zero_mean=True)
+    max_len = max(len(w) for w in wavelets)
+    if max_len > n_times:
+        raise ValueError('the %.1f Hz wavelet is longer than the epochs' % min(freqs))
+    n_fft = fft.next_fast_len(n_times + max_len - 1)
+    fft_data = fft.fft(data, n_fft, axis=-1)
+    tf = np.empty(data.shape[:-1] + (len(freqs), n_times), dtype=np.float32)
+    for k, w in enumerate(wavelets):
+        fft_w = fft.fft(w.astype(np.complex64), n_fft)
+        coefs = fft.ifft(fft_data * fft_w, axis=-1)
+        start = (len(w) - 1) // 2
+        coefs = coefs[..., start:start + n_times]
+        tf[..., k, :] = coefs.real ** 2 + coefs.imag ** 2
+    return tf
+
+def spectral_window_power(data, sfreq, epoch_tmin, windows, lower, upper, method='welch'):
+    """Mean band power between lower and upper, from the spectrum of each window.
+
+    The same windows as in the Morlet path are cut out of the epochs and a
+    Welch or multitaper spectrum is taken of each one, so no time-resolved
+    transform is needed. The density (V**2/Hz) is multiplied by sfreq,
+    which is the Morlet power of a spectrum that is flat over the wavelet
+    bandwidth; with the short wavelets (n_cycles = freqs/4) a steep
+    spectrum leaks more into the Morlet power, e.g. up to about 2x for
+    1/f**2 noise. Returns the window names and an array
+    (epochs, channels, windows).
+    """
+    import numpy as np
+    from mne.time_frequency import psd_array_welch, psd_array_multitaper
+
+    names, powers = [], []
+    n_times = data.shape[-1]
+    for name, window in windows.items():
+        start, stop = window_samples(window, epoch_tmin, sfreq)
+        start, stop = max(start, 0), min(stop, n_times)
+        if stop <= start:
+            continue
+        seg = data[..., start:stop]
+        if method == 'welch':
+            n_fft = min(seg.shape[-1], int(welch_seg*sfreq))
+            psd, freqs = psd_array_welch(seg, sfreq, fmin=lower, fmax=upper,
+                                         n_fft=n_fft, verbose=False)
+        elif method == 'multitaper':
+            psd, freqs = psd_array_multitaper(seg, sfreq, fmin=lower, fmax=upper,
+                                              normalization='full', verbose=False)
+        else:
+            raise ValueError("estimator must be 'morlet', 'welch' or "
+                             "'multitaper', got %r" % (method,))
+        if len(freqs) == 0:
+            raise ValueError('window %s is too short to resolve %.1f-%.1f Hz'
+                             % (name, lower, upper))
+        names.append(name)
+        powers.append(psd.mean(axis=-1) * sfreq)
+    return names, np.stack(powers, axis=-1)
+
+def window_power(data, sfreq, epoch_tmin, windows, lower, upper, estimator=estimator):
+    """Band power per epoch, channel and window with the chosen estimator."""
+    if estimator == 'morlet':
+        return morlet_window_power(data, sfreq, epoch_tmin, windows, lower, upper)
+    return spectral_window_power(data, sfreq, epoch_tmin, windows, lower, upper,
+                                 method=estimator)
+
+def compare_estimators(data, sfreq, epoch_tmin, windows, lower, upper, estimator='welch'):
+    """Correlate the log band power of an estimator with the Morlet path.
+
+    Agreement is the Pearson correlation of log power across epochs and
+    channels, per window. It is only high when the band power really
+    varies between epochs and channels; on stationary noise r only
+    measures the estimation noise of both paths and stays low (about
+    0.2-0.6 for Welch, 0.8 for multitaper on 30 s epochs). Returns a
+    dict of window name -> r.
+    """
+    import numpy as np
+
+    names, ref = morlet_window_power(data, sfreq, epoch_tmin, windows, lower, upper)
+    names_est, est = window_power(data, sfreq, epoch_tmin, windows, lower, upper, estimator)
+    r = {}
+    for n, name in enumerate(names):
+        x = np.log(ref[..., n]).ravel()
+        y = np.log(est[..., names_est.index(name)]).ravel()
+        r[name] = float(np.corrcoef(x, y)[0, 1])
+    return r
+
+def epochs_data(epochs, precision=precision):
+    """Data of (not preloaded) epochs in the compute dtype.
+
+    In single precision the epochs are read one at a time into a float32
+    array, so the float64 data of the whole file is never held next to
+    it. The epochs are saved in single precision, so nothing is lost.
+    """
+    import numpy as np
+    dtype = compute_dtype(precision)
+    if dtype == np.float64:
+        return epochs.get_data()
+    data = np.empty((len(epochs.events), len(epochs.ch_names), len(epochs.times)),
+                    dtype=dtype)
+    n = 0
+    for epoch in epochs:
+        data[n] = epoch
+        n += 1
+    return data[:n]
+
+def tfa_file(e, iaf_info_means, bands=bands, windows=windows, power_dir='power',
+             estimator=estimator, validate=False, precision=precision, report=None):
+    """Extract band power per epoch for one pre-processed epochs file.
+
+    iaf_info_means is the output of read_iaf_means or the name of the IAF
+    table. estimator is 'morlet' (the full time-frequency transform) or
+    'welch'/'multitaper' (spectra of each window); with validate=True the
+    faster estimators are also checked against the Morlet path.
+    precision='single' computes in float32 (see dnap_precision); with
+    validate=True it is then also checked against the double path. Writes
+    one csv per band to power_dir and returns the list of per-band
+    dataframes.
+    """
+    import mne
+
+    if report is None:
+        report = RunReport('03_tfa')
+    if isinstance(iaf_info_means, str):
+        iaf_info_means = read_iaf_means(iaf_info_means)
+    s_no = op.basename(e).split('_')[0]
+    a = op.basename(e).split('_')[1]
+    report.subject(s_no + "_" + a)
+
+    with report.stage('read'):
         #read in epochs 
-        epochs = mne.read_epochs(e, preload=True)
-        
-        #initialise dataframe for tf output
-        tf_all = pd.DataFrame()
-        
-        # calculate power per band 
-        for b in bands:
-            print("processing "+ b + " band")
-            #Define frequency band limits based on IAF 
-            band_lower = b + "_" + "lower"      
-            band_upper = b + "_" + "upper" 
-            lower = float(iaf_info_means.value[(iaf_info_means['subj'] == s_no) & (iaf_info_means['measure'] == band_lower) & (iaf_info_means['cond'] == a)])
-            upper = float(iaf_info_means.value[(iaf_info_means['subj'] == s_no) & (iaf_info_means['measure'] == band_upper) & (iaf_info_means['cond'] == a)])
-            
-            freqs = np.linspace(lower,upper,5)
-            ncycles = freqs/4
+        epochs = mne.read_epochs(e, preload=False)
+        data = epochs_data(epochs, precision)
+    sfreq = epochs.info['sfreq']
+    if validate and precision == 'single':
+        if not check_tolerance('data', epochs.get_data(), data):
+            print('WARNING: single precision data out of tolerance for subject %s (%s)'
+                  % (s_no, a))
+    
+    band_means = []
+    
+    # calculate power per band 
+    for b in bands:
+        print("processing "+ b + " band")
+        lower, upper = band_limits(iaf_info_means, s_no, a, b)
 
-            tf_list = []
-            
-            # calculate power and output to a dataframe
+        # calculate power and output to a dataframe
+        with report.stage('wavelet' if estimator == 'morlet' else estimator):
             print("processing")
-            tf = mne.time_frequency.tfr_array_morlet(epochs.get_data(), sfreq=epochs.info['sfreq'], freqs=freqs,n_cycles=ncycles, output='power')
-            df = pd.DataFrame(np.column_stack(list(map(np.ravel, np.meshgrid(*map(np.arange, tf.shape), indexing="ij"))) + [tf.ravel()]), columns = ['epoch','channel', 'frequency', 'time','power'])
-            df['subj'] = s_no
-            df['band'] = b
-            df['condition'] = a
-            tf_list.append(df)
-                
-            # export the current dataframe 
-            tf_all = pd.concat(tf_list)
-            tf_all_wins = add_windows(tf_all,epochs.tmin,epochs.tmax,windows,epochs.info['sfreq'])
-            tf_all_sel = tf_all_wins.drop(['frequency','time'],axis=1)
-            tf_means = tf_all_sel.groupby(['epoch','channel','subj', 'condition', 'win','band'],as_index=False).agg('mean')
-            tf_means['ch_name'] = tf_means.apply(lambda row: get_channel_name(epochs,int(row['channel'])), axis=1)
-            filepath = 'power\\'+s_no+'_'+a+'_'+b+'_sigma.csv'
-            tf_means.to_csv(filepath,index=False)
+            win_names, means = window_power(data, sfreq, epochs.tmin, windows,
+                                            lower, upper, estimator)
+        if validate and estimator != 'morlet':
+            with report.stage('validate'):
+                r = compare_estimators(data, sfreq, epochs.tmin, windows, lower, upper, estimator)
+            for name, r_win in r.items():
+                print('%s vs morlet, %s band, %s window: r = %.3f' % (estimator, b, name, r_win))
+                if r_win < validate_r:
+                    print('WARNING: %s power disagrees with morlet for subject %s (%s)'
+                          % (estimator, s_no, a))
+        if validate and precision == 'single':
+            with report.stage('validate'):
+                _, ref = window_power(epochs.get_data(), sfreq, epochs.tmin, windows,
+                                      lower, upper, estimator)
+            if not check_tolerance('window', ref, means):
+                print('WARNING: single precision power out of tolerance for subject %s (%s)'
+                      % (s_no, a))
+        with report.stage('window-reduce'):
+            tf_means = window_frame(means, win_names, epochs.ch_names)
+            tf_means.insert(2, 'subj', s_no)
+            tf_means.insert(3, 'condition', a)
+            tf_means.insert(5, 'band', b)
+            tf_means['estimator'] = estimator
+        with report.stage('write'):
+            tf_means.to_csv(power_fname(s_no, a, b, power_dir),index=False)
+        band_means.append(tf_means)
+    return band_means
+
+def window_frame(means, win_names, ch_names):
+    """Long-format table of window means of shape (epochs, channels, windows).
+
+    Rows are ordered and typed like the groupby output of add_windows.
+    """
+    import numpy as np
+    import pandas as pd
+
+    order = np.argsort(win_names, kind='stable')
+    means = means[..., order]
+    win_names = np.asarray(win_names, dtype=object)[order]
+    epoch, channel, win = np.meshgrid(*map(np.arange, means.shape), indexing="ij")
+    return pd.DataFrame({'epoch': epoch.ravel().astype(np.float64),
+                         'channel': channel.ravel().astype(np.float64),
+                         'win': win_names[win.ravel()],
+                         'power': means.ravel(),
+                         'ch_name': np.asarray(ch_names, dtype=object)[channel.ravel()]})
+
+def append_csv(df_export, fname):
+    """Add a dataframe to a larger csv with all bands and participants."""
+    if op.isfile(fname):
+        df_export.to_csv(fname, sep = ',', mode = 'a', header = False,
+                         index = False)
+    else:
+        df_export.to_csv(fname, sep = ',', mode = 'a', header = True,
+                         index = False)
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='DNap Relationship (Sigma) 03: Time-Frequency Analysis')
+    parser.add_argument('--estimator', default=estimator,
+                        choices=['morlet', 'welch', 'multitaper'])
+    parser.add_argument('--validate', action='store_true',
+                        help='check the estimator against the morlet path and '
+                             'single against double precision')
+    parser.add_argument('--precision', default=precision,
+                        choices=['double', 'single'])
+    args = parser.parse_args()
+
+    setup_backend()
+
+    # set working directory to where the pre-processed EEG files are 
+    os.chdir(processed_dir)
+
+    #get lists of processed input files
+    epoch_files = glob.glob('*_epo.fif.gz') 
+
+    iaf_info_means = read_iaf_means('iaf_long.txt')
+
+    # record time and memory used by each processing step
+    report = RunReport('03_tfa')
+
+    # extract theta and sigma power per epoch, per participant
+    for e in epoch_files:
+        s_no = e.split('_')[0]
+        a = e.split('_')[1]
+        if e not in exclude:
+            print("processing subject no." + s_no + ". Condition:" + a)
+            
+            if op.exists(power_fname(s_no, a, 'sigma')):
+                if not(compute_from_scratch):
+                    print('skipping participant' + s_no + "-condition: " + a +': file already processed')
+                    continue  
             
-            # add the current dataframe to a larger dataframe with all bands and participants 
-            df_export = pd.DataFrame(tf_means)
-            if op.isfile('sigma_power.csv'):
-                df_export.to_csv('sigma_power.csv', sep = ',', mode = 'a', header = False,
-                                 index = False)
-            else:
-                df_export.to_csv('sigma_power.csv', sep = ',', mode = 'a', header = True,
-                                 index = False)
-    
\ No newline at end of file
+            for tf_means in tfa_file(e, iaf_info_means, estimator=args.estimator,
+                                     validate=args.validate, precision=args.precision,
+                                     report=report):
+                # add the current dataframe to a larger dataframe with all bands and participants 
+                with report.stage('write'):
+                    append_csv(tf_means, 'sigma_power.csv')
+
+    # save the run report to spot slow steps and outlier participants
+    report.write('reports\\03_tfa_report')
+
+if __name__ == '__main__':
+    main()
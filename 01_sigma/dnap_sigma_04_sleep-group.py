@@ -9,60 +9,110 @@ Functions from YASA (Vallet, 2020; https://github.com/raphaelvallat/yasa)
 Authors: Alex Chatburn (the Serpent King)
 
 """
-import mne
-import yasa
 import os
 import os.path as op
-import seaborn as sns
-import matplotlib.pyplot as plt
 import glob
-import pandas as pd
-import numpy as np
-import pingouin as pg
-from tensorpac import Pac
-from pandas import read_csv
-
-sns.set(style='white', font_scale=1.2)
-
-# set the working directoy where the raw eeg files are located
-os.chdir('D:\\DNap\\EEG')
+from dnap_profiling import RunReport
+from dnap_startup import setup_backend
+from dnap_precision import check_table, check_tolerance, compute_dtype
+from dnap_artifacts import stream_art_detect
+from dnap_windows import interval_windows
+from dnap_stages import planned_fraction, restrict, stage_plan, to_recording_time
+from dnap_events import clean_minutes, events_fname, save_events
+from dnap_coupling import add_coupling, coupling_topography
+
+# where the raw eeg files and the pre-processed files are located
+raw_dir = 'D:\\DNap\\EEG'
+processed_dir = 'D:\\DNap\\EEG\\processed\\'
 
 # create list of sleep EEG files
 # need to create two lists for .vhdr files and files that were appended
-sleep_files = glob.glob('*_int_nap.vhdr')
+sleep_pattern = '*_int_nap.vhdr'
 
 #toggle this to true if you want to overwrite already processed files
 #toggle this to false if you want to skip already processed files
 compute_from_scratch = False
 
+# filter band for the pre-processing
+l_freq, h_freq = 0.3, 30.
+
+# set parameters for analysis
+sf_art   = 1/5
+sf_hypno = 1/30
+sf       = 100
+
+# covariance artifact detection: read the nap in blocks of art_block seconds
+# instead of all at once (same result as yasa.art_detect)
+stream_artifacts = True
+art_block = 600.
+
+# compute precision of the nap data: 'double' or 'single' (float32, half
+# the memory; band power, detection and PAC still run in float64 inside
+# yasa/tensorpac)
+precision = 'double'
+
+# with precision='single', also compute band power and detections on the
+# double precision nap and check them against the dnap_precision
+# tolerances (takes about twice as long)
+validate_precision = False
+
+# run the slow wave detection only on the N3 intervals, padded by
+# stage_pad seconds (see dnap_stages), so wake, N1 and N2 are not filtered
+# for nothing; the slow waves are the same as on the whole nap (to 1e-9).
+# Spindles and coupling always run on the whole nap: yasa's moving RMS
+# grid moves some spindle onsets by one sample on a cropped nap, and the
+# coupling phase/ndPAC come from a Hilbert transform over all the input
+restrict_stages = True
+stage_pad = 30.
+
+# spindle detection thresholds (yasa.spindles_detect thresh)
+sp_thresh = {'rel_pow': 0.2, 'corr': 0.65, 'rms': 1.5}
+
+# PAC comodulogram grid: (start, stop, step) of the phase and amplitude
+# frequencies in Hz
+pac_pha = (0.125, 4.25, 0.25)
+pac_amp = (7.5, 25.5, 0.5)
+
+# create a list of the channels we want to include
+chans = ['Fz','F3','F4','Cz','C3','C4','Pz','P3','P4','O1','O2']
+
+# montage used to plot the coupling topographies
+montage_name = 'standard_1020'
+
+# SO-spindle coupling: channel of the per-stage table, circular plots and
+# PAC comodulograms; the coupling itself is computed on all chans, with
+# the sigma filtering and Hilbert transforms spread over n_jobs
+coupling_chan = 'Cz'
+n_jobs = os.cpu_count() or 1
+
+# list the cases here that you want to process  
+process_cases = ["30"]
+
+# output folders for the analysis of each subject
+folder_list = ['spectrogram', 'spindle', 'so', 'power', 'coupling', 'events']
+
 ## ---------------------------------------------------------------------------
 ## Basic Pre-Processing
 ## ---------------------------------------------------------------------------
 
-# loop through each file for each subject
-# be sure to change 'appended_files' to 'sleep_files' and vice versa
-for s in sleep_files:
-    print("processing file " + s)
-    subj = op.split(s)[1][0:2] 
-    
-    if op.exists('processed/' + subj + '_nap' + '_raw.fif.gz'):
-        if not(compute_from_scratch):
-            print('skipping participant' + subj + ': file already exists')
-            continue
-        
-    outfile = 'processed/' + subj + '_nap' + '_raw.fif.gz'
-    
+def nap_fname(subj, out_dir='processed'):
+    return op.join(out_dir, subj + '_nap' + '_raw.fif.gz')
+
+def read_reference_nap(s):
+    """Read a raw nap, downsample it to 100 Hz and re-reference it."""
+    import mne
     # read in raw sleep EEG data
     raw = mne.io.read_raw_brainvision(s, eog=('E1','E2'), misc=('EMG1','EMG2','EMG3', 'ECG'), preload=True)
-    
+
     # downsample to 100 Hz
     raw = raw.resample(100)
-    
+
     # re-reference to linked mastoids
-    raw = mne.io.set_eeg_reference(raw,['M1','M2'])[0]
+    return mne.io.set_eeg_reference(raw,['M1','M2'])[0]
 
+def filter_nap_raw(raw, l_freq=l_freq, h_freq=h_freq):
     # apply basic pre-processing parameters
-    raw = raw.filter(0.3, 30.,
+    raw = raw.filter(l_freq, h_freq,
                     l_trans_bandwidth='auto',
                      h_trans_bandwidth='auto',
                      filter_length='auto',
@@ -70,113 +120,175 @@ for s in sleep_files:
                      fir_window='hamming',
                      phase='zero',
                      n_jobs=2)
-    
+
     # label mastoids and horizontal EOG as miscellaneous
     raw.set_channel_types({'M1':'misc','M2':'misc'})
+    return raw
+
+def preprocess_nap(s, outfile, l_freq=l_freq, h_freq=h_freq, report=None):
+    """Read, downsample, re-reference and filter one nap recording."""
+    if report is None:
+        report = RunReport('04_sleep')
+    report.subject(op.split(s)[1][0:2])
+
+    with report.stage('preproc'):
+        raw = filter_nap_raw(read_reference_nap(s), l_freq, h_freq)
     
-    # save pre-processed EEG file
-    raw.save(outfile,fmt='single',overwrite=True)
-    
+        # save pre-processed EEG file
+        raw.save(outfile,fmt='single',overwrite=True)
+    return outfile
+
+# preprocess_nap in two steps with a checkpoint in between, for the
+# parameter sweep (dnap_sweep.py)
+
+def reference_nap(s, outfile, report=None):
+    """Save the downsampled, re-referenced nap (double precision)."""
+    if report is None:
+        report = RunReport('04_sleep')
+    report.subject(op.split(s)[1][0:2])
+    with report.stage('preproc'):
+        read_reference_nap(s).save(outfile, fmt='double', overwrite=True)
+    return outfile
+
+def filter_nap(raw_file, outfile, l_freq=l_freq, h_freq=h_freq, report=None):
+    """Filter a reference_nap checkpoint and save the pre-processed nap."""
+    import mne
+    if report is None:
+        report = RunReport('04_sleep')
+    with report.stage('preproc'):
+        raw = mne.io.read_raw_fif(raw_file, preload=True)
+        filter_nap_raw(raw, l_freq, h_freq).save(outfile, fmt='single',
+                                                  overwrite=True)
+    return outfile
+
 ## ---------------------------------------------------------------------------
 ## Covariance-Based Artifact Rejection and Spectrogram Generation 
 ## ---------------------------------------------------------------------------
-    
-# list raw EEG and hypnogram files in chronological order so they are matched
-# doesn't work. nothing works. need help.
-os.chdir('D:\\DNap\\EEG\\processed\\')
-
-art_files = glob.glob(os.path.join('*_nap_raw.fif.gz'))
-
-# set parameters for analysis
-sf_art   = 1/5
-sf_hypno = 1/30
-sf       = 100
-
-# create a list of the channels we want to include
-chans = ['Fz','F3','F4','Cz','C3','C4','Pz','P3','P4','O1','O2']
 
-# toggle this to true if you want to overwrite the processed files
-compute_from_scratch = False
+def read_nap(a, hypno_file, precision='double'):
+    """Load the pre-processed nap and its hypnogram upsampled to 100 Hz.
 
-# list the cases here that you want to process  
-process_cases = ["30"]
-
-# load data and hypnogram
-for a in sorted(art_files, key=lambda s: s.lower()): 
-    print("processing file " + a)
-    subj = op.split(a)[1][0:2] 
-    
-    if subj not in process_cases:
-        if not(compute_from_scratch):
-            print('skipping participant ' + subj)
-            continue
-    
+    In single precision the channels are read one at a time into a
+    float32 array, so the float64 nap is never held next to it.
+    """
+    import mne
+    import yasa
+    import numpy as np
+    import pandas as pd
     f = mne.io.read_raw_fif(a)
-    data = f.get_data(picks=['Fz', 'F3', 'F4', 'Cz', 'C3', 'C4', 'Pz', 'P3', 'P4', 'O1', 'O2'])
-    hypno_file = 'D:\\DNap\\EEG\\processed\\' + subj + '_hyp.csv'
+    if compute_dtype(precision) == np.float64:
+        data = f.get_data(picks=chans)
+    else:
+        data = np.empty((len(chans), f.n_times), dtype=compute_dtype(precision))
+        for i, ch in enumerate(chans):
+            data[i] = f.get_data(picks=ch)[0]
     #hypno = yasa.load_profusion_hypno(hypno_file, replace=True)
     hypno = pd.read_csv(hypno_file)
     hypno = hypno.squeeze('columns') 
     
     # up sample hypnogram to match sampling rate of data (100 Hz)
     hypno = yasa.hypno_upsample_to_data(hypno, sf_hypno, data, sf)
+    return f, data, hypno
 
-    # run artifact rejection based on z scores
-    art, zscores = yasa.art_detect(f, sf, window=5, hypno=hypno, 
-                           include=(1, 2, 3, 4), method='covar', 
-                           threshold=3, verbose='info')
+def detect_artifacts(f, hypno, streaming=stream_artifacts):
+    """Return the hypnogram with -1 marking rejected 5-s windows.
 
+    With streaming=True the recording is read art_block seconds at a time
+    (see dnap_artifacts), otherwise yasa.art_detect loads all of it.
+    """
+    import yasa
+    # run artifact rejection based on z scores
+    if streaming:
+        art, zscores = stream_art_detect(f, window=5, hypno=hypno,
+                                         include=(1, 2, 3, 4), threshold=3,
+                                         block_sec=art_block)
+    else:
+        art, zscores = yasa.art_detect(f, sf, window=5, hypno=hypno, 
+                               include=(1, 2, 3, 4), method='covar', 
+                               threshold=3, verbose='info')
 
     art_up = yasa.hypno_upsample_to_data(art, sf_art, f, sf)
 
     # Add -1 to hypnogram to indicate rejected epochs
     hypno_with_art = hypno.copy()
     hypno_with_art[art_up] = -1
+    return hypno_with_art
 
+def plot_hypno_spectrogram(data, hypno, subj, out_dir='.'):
+    import yasa
+    import seaborn as sns
+    import matplotlib.pyplot as plt
     # plot the whole night of sleep and save the figure into folder 'spectrogram'
     plot_1 = yasa.plot_spectrogram(data[0, :], sf, hypno, cmap='viridis',
                            trimperc=5)
     sns.despine()
-    plt.savefig('spectrogram/' + subj + '_hypno.png', dpi=300)
-
-    # adapt scaling of data by converting to microvolts (uV)
-    data = data * 1e6
+    plt.savefig(op.join(out_dir, 'spectrogram', subj + '_hypno.png'), dpi=300)
+    plt.close('all')
+
+def stage_data(data, hypno, include, restricted=restrict_stages):
+    """Data and hypnogram of the padded include intervals, and their plan.
+
+    Event times of a detection run on the returned data are relative to
+    the restricted data; dnap_stages.to_recording_time maps them back.
+    """
+    if not restricted:
+        return data, hypno, [(0, len(hypno))]
+    plan = stage_plan(hypno, include, sf, pad=stage_pad)
+    print('computing on %.0f%% of the nap for stage(s) %s'
+          % (100 * planned_fraction(plan, len(hypno)), include))
+    data, hypno = restrict(data, hypno, plan)
+    return data, hypno, plan
+
+def save_event_table(det, plan, hypno, subj, kind, out_dir='.'):
+    """Keep every detected event (recording time) for later summaries."""
+    events = to_recording_time(det.summary(), plan, sf)
+    return save_events(events, events_fname(subj, kind, op.join(out_dir, 'events')),
+                       subj, clean_minutes(hypno, sf))
 
 ## ---------------------------------------------------------------------------
 ## Spindle Detection
 ## ---------------------------------------------------------------------------
 
+def detect_spindles(data, hypno_with_art, subj, out_dir='.', thresh=sp_thresh):
+    import yasa
+    import seaborn as sns
+    import matplotlib.pyplot as plt
     # run spindle detection algorithm for stage 2 and sws (N2, N3)
-    sp = yasa.spindles_detect(data, sf, ch_names=chans, hypno=hypno_with_art, 
-                          include=(2, 3))
+    # (on the whole nap, see restrict_stages)
+    data_stage, hypno_stage, plan = stage_data(data, hypno_with_art, (2, 3),
+                                               restricted=False)
+    sp = yasa.spindles_detect(data_stage, sf, ch_names=chans, hypno=hypno_stage, 
+                          include=(2, 3), thresh=thresh)
+    save_event_table(sp, plan, hypno_with_art, subj, 'spindles', out_dir)
 
     # extract spindle metrics and add subject code to data structure
     sp_data = sp.summary(grp_chan=True, grp_stage=True, aggfunc='median').round(3)
     sp_data['subj'] = subj
 
     # save output file for each subject into folder 'spindle'
-    sp_data.to_csv('spindle/' + subj + '_spindle.csv', header = True)
+    sp_data.to_csv(op.join(out_dir, 'spindle', subj + '_spindle.csv'), header = True)
 
     # plot average spindle and save figure to folder 'spindle'
     ax = sp.plot_average(center='Peak', time_before=0.8, time_after=0.8, 
                      filt=(12, 16), ci=None, legend=False)
     sns.despine()
-    plt.savefig('spindle/' + subj + '_spindle.png', dpi=300)
-    
-    # append each subject to grand .csv file
-    df_export = pd.DataFrame(sp_data)
-    if op.isfile('slow_waves.csv'):
-        df_export.to_csv('spindles.csv', sep=',', mode='a', header=False)
-    else:
-        df_export.to_csv('spindles.csv', sep=',', mode='a', header=True)
+    plt.savefig(op.join(out_dir, 'spindle', subj + '_spindle.png'), dpi=300)
+    plt.close('all')
+    return sp, sp_data
 
 ## ---------------------------------------------------------------------------
 ## Slow Wave Detection
 ## ---------------------------------------------------------------------------
 
+def detect_slow_waves(data, hypno_with_art, subj, out_dir='.'):
+    import yasa
+    import seaborn as sns
+    import matplotlib.pyplot as plt
     # run slow wave detection algorithm for sws (N3)
-    sw = yasa.sw_detect(data, sf, ch_names=chans, hypno=hypno_with_art, 
+    data_stage, hypno_stage, plan = stage_data(data, hypno_with_art, 3)
+    sw = yasa.sw_detect(data_stage, sf, ch_names=chans, hypno=hypno_stage, 
                     include=(3))
+    save_event_table(sw, plan, hypno_with_art, subj, 'slow_waves', out_dir)
 
     # extract slow wave metrics and add subject code to data structure
     so_data = sw.summary(grp_chan=True, grp_stage=True, aggfunc='median').round(3)
@@ -184,70 +296,78 @@ for a in sorted(art_files, key=lambda s: s.lower()):
     print(sw.summary().shape[0], 'slow-waves detected.')
 
     # save output file for each subject into folder 'so'
-    so_data.to_csv('so/' + subj + '_so.csv', header = True)
+    so_data.to_csv(op.join(out_dir, 'so', subj + '_so.csv'), header = True)
 
     # plot the slow waves with confidence intervals and save to folder 'so'
     ax2 = sw.plot_average(center="Start", time_before=2.5, time_after=2.5, 
                       legend = False)
     sns.despine()
-    plt.savefig('so/' + subj + '_SW.png', dpi=300)
-
-    # append each subject to grand .csv file
-    df_export = pd.DataFrame(so_data)
-    if op.isfile('slow_waves.csv'):
-        df_export.to_csv('slow_waves.csv', sep=',', mode='a', header=False)
-    else:
-        df_export.to_csv('slow_waves.csv', sep=',', mode='a', header=True)
+    plt.savefig(op.join(out_dir, 'so', subj + '_SW.png'), dpi=300)
+    plt.close('all')
+    return sw, so_data
          
 ## ---------------------------------------------------------------------------
 ## Band Power Analysis
 ## ---------------------------------------------------------------------------
-    
+
+def compute_bandpower(data, hypno_with_art, subj, out_dir='.'):
+    import yasa
     power = yasa.bandpower(data, sf=sf, hypno=hypno_with_art, ch_names=chans, 
                             include=(2,3,4))
     power['subj'] = subj
-    
-    # append each subject to grand .csv file
-    df_export = pd.DataFrame(power)
-    if op.isfile('power.csv'):
-         df_export.to_csv('power.csv', sep=',', mode='a', header=False)
-    else:
-         df_export.to_csv('power.csv', sep=',', mode='a', header=True)
-
+    power.to_csv(op.join(out_dir, 'power', subj + '_power.csv'), header = True)
+    return power
 
 ## ---------------------------------------------------------------------------
 ## Slow Wave and Spindle Coupling
 ## ---------------------------------------------------------------------------
 
-    # only use channel Cz to reduce computational complexity
-    data_cz = data[3, :].astype(np.float64)
+def compute_coupling(data, hypno, subj, out_dir='.'):
+    import yasa
+    import numpy as np
+    import pingouin as pg
+    import seaborn as sns
+    import matplotlib.pyplot as plt
+    # channel used for the per-stage table and PAC
+    # (kept in the compute precision, yasa converts to float64 itself)
+    data_cz = data[chans.index(coupling_chan), :]
     print(data_cz.shape, np.round(data_cz[0:5], 3))
 
-    # run slow wave and spindle detection function on stage 2 and sws (N2, N3)
-    coup = yasa.sw_detect(data_cz, sf, hypno=hypno, include=(2, 3), 
-                    coupling=True)#, freq_sp=(12, 16))
+    # run slow wave detection on stage 2 and sws (N2, N3) on all channels,
+    # then add the spindle coupling of every channel in one batched pass
+    # (same values as yasa.sw_detect(coupling=True), see dnap_coupling;
+    # on the whole nap, see restrict_stages)
+    data_stage, hypno_stage, plan = stage_data(data, hypno, (2, 3),
+                                               restricted=False)
+    sw = yasa.sw_detect(data_stage, sf, ch_names=chans, hypno=hypno_stage,
+                        include=(2, 3))
+    coup = add_coupling(sw, n_jobs)
+    save_event_table(coup, plan, hypno, subj, 'coupling', out_dir)
 
     # create data structure containing each coupling event
-    events = coup.summary()
+    events_all = coup.summary()
+    mask = (events_all['Channel'] == coupling_chan).to_numpy()
+    events = events_all[mask]
 
     # group data by sleep stage
-    out = coup.summary(grp_stage=True).round(3)
+    out = coup.summary(grp_stage=True, mask=mask).round(3)
 
     # add column for subject code
     out['subj'] = subj
-    
-    # append each subject to grand .csv file
-    df_export = pd.DataFrame(out)
-    if op.isfile('coupling.csv'):
-        df_export.to_csv('coupling.csv', sep=',', mode='a', header=False)
-    else:
-        df_export.to_csv('coupling.csv', sep=',', mode='a', header=True)
+    out.to_csv(op.join(out_dir, 'coupling', subj + '_coupling.csv'), header = True)
+
+    # same per channel
+    out_chan = coup.summary(grp_chan=True, grp_stage=True).round(3)
+    out_chan['subj'] = subj
+    out_chan.to_csv(op.join(out_dir, 'coupling', subj + '_coupling_chan.csv'),
+                    header = True)
+    plot_coupling_topography(events_all, subj, out_dir)
         
     # plot circular histogram to visualise coupling
     plt.figure()
     circ2 = pg.plot_circmean(events['PhaseAtSigmaPeak'])
     sns.despine()
-    plt.savefig('coupling/' + subj + '_circ.png', dpi=300)
+    plt.savefig(op.join(out_dir, 'coupling', subj + '_circ.png'), dpi=300)
     plt.close();
 
     print('Circular mean: %.3f rad' % pg.circ_mean(events['PhaseAtSigmaPeak']))
@@ -257,23 +377,72 @@ for a in sorted(art_files, key=lambda s: s.lower()):
     plt.figure()
     hist = events['ndPAC'].hist()
     sns.despine()
-    plt.savefig('coupling/' + subj + '_histogram.png', dpi=300)
+    plt.savefig(op.join(out_dir, 'coupling', subj + '_histogram.png'), dpi=300)
     plt.close();
 
     # this should be close to the vector length that we calculated above
     events['ndPAC'].mean()
-    
+    return data_cz, out, out_chan
+
+def plot_coupling_topography(events, subj, out_dir='.'):
+    """Topomaps of the vector length and mean ndPAC of each channel.
+
+    Channels without slow waves (or without coupling values) are left out
+    of the map of that value.
+    """
+    import mne
+    import matplotlib.pyplot as plt
+    topo = coupling_topography(events).reindex(chans)
+
+    fig, axes = plt.subplots(1, 2, figsize=(8, 4))
+    for ax, column in zip(axes, ['VectorLength', 'ndPAC']):
+        values = topo[column].dropna()
+        info = mne.create_info(list(values.index), sf, 'eeg')
+        info.set_montage(montage_name)
+        mne.viz.plot_topomap(values.to_numpy(), info, axes=ax,
+                             cmap='viridis', show=False)
+        ax.set_title(column)
+    plt.savefig(op.join(out_dir, 'coupling', subj + '_coupling_topo.png'), dpi=300)
+    plt.close(fig)
+    return topo
+
+def pac_epochs(p, views):
+    """PAC of the epochs in a list of epoch views, (amp, phase, epochs).
+
+    Phase and amplitude are filtered view by view and fitted together, as
+    the Tort MI normalises the phase bins over all epochs.
+    """
+    import numpy as np
+    kw = dict(keepfilt=False, n_jobs=1)
+    pha = np.concatenate([p.filter(sf, v, 'phase', **kw) for v in views], axis=1)
+    amp = np.concatenate([p.filter(sf, v, 'amplitude', **kw) for v in views], axis=1)
+    return p.fit(pha, amp)
+
+def compute_pac(data_cz, hypno, subj, out_dir='.', report=None,
+                f_pha=pac_pha, f_amp=pac_amp):
+    """Comodulograms of N3 phase-amplitude coupling (MVL and Tort MI)."""
+    import numpy as np
+    import pandas as pd
+    import seaborn as sns
+    import matplotlib.pyplot as plt
+    from tensorpac import Pac
+
+    if report is None:
+        report = RunReport('04_sleep')
+
     # calculate data-driven phase amplitide coupling (PAC)
 
     # segment N3 sleep into 15-seconds non-overlapping epochs
-    _, data_cz_N3 = yasa.sliding_window(data_cz[hypno == 3], sf, window=15)
+    # (views of each N3 interval, no copy and no epoch spanning two intervals)
+    data_cz_N3 = [view for _, view in
+                  interval_windows(data_cz, sf, 15, mask=np.asarray(hypno) == 3)]
 
     # we end up with x number of epochs of 15-seconds
-    data_cz_N3.shape
+    print('%d N3 epochs of 15 s' % sum(len(v) for v in data_cz_N3))
 
     # first, let's define our array of frequencies for phase and amplitude
-    f_pha = np.arange(0.125, 4.25, 0.25)  # frequency for phase
-    f_amp = np.arange(7.5, 25.5, 0.5)     # frequency for amplitude
+    f_pha = np.arange(*f_pha)  # frequency for phase
+    f_amp = np.arange(*f_amp)  # frequency for amplitude
 
     f_pha, f_amp
 
@@ -284,13 +453,14 @@ for a in sorted(art_files, key=lambda s: s.lower()):
     p = Pac(idpac=(1, 0, 0), f_pha=f_pha, f_amp=f_amp, verbose='WARNING')
 
     # filter the data and extract the PAC values 
-    xpac1 = p.filterfit(sf, data_cz_N3)
+    with report.stage('PAC'):
+        xpac1 = pac_epochs(p, data_cz_N3)
 
     # plot the comodulogram
     plt.figure()
     como1 = p.comodulogram(xpac1.mean(-1), title=str(p), vmin=0, plotas='imshow')
     sns.despine()
-    plt.savefig('coupling/' + subj + '_coupling_mvl.png', dpi=300)
+    plt.savefig(op.join(out_dir, 'coupling', subj + '_coupling_mvl.png'), dpi=300)
     plt.close();
     
     # extract PAC values into a data frame - no need to save this for now
@@ -305,13 +475,14 @@ for a in sorted(art_files, key=lambda s: s.lower()):
     p2 = Pac(idpac=(2, 0, 0), f_pha=f_pha, f_amp=f_amp, verbose='WARNING')
 
     # filter the data and extract the PAC values
-    xpac2 = p2.filterfit(sf, data_cz_N3)
+    with report.stage('PAC'):
+        xpac2 = pac_epochs(p2, data_cz_N3)
 
     # plot the comodulogram and save it
     plt.figure()
     como2 = p2.comodulogram(xpac2.mean(-1), title=str(p2), plotas='imshow')
     sns.despine()
-    plt.savefig('coupling/' + subj + '_coupling_Tort.png', dpi=300)
+    plt.savefig(op.join(out_dir, 'coupling', subj + '_coupling_Tort.png'), dpi=300)
     plt.close();
 
     # extract PAC values into a data frame - no need to save this for now
@@ -319,31 +490,194 @@ for a in sorted(art_files, key=lambda s: s.lower()):
     df_pac2.columns.name = 'FreqPhase'
     df_pac2.index.name = 'FreqAmplitude'
     df_pac2.round(3)
+    return df_pac, df_pac2
+
+def check_precision(ref, data, hypno_with_art, sp, sw, power, thresh=sp_thresh):
+    """Check single precision nap results against the double precision path.
+
+    ref and data are the nap in double and single precision (uV); sp, sw
+    and power the detections and band power computed from data. Returns
+    True if everything is within the dnap_precision tolerances.
+    """
+    import yasa
+    ok = check_tolerance('data', ref, data)
+
+    power_ref = yasa.bandpower(ref, sf=sf, hypno=hypno_with_art, ch_names=chans,
+                               include=(2,3,4))
+    ok &= check_table('bandpower', power_ref, power)
+
+    data_stage, hypno_stage, _ = stage_data(ref, hypno_with_art, (2, 3),
+                                            restricted=False)
+    sp_ref = yasa.spindles_detect(data_stage, sf, ch_names=chans, hypno=hypno_stage,
+                                  include=(2, 3), thresh=thresh)
+    data_stage, hypno_stage, _ = stage_data(ref, hypno_with_art, 3)
+    sw_ref = yasa.sw_detect(data_stage, sf, ch_names=chans, hypno=hypno_stage,
+                            include=(3))
+    for ref_det, det in ((sp_ref, sp), (sw_ref, sw)):
+        kw = dict(grp_chan=True, grp_stage=True, aggfunc='median')
+        ok &= check_table('detection', ref_det.summary(**kw), det.summary(**kw))
+    return ok
+
+def analyse_nap(a, hypno_file, out_dir='.', precision=precision,
+                sp_thresh=sp_thresh, pac_pha=pac_pha, pac_amp=pac_amp,
+                validate=validate_precision, report=None):
+    """Run artifact rejection, detection, band power and coupling for one nap.
+
+    Per-subject results are written to the folders in folder_list under
+    out_dir. precision='single' keeps the nap data in float32 (see
+    dnap_precision), validate=True then checks it against double
+    precision; sp_thresh, pac_pha and pac_amp default to the module
+    settings. Returns a dict of the summary dataframes.
+    """
+    import seaborn as sns
+    sns.set(style='white', font_scale=1.2)
+
+    if report is None:
+        report = RunReport('04_sleep')
+    subj = op.split(a)[1][0:2] 
+    report.subject(subj)
+
+    with report.stage('read'):
+        f, data, hypno = read_nap(a, hypno_file, precision)
+        ref = None
+        if validate and precision == 'single':
+            ref = read_nap(a, hypno_file)[1]
+
+    with report.stage('art_detect'):
+        hypno_with_art = detect_artifacts(f, hypno)
+
+    plot_hypno_spectrogram(data, hypno, subj, out_dir)
+
+    # adapt scaling of data by converting to microvolts (uV)
+    data *= 1e6
+
+    with report.stage('spindles'):
+        sp, sp_data = detect_spindles(data, hypno_with_art, subj, out_dir,
+                                      sp_thresh)
+
+    with report.stage('SW'):
+        sw, so_data = detect_slow_waves(data, hypno_with_art, subj, out_dir)
+
+    with report.stage('bandpower'):
+        power = compute_bandpower(data, hypno_with_art, subj, out_dir)
+
+    if ref is not None:
+        with report.stage('validate'):
+            if not check_precision(ref * 1e6, data, hypno_with_art, sp, sw,
+                                   power, sp_thresh):
+                print('WARNING: single precision results out of tolerance '
+                      'for subject ' + subj)
+        del ref
+
+    with report.stage('coupling'):
+        data_cz, out, out_chan = compute_coupling(data, hypno, subj, out_dir)
+
+    compute_pac(data_cz, hypno, subj, out_dir, report, pac_pha, pac_amp)
+
+    return {'spindles': sp_data, 'slow_waves': so_data, 'power': power,
+            'coupling': out, 'coupling_chan': out_chan}
+
+def append_csv(df_export, fname):
+    """Append a subject to the grand .csv file."""
+    import pandas as pd
+    df_export = pd.DataFrame(df_export)
+    if op.isfile(fname):
+        df_export.to_csv(fname, sep=',', mode='a', header=False)
+    else:
+        df_export.to_csv(fname, sep=',', mode='a', header=True)
 
 ## ---------------------------------------------------------------------------
 ## Grand Average Plots
 ## ---------------------------------------------------------------------------
 
-# read in data file that contains all subjects
-coup_cnt = read_csv("coupling.csv")
-
-# plot circular histogram with all subjects
-plt.figure()
-circ2 = pg.plot_circmean(coup_cnt['PhaseAtSigmaPeak'],
-                         kwargs_markers=dict(color='k',mfc='r'),
-                         kwargs_arrow=dict(ec='r', fc='r'))
-sns.despine()
-plt.savefig('coupling/' + '_coupling_average_NREM.png', dpi=300)
-
-# Get names of indexes for which column Stage has value 2
-indexNames = coup_cnt[ coup_cnt['Stage'] == 3 ].index
-# Delete these row indexes from dataFrame
-coup_cnt.drop(indexNames , inplace=True)
-
-# plot circular histogram with all subjects
-plt.figure()
-circ2 = pg.plot_circmean(coup_cnt['PhaseAtSigmaPeak'],
-                         kwargs_markers=dict(color='k',mfc='r'),
-                         kwargs_arrow=dict(ec='r', fc='r'))
-sns.despine()
-plt.savefig('coupling/' + '_coupling_average_N3.png', dpi=300)
+def grand_average_plots(coupling_file='coupling.csv'):
+    import pingouin as pg
+    import seaborn as sns
+    import matplotlib.pyplot as plt
+    from pandas import read_csv
+    sns.set(style='white', font_scale=1.2)
+
+    # read in data file that contains all subjects
+    coup_cnt = read_csv(coupling_file)
+
+    # plot circular histogram with all subjects
+    plt.figure()
+    circ2 = pg.plot_circmean(coup_cnt['PhaseAtSigmaPeak'],
+                             kwargs_markers=dict(color='k',mfc='r'),
+                             kwargs_arrow=dict(ec='r', fc='r'))
+    sns.despine()
+    plt.savefig('coupling/' + '_coupling_average_NREM.png', dpi=300)
+
+    # Get names of indexes for which column Stage has value 2
+    indexNames = coup_cnt[ coup_cnt['Stage'] == 3 ].index
+    # Delete these row indexes from dataFrame
+    coup_cnt.drop(indexNames , inplace=True)
+
+    # plot circular histogram with all subjects
+    plt.figure()
+    circ2 = pg.plot_circmean(coup_cnt['PhaseAtSigmaPeak'],
+                             kwargs_markers=dict(color='k',mfc='r'),
+                             kwargs_arrow=dict(ec='r', fc='r'))
+    sns.despine()
+    plt.savefig('coupling/' + '_coupling_average_N3.png', dpi=300)
+
+def main():
+    # plots go to a window in IPython and straight to file in batch runs
+    setup_backend()
+
+    # set the working directoy where the raw eeg files are located
+    os.chdir(raw_dir)
+
+    # record time and memory used by each processing step
+    report = RunReport('04_sleep')
+
+    # loop through each file for each subject
+    # be sure to change 'appended_files' to 'sleep_files' and vice versa
+    for s in glob.glob(sleep_pattern):
+        print("processing file " + s)
+        subj = op.split(s)[1][0:2] 
+        
+        if op.exists(nap_fname(subj)):
+            if not(compute_from_scratch):
+                print('skipping participant' + subj + ': file already exists')
+                continue
+            
+        preprocess_nap(s, nap_fname(subj), report=report)
+        
+    # list raw EEG and hypnogram files in chronological order so they are matched
+    # doesn't work. nothing works. need help.
+    os.chdir(processed_dir)
+
+    art_files = glob.glob(os.path.join('*_nap_raw.fif.gz'))
+
+    for l in folder_list:
+        if not os.path.exists(l):
+            os.makedirs(l)
+
+    # load data and hypnogram
+    for a in sorted(art_files, key=lambda s: s.lower()): 
+        print("processing file " + a)
+        subj = op.split(a)[1][0:2] 
+        
+        if subj not in process_cases:
+            if not(compute_from_scratch):
+                print('skipping participant ' + subj)
+                continue
+
+        hypno_file = op.join(processed_dir, subj + '_hyp.csv')
+        results = analyse_nap(a, hypno_file, report=report)
+
+        # append each subject to grand .csv file
+        append_csv(results['spindles'], 'spindles.csv')
+        append_csv(results['slow_waves'], 'slow_waves.csv')
+        append_csv(results['power'], 'power.csv')
+        append_csv(results['coupling'], 'coupling.csv')
+        append_csv(results['coupling_chan'], 'coupling_chan.csv')
+
+    # save the run report to spot slow steps and outlier participants
+    report.write('reports/04_sleep_report')
+
+    grand_average_plots('coupling.csv')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 20:14:36 2026
+
+@author: Hayley B. Caldwell
+
+DNap Relationship (Sigma) 05: Group Statistics
+
+Cluster-based permutation tests of TFA power between the two conditions
+(ret vs. res), paired within subjects. Clusters are formed over adjacent
+channels within each band and window; the maximum cluster mass over all
+bands and windows makes up the null distribution, so the p-values are
+corrected across the whole family.
+
+Sign-flip permutations are computed in batches as matrix products, in
+chunks that fit memory_budget_mb, spread over n_jobs processes.
+"""
+
+import os
+import os.path as op
+from dnap_profiling import RunReport
+
+# where the pre-processed EEG files and the TFA results are
+processed_dir = 'E:\\DNap\\EEG\\sigma\\processed'
+power_file = 'sigma_power.csv'
+stats_dir = 'stats'
+
+# conditions to compare (condition 1 - condition 2)
+conditions = ('ret', 'res')
+# compare log10 power
+log_power = True
+# montage used to find neighbouring channels
+montage_name = 'standard_1020'
+
+# cluster-forming threshold (two-sided p of the paired t) and cluster alpha
+cluster_alpha = 0.05
+alpha = 0.05
+n_permutations = 5000
+# memory for one chunk of permutations, in MB
+memory_budget_mb = 256
+n_jobs = os.cpu_count() or 1
+seed = 42
+
+
+def read_power(power_file=power_file, conditions=conditions, log_power=log_power):
+    """Mean power per subject, condition, band, window and channel.
+
+    Returns the paired difference (subjects, slices, channels), the list of
+    (band, window) slices, the channel names and the subjects. Subjects
+    without both conditions for every slice and channel are left out with
+    a warning; a condition missing from the whole file is an error.
+    """
+    import numpy as np
+    import pandas as pd
+
+    power = pd.read_csv(power_file, dtype={'subj': str})
+    found = sorted(power['condition'].unique())
+    missing = [c for c in conditions if c not in found]
+    if missing:
+        raise ValueError('%s has no power for condition(s) %s (found: %s)'
+                         % (power_file, ', '.join(missing), ', '.join(found)))
+    power = power[power['condition'].isin(conditions)]
+    means = power.groupby(['subj', 'condition', 'band', 'win', 'ch_name'],
+                          as_index=False)['power'].mean()
+    if log_power:
+        means['power'] = np.log10(means['power'])
+    table = means.pivot_table(index=['subj', 'band', 'win'],
+                              columns=['condition', 'ch_name'], values='power')
+    ch_names = sorted(means['ch_name'].unique())
+    diff = (table[conditions[0]].reindex(columns=ch_names)
+            - table[conditions[1]].reindex(columns=ch_names))
+
+    all_subjects = sorted(means['subj'].unique())
+    complete_rows = diff.dropna(how='any')
+    slices = sorted(set(zip(complete_rows.index.get_level_values('band'),
+                            complete_rows.index.get_level_values('win'))))
+    full = pd.MultiIndex.from_tuples([(s, b, w) for s in all_subjects for b, w in slices],
+                                     names=['subj', 'band', 'win'])
+    diff = diff.reindex(full)
+    complete = ~diff.isna().any(axis=1).groupby(level='subj').any()
+    subjects = [s for s in all_subjects if slices and complete[s]]
+    dropped = [s for s in all_subjects if s not in subjects]
+    if dropped:
+        print('WARNING: %s: left out %s (missing %s or %s for a band, window or '
+              'channel)' % ((power_file, ', '.join(dropped)) + tuple(conditions)))
+    print('%s vs %s: n = %d subjects' % (conditions + (len(subjects),)))
+    if len(subjects) < 2:
+        raise ValueError('%s: %d subject(s) have both %s and %s for every band, '
+                         'window and channel; the paired test needs 2'
+                         % ((power_file, len(subjects)) + tuple(conditions)))
+    data = diff.loc[subjects].to_numpy().reshape(len(subjects), len(slices), len(ch_names))
+    return data, slices, ch_names, subjects
+
+
+def channel_adjacency(ch_names, montage_name=montage_name):
+    """Boolean (channels, channels) neighbour matrix, including the diagonal."""
+    import mne
+
+    info = mne.create_info(ch_names, 100., 'eeg')
+    info.set_montage(montage_name)
+    adjacency, _ = mne.channels.find_ch_adjacency(info, 'eeg')
+    adjacency = adjacency.toarray().astype(bool)
+    adjacency[range(len(ch_names)), range(len(ch_names))] = True
+    return adjacency
+
+
+def sign_flips(n_subj, n_perm, rng, first=True):
+    """Random +/-1 flips (n_perm, n_subj); with first=True row 0 is all +1."""
+    import numpy as np
+    signs = rng.integers(0, 2, size=(n_perm, n_subj)) * 2 - 1
+    if first and n_perm:
+        signs[0] = 1
+    return signs.astype(np.float64)
+
+
+def all_sign_flips(n_subj):
+    """All 2 ** n_subj flips, the identity first."""
+    import numpy as np
+    codes = np.arange(2 ** n_subj)[:, None] >> np.arange(n_subj) & 1
+    return 1. - 2. * codes
+
+
+def paired_t(data, signs):
+    """Paired t for each row of sign flips, shape (perms, slices, channels).
+
+    Flipping signs does not change the sum of squares, so each
+    permutation only needs one matrix product for the means.
+    """
+    import numpy as np
+    n = data.shape[0]
+    flat = data.reshape(n, -1)
+    mean = signs @ flat / n
+    ss = (flat ** 2).sum(axis=0)
+    var = (ss - n * mean ** 2) / (n - 1)
+    t = mean / np.sqrt(np.maximum(var, 1e-300) / n)
+    return t.reshape((len(signs),) + data.shape[1:])
+
+
+def cluster_labels(supra, adjacency):
+    """Label connected supra-threshold channels, batched.
+
+    supra is boolean (..., channels). Each cluster gets the index of its
+    lowest channel; channels below threshold get n_channels.
+    """
+    import numpy as np
+    n_chan = supra.shape[-1]
+    labels = np.where(supra, np.arange(n_chan), n_chan)
+    while True:
+        # smallest label among supra-threshold neighbours
+        neigh = np.where(adjacency & supra[..., None, :], labels[..., None, :], n_chan)
+        new = np.where(supra, neigh.min(axis=-1), n_chan)
+        if np.array_equal(new, labels):
+            return labels
+        labels = new
+
+
+def cluster_masses(t, threshold, adjacency):
+    """Cluster labels and masses (sum of t) of positive and negative clusters.
+
+    Returns labels (..., channels) in [0, 2 * n_channels], where the
+    negative clusters are offset by n_channels and 2 * n_channels is no
+    cluster, and masses (..., 2 * n_channels).
+    """
+    import numpy as np
+    n_chan = t.shape[-1]
+    pos = cluster_labels(t > threshold, adjacency)
+    neg = cluster_labels(t < -threshold, adjacency)
+    labels = np.where(pos < n_chan, pos, np.where(neg < n_chan, neg + n_chan, 2 * n_chan))
+    n_groups = int(np.prod(t.shape[:-1]))
+    idx = np.arange(n_groups).reshape(t.shape[:-1] + (1,)) * (2 * n_chan + 1) + labels
+    masses = np.bincount(idx.ravel(), weights=t.ravel(),
+                         minlength=n_groups * (2 * n_chan + 1))
+    masses = masses.reshape(t.shape[:-1] + (2 * n_chan + 1,))[..., :-1]
+    return labels, masses
+
+
+def max_cluster_mass(data, signs, threshold, adjacency):
+    """Largest absolute cluster mass over all slices, per permutation."""
+    import numpy as np
+    _, masses = cluster_masses(paired_t(data, signs), threshold, adjacency)
+    return np.abs(masses).reshape(len(signs), -1).max(axis=1)
+
+
+def _null_chunk(data, n_perm, seed, threshold, adjacency, signs=None):
+    import numpy as np
+    if signs is None:
+        signs = sign_flips(data.shape[0], n_perm, np.random.default_rng(seed), first=False)
+    return max_cluster_mass(data, signs, threshold, adjacency)
+
+
+def null_distribution(data, n_perm, threshold, adjacency, budget_mb=memory_budget_mb,
+                      n_jobs=n_jobs, seed=seed):
+    """Max cluster masses of the sign-flip null, identity included first.
+
+    All 2 ** n_subjects flips are used when there are no more than
+    n_perm of them (exact test), else n_perm - 1 random ones.
+    """
+    import numpy as np
+    from concurrent.futures import ProcessPoolExecutor
+
+    n_subj, n_slices, n_chan = data.shape
+    # t, labels and the neighbour comparison of one permutation
+    per_perm = n_slices * n_chan * (n_chan + 6) * 8
+    chunk = max(1, int(budget_mb * 1024 ** 2 // per_perm))
+
+    exact = 2 ** n_subj <= n_perm
+    if exact:
+        signs = all_sign_flips(n_subj)[1:]
+        jobs = [dict(signs=signs[i:i + chunk], n_perm=None, seed=None)
+                for i in range(0, len(signs), chunk)]
+    else:
+        seeds = np.random.SeedSequence(seed).spawn((n_perm - 1 + chunk - 1) // chunk)
+        sizes = [min(chunk, n_perm - 1 - i * chunk) for i in range(len(seeds))]
+        jobs = [dict(signs=None, n_perm=k, seed=s) for k, s in zip(sizes, seeds)]
+
+    observed = max_cluster_mass(data, np.ones((1, n_subj)), threshold, adjacency)
+    if n_jobs > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(min(n_jobs, len(jobs))) as ex:
+            futures = [ex.submit(_null_chunk, data, j['n_perm'], j['seed'], threshold,
+                                 adjacency, j['signs']) for j in jobs]
+            null = [f.result() for f in futures]
+    else:
+        null = [_null_chunk(data, j['n_perm'], j['seed'], threshold, adjacency, j['signs'])
+                for j in jobs]
+    return np.concatenate([observed] + null), exact
+
+
+def cluster_p(null, mass):
+    """Share of the null at least as extreme as a cluster mass.
+
+    The batched matrix products round differently from the observed one,
+    so masses equal up to rounding count as equal.
+    """
+    import numpy as np
+    return float(np.mean(null >= abs(mass) * (1 - 1e-9)))
+
+
+def cluster_test(data, slices, ch_names, adjacency, n_perm=n_permutations,
+                 cluster_alpha=cluster_alpha, budget_mb=memory_budget_mb,
+                 n_jobs=n_jobs, seed=seed, report=None):
+    """Paired cluster permutation test over channels, bands and windows.
+
+    Returns a per-channel table (t, cluster, p, significant) and a table
+    of the clusters with their mass, channels and p-value.
+    """
+    import numpy as np
+    import pandas as pd
+    from scipy import stats
+
+    if report is None:
+        report = RunReport('05_stats')
+    n_subj = data.shape[0]
+    threshold = stats.t.ppf(1 - cluster_alpha / 2, n_subj - 1)
+
+    with report.stage('observed'):
+        t_obs = paired_t(data, np.ones((1, n_subj)))[0]
+        labels, masses = cluster_masses(t_obs, threshold, adjacency)
+    with report.stage('permutations'):
+        null, exact = null_distribution(data, n_perm, threshold, adjacency,
+                                        budget_mb, n_jobs, seed)
+    print('%d permutations%s, cluster threshold t = %.3f'
+          % (len(null), ' (exact)' if exact else '', threshold))
+
+    n_chan = len(ch_names)
+    channels, clusters = [], []
+    for s, (band, win) in enumerate(slices):
+        for c in np.unique(labels[s][labels[s] < 2 * n_chan]):
+            mass = masses[s, c]
+            members = np.nonzero(labels[s] == c)[0]
+            clusters.append({'band': band, 'win': win,
+                             'cluster': len(clusters) + 1,
+                             'sign': 'positive' if c < n_chan else 'negative',
+                             'mass': mass,
+                             'n_channels': len(members),
+                             'channels': ' '.join(ch_names[m] for m in members),
+                             'p': cluster_p(null, mass)})
+        for ch in range(n_chan):
+            found = [k for k in clusters if k['band'] == band and k['win'] == win
+                     and ch_names[ch] in k['channels'].split()]
+            channels.append({'band': band, 'win': win, 'ch_name': ch_names[ch],
+                             't': t_obs[s, ch],
+                             'cluster': found[0]['cluster'] if found else 0,
+                             'p': found[0]['p'] if found else np.nan})
+    channels = pd.DataFrame(channels)
+    channels['significant'] = channels['p'] < alpha
+    clusters = pd.DataFrame(clusters, columns=['band', 'win', 'cluster', 'sign', 'mass',
+                                               'n_channels', 'channels', 'p'])
+    return channels, clusters
+
+
+def group_stats(power_file, out_dir=stats_dir, conditions=conditions,
+                n_perm=n_permutations, n_jobs=n_jobs, report=None):
+    """Run the cluster test on a TFA power table and write the results.
+
+    Writes <cond1>_vs_<cond2>_channels.csv (cluster mask per channel) and
+    <cond1>_vs_<cond2>_clusters.csv to out_dir; returns both tables.
+    """
+    if report is None:
+        report = RunReport('05_stats')
+    with report.stage('read'):
+        data, slices, ch_names, subjects = read_power(power_file, conditions)
+        adjacency = channel_adjacency(ch_names)
+    print('%d subjects, %d channels, %d band x window slices'
+          % (len(subjects), len(ch_names), len(slices)))
+    channels, clusters = cluster_test(data, slices, ch_names, adjacency, n_perm,
+                                      n_jobs=n_jobs, report=report)
+    if not op.exists(out_dir):
+        os.makedirs(out_dir)
+    name = op.join(out_dir, '%s_vs_%s' % conditions)
+    with report.stage('write'):
+        channels.to_csv(name + '_channels.csv', index=False)
+        clusters.to_csv(name + '_clusters.csv', index=False)
+    return channels, clusters
+
+
+def main():
+    os.chdir(processed_dir)
+
+    # record time and memory used by each processing step
+    report = RunReport('05_stats')
+    channels, clusters = group_stats(power_file, report=report)
+    print(clusters.round(3).to_string(index=False))
+    report.write('reports\\05_stats_report')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 21:02:44 2026
+
+@author: Hayley B. Caldwell
+
+DNap Relationship (Sigma): Stage-Restricted Computation
+
+Plans the sleep analyses from the hypnogram: only the intervals of the
+stages an analysis includes are kept, padded on both sides so filters
+and moving windows see the same neighbourhood as in the full recording,
+and merged when the padding makes them touch. The kept intervals are
+concatenated into one shorter recording; the padding keeps its own
+stage codes, so it is never detected on, and event times can be mapped
+back to the recording with to_recording_time.
+
+Slow waves match the full-night run to rounding, so 04 restricts the
+slow wave detection. Spindle onsets can move by one sample (and
+borderline spindles come and go) because yasa places its moving RMS
+windows on a float time grid counted from the first sample; cropping the
+wake before a nap changes them the same way, and padding cannot align
+that grid. The phase and ndPAC of coupling use a Hilbert transform over
+the whole input and differ by about 1e-4. 04 therefore runs spindles and
+coupling on the whole nap.
+"""
+
+import numpy as np
+
+# padding around each interval in seconds: longer than half the longest
+# filter of the detections (16.5 s slow wave FIR) plus moving windows
+pad_sec = 30.
+# interval edges are aligned to whole seconds so the STFT and moving
+# window grids of the detections fall on the same samples
+align_sec = 1.
+
+# event time columns of the yasa detection summaries, in seconds
+time_columns = ['Start', 'End', 'Peak', 'NegPeak', 'MidCrossing', 'PosPeak',
+                'SigmaPeak']
+
+
+def stage_plan(hypno, include, sf, pad=pad_sec, align=align_sec):
+    """[start, stop) sample intervals to compute on.
+
+    Intervals where hypno is in include, padded by pad seconds, aligned
+    to align seconds, clipped to the recording and merged where they
+    overlap or touch.
+    """
+    hypno = np.asarray(hypno)
+    n_samples = len(hypno)
+    mask = np.isin(hypno, np.atleast_1d(include))
+    edges = np.diff(np.concatenate([[0], mask.astype(np.int8), [0]]))
+    starts, stops = np.nonzero(edges == 1)[0], np.nonzero(edges == -1)[0]
+    n_pad, n_align = int(pad * sf), max(1, int(align * sf))
+    plan = []
+    for start, stop in zip(starts, stops):
+        start = max(0, (start - n_pad) // n_align * n_align)
+        stop = min(n_samples, -(-(stop + n_pad) // n_align) * n_align)
+        if plan and start <= plan[-1][1]:
+            plan[-1] = (plan[-1][0], max(plan[-1][1], int(stop)))
+        else:
+            plan.append((int(start), int(stop)))
+    return plan
+
+
+def restrict(data, hypno, plan):
+    """Concatenate the planned intervals of data (..., times) and hypno."""
+    hypno = np.asarray(hypno)
+    if len(plan) == 1 and plan[0] == (0, hypno.shape[-1]):
+        return data, hypno
+    idx = np.concatenate([np.arange(start, stop) for start, stop in plan])
+    return data[..., idx], hypno[idx]
+
+
+def planned_fraction(plan, n_samples):
+    """Share of the recording that is computed on."""
+    return sum(stop - start for start, stop in plan) / float(n_samples)
+
+
+def to_recording_time(events, plan, sf, columns=time_columns):
+    """Map event times (s) of a restricted run back to the recording.
+
+    events is a dataframe such as the summary of a yasa detection run on
+    the output of restrict; it is changed in place and returned.
+    """
+    lengths = np.array([stop - start for start, stop in plan])
+    restricted_starts = np.concatenate([[0], np.cumsum(lengths)[:-1]]) / sf
+    offsets = np.array([start for start, _ in plan]) / sf - restricted_starts
+    for col in columns:
+        if col in events:
+            seg = np.searchsorted(restricted_starts, events[col].to_numpy(), side='right') - 1
+            events[col] = events[col] + offsets[np.clip(seg, 0, len(plan) - 1)]
+    return events
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 13:40:05 2026
+
+@author: Hayley B. Caldwell
+
+DNap Relationship (Sigma): Start-up
+
+The stage scripts only import mne, pandas, plotting and analysis packages
+inside the functions that use them, so a batch worker pays for them only
+when the step runs. This module picks the matplotlib backend and checks
+that importing the stages stays cheap:
+
+    python dnap_startup.py
+"""
+
+import os.path as op
+import sys
+import json
+import subprocess
+
+here = op.dirname(op.abspath(__file__))
+
+# packages that must not be loaded just by importing a stage
+heavy_modules = ['mne', 'yasa', 'pandas', 'matplotlib', 'seaborn', 'scipy',
+                 'autoreject', 'tensorpac', 'pingouin', 'philistine',
+                 'pyriemann']
+
+# seconds allowed for importing one stage in a fresh interpreter
+import_budget = 0.5
+
+
+def ipython_shell():
+    """The running IPython shell, or None outside IPython."""
+    if 'IPython' not in sys.modules:
+        # not started from IPython, no need to import it
+        return None
+    try:
+        from IPython import get_ipython
+    except ImportError:
+        return None
+    return get_ipython()
+
+
+def setup_backend():
+    """Show plots in a window under IPython and use Agg everywhere else."""
+    shell = ipython_shell()
+    if shell is not None:
+        # plots created will appear in a different window - dont worry, it runs
+        shell.run_line_magic('matplotlib', 'qt')
+        return
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+def import_overhead(script):
+    """Import a stage script in a fresh interpreter.
+
+    Returns the import time in seconds and the list of heavy packages that
+    were loaded as a side effect.
+    """
+    code = ('import sys, time, json\n'
+            'sys.path.insert(0, %r)\n'
+            't0 = time.perf_counter()\n'
+            'import dnap_pipeline\n'
+            'dnap_pipeline.load_stage(%r)\n'
+            'dt = time.perf_counter() - t0\n'
+            'heavy = [m for m in %r if m in sys.modules]\n'
+            'print(json.dumps([dt, heavy]))\n' % (here, script, heavy_modules))
+    out = subprocess.run([sys.executable, '-c', code], capture_output=True,
+                         text=True, check=True)
+    dt, heavy = json.loads(out.stdout.strip().splitlines()[-1])
+    return dt, heavy
+
+
+def check_imports(budget=import_budget):
+    """Measure the import of every stage; return False if one is too slow."""
+    from dnap_pipeline import stage_scripts
+    ok = True
+    for name, script in sorted(stage_scripts.items()):
+        dt, heavy = import_overhead(script)
+        status = 'ok'
+        if dt > budget or heavy:
+            status = 'OVER BUDGET'
+            ok = False
+        print('%-8s %6.3f s  heavy: %-20s %s'
+              % (name, dt, ', '.join(heavy) or '-', status))
+    return ok
+
+
+if __name__ == '__main__':
+    sys.exit(0 if check_imports() else 1)
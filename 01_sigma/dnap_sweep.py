@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 22:14:05 2026
+
+@author: Hayley B. Caldwell
+
+DNap Relationship (Sigma): Parameter Sweep
+
+Runs the task and nap analyses for every combination of a grid of
+settings, for sensitivity analyses. The pre-processing is split into
+checkpoints, each saved once per combination of the settings it depends
+on (including those of the steps before it):
+
+    segmented raw      01   -
+    filtered raw       01   sfreq, l_freq, h_freq
+    ICA-cleaned raw    01   (as filtered raw)
+    epochs             01   + duration, reject, flat
+    TFA power, stats   03   + estimator, precision, n_permutations
+    re-referenced nap  04   -
+    filtered nap       04   nap_l_freq, nap_h_freq
+    detections         04   + precision, sp_rel_pow, sp_corr, sp_rms,
+                              pac_pha, pac_amp
+
+Variants that share settings share the nodes of dnap_pipeline.Pipeline
+that produce their checkpoints, so each variant resumes from the deepest
+checkpoint it has in common with the others, and independent nodes run
+in parallel. A sweep over spindle thresholds re-runs only the detection;
+one over reject only the epoching and what follows. The manifest keeps
+finished checkpoints across runs, so extending a grid only computes the
+new variants.
+
+reject and flat are the EEG thresholds in V (the EOG threshold of the
+01 settings is kept); None keeps all epochs. Results of each variant
+are listed in variants.csv in the sweep folder.
+
+    python dnap_sweep.py --grid reject=100e-6,150e-6,none --grid sp_rms=1.25,1.5,2 --jobs 8
+    python dnap_sweep.py --grid-file sweep.json
+"""
+
+import os
+import os.path as op
+import sys
+import csv
+import glob
+import json
+import hashlib
+import argparse
+import itertools
+
+from dnap_events import event_kinds, events_fname
+from dnap_startup import setup_backend
+from dnap_pipeline import (Pipeline, brainvision_files, load_stage,
+                           make_folders, parse_value, stage_scripts)
+
+# settings each step depends on, in addition to those of its upstream step
+step_params = {'segment': [],
+               'filter': ['sfreq', 'l_freq', 'h_freq'],
+               'ica': [],
+               'epochs': ['duration', 'reject', 'flat'],
+               'tfa': ['estimator', 'precision'],
+               'stats': ['n_permutations'],
+               'nap': [],
+               'nap_filter': ['nap_l_freq', 'nap_h_freq'],
+               'detect': ['precision', 'sp_rel_pow', 'sp_corr', 'sp_rms',
+                          'pac_pha', 'pac_amp']}
+upstream = {'filter': 'segment', 'ica': 'filter', 'epochs': 'ica',
+            'tfa': 'epochs', 'stats': 'tfa', 'nap_filter': 'nap',
+            'detect': 'nap_filter'}
+
+
+def default_params():
+    """The settings of the stage scripts, as sweep parameters."""
+    preproc = load_stage(stage_scripts['preproc'])
+    tfa = load_stage(stage_scripts['tfa'])
+    sleep = load_stage(stage_scripts['sleep'])
+    stats = load_stage(stage_scripts['stats'])
+    return {'sfreq': preproc.resample_sfreq,
+            'l_freq': preproc.l_freq,
+            'h_freq': preproc.h_freq,
+            'duration': preproc.epoch_duration,
+            'reject': None,
+            'flat': None,
+            'estimator': tfa.estimator,
+            'precision': tfa.precision,
+            'n_permutations': stats.n_permutations,
+            'nap_l_freq': sleep.l_freq,
+            'nap_h_freq': sleep.h_freq,
+            'sp_rel_pow': sleep.sp_thresh['rel_pow'],
+            'sp_corr': sleep.sp_thresh['corr'],
+            'sp_rms': sleep.sp_thresh['rms'],
+            'pac_pha': list(sleep.pac_pha),
+            'pac_amp': list(sleep.pac_amp)}
+
+
+def expand_grid(grid, defaults):
+    """One parameter dict per combination of the values in grid."""
+    unknown = set(grid) - set(defaults)
+    if unknown:
+        raise ValueError('unknown sweep parameter(s): %s'
+                         % ', '.join(sorted(unknown)))
+    names = sorted(grid)
+    variants = []
+    for values in itertools.product(*(grid[n] for n in names)):
+        params = dict(defaults)
+        params.update(zip(names, values))
+        variants.append(params)
+    return variants
+
+
+def step_names(step):
+    """All parameters a step depends on, through its upstream steps."""
+    names = []
+    while step is not None:
+        names = step_params[step] + names
+        step = upstream.get(step)
+    return names
+
+
+def param_key(params, names):
+    state = json.dumps({n: params[n] for n in names}, sort_keys=True)
+    return hashlib.sha1(state.encode()).hexdigest()[:10]
+
+
+def step_key(step, params):
+    return param_key(params, step_names(step))
+
+
+def variant_id(params):
+    return 'v' + param_key(params, sorted(params))
+
+
+def build_sweep(variants, sweep_dir, manifest_file=None, n_jobs=1):
+    """Pipeline with the nodes of all variants, shared where possible.
+
+    n_jobs is passed to the steps that run in parallel themselves (the
+    IAF spectra). Returns the pipeline and one row per variant with its
+    parameters and output folders.
+    """
+    preproc = load_stage(stage_scripts['preproc'])
+    iaf = load_stage(stage_scripts['iaf'])
+    tfa = load_stage(stage_scripts['tfa'])
+    sleep = load_stage(stage_scripts['sleep'])
+    stats = load_stage(stage_scripts['stats'])
+
+    eeg_dir = preproc.data_dir
+    ckpt_dir = op.join(sweep_dir, 'checkpoints')
+    report_dir = op.join(sweep_dir, 'reports')
+    if manifest_file is None:
+        manifest_file = op.join(sweep_dir, 'sweep_manifest.json')
+    pipe = Pipeline(manifest_file)
+
+    def add(name, *args, **kwargs):
+        # variants sharing a checkpoint share its node
+        if name not in pipe.nodes:
+            kwargs.setdefault('report_file',
+                              op.join(report_dir, name.replace(':', '_').replace('@', '_')))
+            pipe.add(name, *args, **kwargs)
+        return name
+
+    def ckpt(item, step, key, ext='_raw.fif'):
+        return op.join(ckpt_dir, '%s_%s_%s%s' % (item, step, key, ext))
+
+    task_files = sorted(glob.glob(op.join(eeg_dir, preproc.raw_pattern)))
+    iaf_files = sorted(glob.glob(op.join(eeg_dir, iaf.iaf_pattern)))
+    iaf_table = op.join(sweep_dir, 'iaf_long.txt')
+    add('iaf', stage_scripts['iaf'], 'compute_iaf',
+        dict(iaf_files=iaf_files, outfile=iaf_table, fmin=iaf.iaf_fmin,
+             fmax=iaf.iaf_fmax, n_jobs=n_jobs),
+        inputs=[i for f in iaf_files for i in brainvision_files(f)],
+        outputs=[iaf_table])
+
+    naps = []
+    for s in sorted(glob.glob(op.join(sleep.raw_dir, sleep.sleep_pattern))):
+        subj = op.split(s)[1][0:2]
+        hypno_file = op.join(sleep.processed_dir, subj + '_hyp.csv')
+        if not op.exists(hypno_file):
+            print('no hypnogram for participant ' + subj + ', skipping detection')
+            continue
+        naps.append((s, subj, hypno_file))
+
+    rows = []
+    for params in variants:
+        keys = {step: step_key(step, params) for step in step_params}
+        epochs_dir = op.join(sweep_dir, 'epochs_' + keys['epochs'])
+        power_dir = op.join(sweep_dir, 'power_' + keys['tfa'])
+        stats_dir = op.join(sweep_dir, 'stats_' + keys['stats'])
+        sleep_dir = op.join(sweep_dir, 'sleep_' + keys['detect'])
+
+        # raw task EEG -> segmented -> filtered -> ICA -> epochs -> power
+        power_files, tfa_nodes = [], []
+        for f in task_files:
+            s_number, condition = preproc.parse_fname(f)
+            item = s_number + '_' + condition
+            inputs = brainvision_files(f)
+            paste = preproc.files_to_paste.get(op.basename(f))
+            if paste is not None:
+                inputs += brainvision_files(op.join(eeg_dir, paste))
+            seg = ckpt(item, 'segment', keys['segment'])
+            dep = add('segment:%s@%s' % (item, keys['segment']),
+                      stage_scripts['preproc'], 'segment_file',
+                      dict(f=f, outfile=seg), inputs=inputs, outputs=[seg])
+            filt = ckpt(item, 'filter', keys['filter'])
+            dep = add('filter:%s@%s' % (item, keys['filter']),
+                      stage_scripts['preproc'], 'filter_file',
+                      dict(raw_file=seg, outfile=filt, l_freq=params['l_freq'],
+                           h_freq=params['h_freq'], sfreq=params['sfreq']),
+                      inputs=[seg], outputs=[filt], deps=[dep])
+            ica = ckpt(item, 'ica', keys['ica'])
+            dep = add('ica:%s@%s' % (item, keys['ica']),
+                      stage_scripts['preproc'], 'ica_file',
+                      dict(raw_file=filt, f=f, outfile=ica),
+                      inputs=[filt], outputs=[ica], deps=[dep])
+            epo = preproc.processed_fname(f, epochs_dir)
+            dep = add('epochs:%s@%s' % (item, keys['epochs']),
+                      stage_scripts['preproc'], 'epoch_file',
+                      dict(raw_file=ica, f=f, out_dir=epochs_dir,
+                           duration=params['duration'],
+                           reject=thresholds(preproc.reject, params['reject']),
+                           flat=thresholds(preproc.flat, params['flat'])),
+                      inputs=[ica], outputs=epoch_outputs(preproc, f, epochs_dir),
+                      deps=[dep])
+            outputs = [tfa.power_fname(s_number, condition, b, power_dir)
+                       for b in tfa.bands]
+            tfa_nodes.append(add(
+                'tfa:%s@%s' % (item, keys['tfa']), stage_scripts['tfa'], 'tfa_file',
+                dict(e=epo, iaf_info_means=iaf_table, bands=tfa.bands,
+                     windows=tfa.windows, power_dir=power_dir,
+                     estimator=params['estimator'],
+                     precision=params['precision']),
+                inputs=[epo, iaf_table], outputs=outputs, deps=[dep, 'iaf']))
+            power_files += outputs
+
+        sigma_power = op.join(power_dir, 'sigma_power.csv')
+        dep = add('tfa:gather@' + keys['tfa'], None, 'concat_csv',
+                  dict(files=power_files, outfile=sigma_power),
+                  inputs=power_files, outputs=[sigma_power], deps=tfa_nodes,
+                  report_file=None)
+        name = op.join(stats_dir, '%s_vs_%s' % stats.conditions)
+        add('stats@' + keys['stats'], stage_scripts['stats'], 'group_stats',
+            dict(power_file=sigma_power, out_dir=stats_dir,
+                 n_perm=int(params['n_permutations'])),
+            inputs=[sigma_power],
+            outputs=[name + '_channels.csv', name + '_clusters.csv'],
+            deps=[dep])
+
+        # raw nap EEG -> re-referenced -> filtered -> detections
+        results = {'spindles': [], 'slow_waves': [], 'power': [], 'coupling': [],
+                   'coupling_chan': []}
+        detect_nodes = []
+        for s, subj, hypno_file in naps:
+            ref = ckpt(subj, 'nap', keys['nap'])
+            dep = add('nap:%s@%s' % (subj, keys['nap']),
+                      stage_scripts['sleep'], 'reference_nap',
+                      dict(s=s, outfile=ref), inputs=brainvision_files(s),
+                      outputs=[ref])
+            nap = ckpt(subj, 'nap_filter', keys['nap_filter'], '_raw.fif.gz')
+            dep = add('nap_filter:%s@%s' % (subj, keys['nap_filter']),
+                      stage_scripts['sleep'], 'filter_nap',
+                      dict(raw_file=ref, outfile=nap,
+                           l_freq=params['nap_l_freq'],
+                           h_freq=params['nap_h_freq']),
+                      inputs=[ref], outputs=[nap], deps=[dep])
+            outputs = {'spindles': op.join(sleep_dir, 'spindle', subj + '_spindle.csv'),
+                       'slow_waves': op.join(sleep_dir, 'so', subj + '_so.csv'),
+                       'power': op.join(sleep_dir, 'power', subj + '_power.csv'),
+                       'coupling': op.join(sleep_dir, 'coupling', subj + '_coupling.csv'),
+                       'coupling_chan': op.join(sleep_dir, 'coupling',
+                                                subj + '_coupling_chan.csv')}
+            events = [events_fname(subj, kind, op.join(sleep_dir, 'events'))
+                      for kind in event_kinds]
+            detect_nodes.append(add(
+                'detect:%s@%s' % (subj, keys['detect']), stage_scripts['sleep'],
+                'analyse_nap',
+                dict(a=nap, hypno_file=hypno_file, out_dir=sleep_dir,
+                     precision=params['precision'],
+                     sp_thresh={'rel_pow': params['sp_rel_pow'],
+                                'corr': params['sp_corr'],
+                                'rms': params['sp_rms']},
+                     pac_pha=params['pac_pha'], pac_amp=params['pac_amp']),
+                inputs=[nap, hypno_file], outputs=list(outputs.values()) + events,
+                deps=[dep]))
+            for key in results:
+                results[key].append(outputs[key])
+        for key, files in results.items():
+            add('detect:gather_%s@%s' % (key, keys['detect']), None, 'concat_csv',
+                dict(files=files, outfile=op.join(sleep_dir, key + '.csv')),
+                inputs=files, outputs=[op.join(sleep_dir, key + '.csv')],
+                deps=detect_nodes, report_file=None)
+
+        row = {'variant': variant_id(params)}
+        row.update((n, json.dumps(v)) for n, v in sorted(params.items()))
+        row.update({'epochs_dir': epochs_dir, 'power_file': sigma_power,
+                    'stats_dir': stats_dir, 'sleep_dir': sleep_dir})
+        rows.append(row)
+    return pipe, rows
+
+
+def epoch_outputs(preproc, f, out_dir):
+    outputs = [preproc.processed_fname(f, out_dir)]
+    if preproc.save_item_epochs:
+        outputs.append(preproc.items_fname(f, out_dir))
+    return outputs
+
+
+def thresholds(base, eeg):
+    """The reject/flat dict of the 01 settings with its EEG value replaced."""
+    if eeg is None:
+        return None
+    return dict(base, eeg=eeg)
+
+
+def sweep_folders(rows, sweep_dir):
+    """Create the checkpoint folder and the output folders of each variant."""
+    sleep = load_stage(stage_scripts['sleep'])
+    folders = [op.join(sweep_dir, 'checkpoints'), op.join(sweep_dir, 'reports')]
+    for row in rows:
+        folders += [row['epochs_dir'], op.dirname(row['power_file']),
+                    row['stats_dir']]
+        folders += [op.join(row['sleep_dir'], l) for l in sleep.folder_list]
+    for l in folders:
+        if not os.path.exists(l):
+            os.makedirs(l)
+
+
+def write_variants(rows, fname):
+    with open(fname, 'w', newline='') as fid:
+        writer = csv.DictWriter(fid, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+    return fname
+
+
+def parse_grid(items, grid_file=None):
+    """Grid from name=v1,v2,... items and/or a json file of name: [values]."""
+    grid = {}
+    if grid_file is not None:
+        with open(grid_file) as fid:
+            grid.update(json.load(fid))
+    for item in items:
+        key, values = item.split('=', 1)
+        grid[key] = [parse_value(v) for v in values.split(',')]
+    return grid
+
+
+def main():
+    preproc = load_stage(stage_scripts['preproc'])
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--grid', action='append', default=[],
+                        help='values of one parameter, e.g. l_freq=0.5,1')
+    parser.add_argument('--grid-file', help='json file of parameter: [values]')
+    parser.add_argument('--out', default=op.join(preproc.data_dir, 'sigma', 'sweep'),
+                        help='folder for the checkpoints and results')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1,
+                        help='number of nodes to run at the same time')
+    parser.add_argument('--force', action='store_true',
+                        help='re-run every node regardless of hashes')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only list the nodes that would run')
+    args = parser.parse_args()
+
+    # plots go to a window in IPython and straight to file in batch runs
+    setup_backend()
+
+    variants = expand_grid(parse_grid(args.grid, args.grid_file),
+                           default_params())
+    sweep_dir = op.abspath(args.out)
+    pipe, rows = build_sweep(variants, sweep_dir, n_jobs=args.jobs)
+    print('%d variants, %d nodes' % (len(variants), len(pipe.nodes)))
+    make_folders()
+    sweep_folders(rows, sweep_dir)
+    write_variants(rows, op.join(sweep_dir, 'variants.csv'))
+    # the stage functions write their plots relative to the EEG folder
+    os.chdir(preproc.data_dir)
+    status = pipe.run(n_jobs=args.jobs, force=args.force, dry_run=args.dry_run)
+
+    counts = {}
+    for s in status.values():
+        counts[s] = counts.get(s, 0) + 1
+    print(', '.join('%d %s' % (n, s) for s, n in sorted(counts.items())))
+    if 'failed' in counts:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 15:21:48 2026
+
+@author: Hayley B. Caldwell
+
+DNap Relationship (Sigma): Window Aggregation
+
+Mean power in time windows via prefix sums: the power array is summed
+cumulatively along time once, after which the mean of any window (also
+overlapping or sliding ones) is two lookups.
+
+Windows of continuous data as strided, read-only views: fixed or
+overlapping windows, optionally only inside the intervals where a mask
+(sleep stage, artifact-free) is true, without copying any samples.
+"""
+
+import numpy as np
+
+
+def window_samples(window, epoch_tmin, sfreq):
+    """Return the [start, stop) samples of a window given in ms.
+
+    Uses the same sample conversion as add_windows in the TFA script, so
+    the windows select exactly the same time points.
+    """
+    zero_ms = (0-epoch_tmin)*sfreq
+    start, stop = window
+    if start < 0:
+        start_sample = int((zero_ms - abs(start))/1000*sfreq)
+    else:
+        start_sample = int((zero_ms + start)/1000*sfreq)
+    if stop < 0:
+        stop_sample = int((zero_ms - abs(stop))/1000*sfreq)
+    else:
+        stop_sample = int((zero_ms + stop)/1000*sfreq)
+    # add_windows keeps start_sample - 1 < time < stop_sample - 1
+    return start_sample, stop_sample - 1
+
+
+def prefix_sums(power):
+    """Cumulative sum along the last (time) axis with a leading zero.
+
+    Sums are accumulated in float64 whatever the input precision.
+    """
+    csum = np.zeros(power.shape[:-1] + (power.shape[-1] + 1,), dtype=np.float64)
+    np.cumsum(power, axis=-1, dtype=np.float64, out=csum[..., 1:])
+    return csum
+
+
+def window_means(csum, windows, epoch_tmin, sfreq):
+    """Mean over each window from prefix sums.
+
+    Parameters
+    ----------
+    csum : array, shape (..., n_times + 1)
+        Output of prefix_sums.
+    windows : dict
+        Window name -> (start, stop) in ms relative to the epoch onset.
+    epoch_tmin : float
+        Start of the epochs in seconds.
+    sfreq : float
+        Sampling frequency.
+
+    Returns
+    -------
+    names : list of str
+        Names of the windows that contain at least one sample.
+    means : array, shape (..., n_windows)
+        Mean of each of these windows.
+    """
+    n_times = csum.shape[-1] - 1
+    names, starts, stops = [], [], []
+    for name, window in windows.items():
+        start, stop = window_samples(window, epoch_tmin, sfreq)
+        start, stop = max(start, 0), min(stop, n_times)
+        if stop <= start:
+            continue
+        names.append(name)
+        starts.append(start)
+        stops.append(stop)
+    starts, stops = np.array(starts, dtype=int), np.array(stops, dtype=int)
+    means = (csum[..., stops] - csum[..., starts]) / (stops - starts)
+    return names, means
+
+
+def sliding_windows(tmin, tmax, length, step, prefix='win'):
+    """Build a windows dict of (possibly overlapping) windows in ms.
+
+    E.g. sliding_windows(0, 30000, 2000, 500) gives 2-s windows every 0.5 s
+    over a 30-s epoch, named 'win_0', 'win_500', ...
+    """
+    windows = {}
+    start = tmin
+    while start + length <= tmax:
+        windows['%s_%g' % (prefix, start)] = (start, start + length)
+        start += step
+    return windows
+
+
+def window_view(data, sfreq, window, step=None):
+    """Read-only view of the windows of data along its last axis.
+
+    Parameters
+    ----------
+    data : array, shape (..., n_times)
+        Continuous data.
+    sfreq : float
+        Sampling frequency.
+    window : float
+        Window length in seconds.
+    step : float | None
+        Step between window starts in seconds; None for non-overlapping
+        windows.
+
+    Returns
+    -------
+    starts : array of int
+        First sample of each window.
+    view : array, shape (n_windows, ..., n_samples)
+        The windows, sharing memory with data.
+    """
+    n = int(round(window * sfreq))
+    n_step = n if step is None else int(round(step * sfreq))
+    if n < 1 or n_step < 1:
+        raise ValueError('window and step must be at least one sample')
+    if data.shape[-1] < n:
+        return np.zeros(0, dtype=int), np.empty((0,) + data.shape[:-1] + (n,), data.dtype)
+    view = np.lib.stride_tricks.sliding_window_view(data, n, axis=-1)[..., ::n_step, :]
+    starts = np.arange(view.shape[-2]) * n_step
+    return starts, np.moveaxis(view, -2, 0)
+
+
+def mask_intervals(mask):
+    """[start, stop) sample intervals where a boolean mask is true."""
+    edges = np.diff(np.concatenate([[0], np.asarray(mask, dtype=np.int8), [0]]))
+    return list(zip(np.nonzero(edges == 1)[0], np.nonzero(edges == -1)[0]))
+
+
+def interval_windows(data, sfreq, window, step=None, mask=None):
+    """Windows of data that lie entirely inside the intervals of a mask.
+
+    E.g. mask=(hypno == 3) for N3, or hypno >= 0 to leave out artifacts
+    marked with -1. Unlike windowing data[..., mask], no window spans the
+    gap between two separate intervals, and nothing is copied.
+
+    Returns a list of (starts, view) pairs as from window_view, one per
+    interval long enough to hold a window; starts are samples in data.
+    """
+    if mask is None:
+        mask = np.ones(data.shape[-1], dtype=bool)
+    out = []
+    for start, stop in mask_intervals(mask):
+        starts, view = window_view(data[..., start:stop], sfreq, window, step)
+        if len(starts):
+            out.append((starts + start, view))
+    return out